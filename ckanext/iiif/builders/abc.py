@@ -1,5 +1,9 @@
 import abc
-from typing import Optional
+from typing import Dict, List, Optional, Tuple, Union
+
+from ..lib.concurrency import run_async, run_in_thread
+from .model import IIIFResource
+from .utils import IIIFBuildError
 
 
 class IIIFResourceBuilder(abc.ABC):
@@ -8,12 +12,90 @@ class IIIFResourceBuilder(abc.ABC):
 
     Subclasses should be registered with the IIIF plugin as builders using the
     register_iiif_builders function on the IIIIF interface.
+
+    Subclasses can optionally declare the prefixes of the identifiers they build, where
+    a prefix is one or more leading path segments of the identifier and a segment of
+    "*" matches any single segment (e.g. "resource/*/record" for
+    "resource/<resource_id>/record/<record_id>"). When prefixes are declared, the
+    builder is only asked to match identifiers with one of these prefixes, otherwise it
+    is asked to match every identifier.
+
+    Builders which need to do several independent blocking things to build a resource
+    (e.g. call a few CKAN actions or remote services) can extend
+    AsyncIIIFResourceBuilder instead so that they can do them concurrently.
     """
 
+    prefixes: Tuple[str, ...] = ()
+
     @abc.abstractmethod
-    def match_and_build(self, identifier: str) -> Optional[dict]: ...
+    def match_and_build(
+        self, identifier: str
+    ) -> Optional[Union[dict, IIIFResource]]: ...
+
+    async def match_and_build_async(
+        self, identifier: str
+    ) -> Optional[Union[dict, IIIFResource]]:
+        """
+        Async variant of match_and_build, for use by async code. By default, this calls
+        match_and_build in a thread so that the event loop isn't blocked.
+
+        :param identifier: the IIIF resource identifier
+        :returns: the built resource or None if the identifier wasn't matched
+        :raises IIIFBuildError: if anything goes wrong after the identifier is matched
+        """
+        return await run_in_thread(self.match_and_build, identifier)
 
     @abc.abstractmethod
     def build_identifier(self, **kwargs) -> str:
         # this is called from an action so only kwargs are used
         ...
+
+    def match_and_build_many(
+        self, identifiers: List[str]
+    ) -> Dict[str, Union[dict, IIIFResource, IIIFBuildError]]:
+        """
+        Build the IIIF resources for all the given identifiers that this builder
+        matches. By default, this just calls match_and_build for each identifier but
+        subclasses can override it to share work between the identifiers (e.g. by
+        retrieving data in bulk).
+
+        :param identifiers: the IIIF resource identifiers
+        :returns: a dict of identifier -> built resource or the IIIFBuildError raised
+            when building it, identifiers which weren't matched are not included
+        """
+        results = {}
+        for identifier in identifiers:
+            try:
+                result = self.match_and_build(identifier)
+            except IIIFBuildError as e:
+                result = e
+            if result is not None:
+                results[identifier] = result
+        return results
+
+
+class AsyncIIIFResourceBuilder(IIIFResourceBuilder):
+    """
+    Abstract base class for a IIIF resource builder which builds resources with async
+    code, allowing it to fan out its I/O (e.g. using asyncio.gather). Subclasses
+    implement match_and_build_async and the synchronous match_and_build, which is what
+    the build_iiif_resource action and the iiif blueprint call, runs it to completion.
+
+    Blocking calls, such as CKAN actions, should be wrapped with
+    ckanext.iiif.lib.concurrency.run_in_thread so that they can run concurrently.
+    """
+
+    @abc.abstractmethod
+    async def match_and_build_async(
+        self, identifier: str
+    ) -> Optional[Union[dict, IIIFResource]]: ...
+
+    def match_and_build(self, identifier: str) -> Optional[Union[dict, IIIFResource]]:
+        """
+        Runs match_and_build_async to completion and returns the result.
+
+        :param identifier: the IIIF resource identifier
+        :returns: the built resource or None if the identifier wasn't matched
+        :raises IIIFBuildError: if anything goes wrong after the identifier is matched
+        """
+        return run_async(self.match_and_build_async(identifier))
@@ -0,0 +1,234 @@
+import re
+from typing import Optional, Union
+
+from ..lib.dimensions import resolve_dimensions
+from .abc import AsyncIIIFResourceBuilder
+from .manifest import RecordManifestBuilder
+from .model import Annotation, AnnotationPage, Canvas
+from .template import get_template
+from .utils import IIIFBuildError, create_id_url, get_modified
+
+
+class RecordCanvasBuilder(AsyncIIIFResourceBuilder):
+    """
+    Builds the individual canvases, annotation pages and annotations of record
+    manifests, so that the IDs published in the manifests can be dereferenced. This
+    includes the annotation pages which manifests with many images only reference rather
+    than embed. Only the requested canvas is built (e.g. only its image's dimensions are
+    resolved and no metadata is built), which is much cheaper than building the whole
+    manifest.
+    """
+
+    BUILDER_ID = 'canvas'
+    IDENTIFIER_REGEX = re.compile(
+        'resource/(?P<resource_id>.+?)/record/(?P<record_id>[^/]+)'
+        '/canvas/(?P<image_number>[0-9]+)'
+        '(?:/(?P<page_number>[0-9]+)(?:/(?P<annotation_number>[0-9]+))?)?$'
+    )
+
+    prefixes = ('resource/*/record/*/canvas',)
+
+    def build_identifier(
+        self,
+        resource_id: str,
+        record_id: Union[str, int],
+        image_number: Union[str, int],
+        page_number: Optional[Union[str, int]] = None,
+        annotation_number: Optional[Union[str, int]] = None,
+    ) -> str:
+        """
+        Given a resource_id, a record_id and an image number, builds the canvas
+        identifier and returns it. If a page number is given, the identifier of that
+        annotation page on the canvas is returned instead, and if an annotation number
+        is given as well, the identifier of that annotation on the page.
+
+        :param resource_id: the resource ID
+        :param record_id: the record ID
+        :param image_number: the number of the image on the record
+        :param page_number: the annotation page number, if an annotation page is wanted
+        :param annotation_number: the annotation number, if an annotation is wanted
+        :returns: the identifier
+        """
+        manifest_id = RecordManifestBuilder._build_record_manifest_id(
+            resource_id, str(record_id)
+        )
+        identifier = f'{manifest_id}/canvas/{image_number}'
+        if page_number is not None:
+            identifier = f'{identifier}/{page_number}'
+            if annotation_number is not None:
+                identifier = f'{identifier}/{annotation_number}'
+        return identifier
+
+    async def match_and_build_async(
+        self, identifier: str
+    ) -> Optional[Union[Canvas, AnnotationPage, Annotation]]:
+        """
+        Build the canvas, annotation page or annotation for the given identifier. If the
+        identifier does not match the format required then None is returned, otherwise
+        an attempt to build the resource is made and any issues will result in raised
+        exceptions. The resource and the record are retrieved concurrently.
+
+        :param identifier: the canvas, annotation page or annotation ID
+        :returns: the canvas, annotation page or annotation or None if the identifier
+            wasn't a match to the required format
+        :raises IIIFBuildError: if anything goes wrong after the identifier is matched
+        """
+        match = RecordCanvasBuilder.IDENTIFIER_REGEX.match(identifier)
+        if not match:
+            return None
+        resource_id, record_id, image_number, page_number, annotation_number = (
+            match.groups()
+        )
+
+        (
+            resource,
+            record,
+            version,
+        ) = await RecordManifestBuilder._get_resource_and_record(
+            identifier, resource_id, record_id
+        )
+        if page_number is None:
+            return RecordCanvasBuilder.build_canvas(
+                resource, record, int(image_number), version
+            )
+        if annotation_number is None:
+            return RecordCanvasBuilder.build_annotation_page(
+                resource, record, int(image_number), int(page_number), version
+            )
+        return RecordCanvasBuilder.build_annotation(
+            resource,
+            record,
+            int(image_number),
+            int(page_number),
+            int(annotation_number),
+            version,
+        )
+
+    @staticmethod
+    def build_canvas(
+        resource: dict, record: dict, image_number: int, version: Optional[int] = None
+    ) -> Canvas:
+        """
+        Given a resource, a record and an image number, build the IIIF canvas for the
+        image. This is the same as the canvas in the record's manifest, with a context
+        and a reference to the manifest it's part of.
+
+        :param resource: the resource dict
+        :param record: the record data
+        :param image_number: the number of the image on the record
+        :param version: the record's version, if known, used to work out when the
+            canvas was last modified
+        :returns: the IIIF canvas
+        :raises IIIFBuildError: if the record doesn't have the image
+        """
+        manifest_id = RecordManifestBuilder._build_record_manifest_id(resource, record)
+        image = RecordCanvasBuilder._get_image(resource, record, image_number)
+        canvas = RecordManifestBuilder._build_canvas(
+            manifest_id, image_number, image, resolve_dimensions([image]).get(image)
+        )
+        canvas.part_of = create_id_url(manifest_id)
+        canvas.context = True
+        canvas.modified = get_modified(resource, version)
+        return canvas
+
+    @staticmethod
+    def build_annotation_page(
+        resource: dict,
+        record: dict,
+        image_number: int,
+        page_number: int,
+        version: Optional[int] = None,
+    ) -> AnnotationPage:
+        """
+        Given a resource, a record, an image number and a page number, build the IIIF
+        annotation page on the image's canvas. Each canvas currently has a single
+        annotation page painting the image onto it.
+
+        :param resource: the resource dict
+        :param record: the record data
+        :param image_number: the number of the image on the record
+        :param page_number: the number of the annotation page on the image's canvas
+        :param version: the record's version, if known, used to work out when the
+            annotation page was last modified
+        :returns: the IIIF annotation page
+        :raises IIIFBuildError: if the record doesn't have the image or the canvas
+            doesn't have the annotation page
+        """
+        manifest_id = RecordManifestBuilder._build_record_manifest_id(resource, record)
+        image = RecordCanvasBuilder._get_image(resource, record, image_number)
+        canvas_id = f'{manifest_id}/canvas/{image_number}'
+        if page_number != 0:
+            raise IIIFBuildError(
+                f'{canvas_id}/{page_number}',
+                f'Annotation page {page_number} not found',
+            )
+        page = RecordManifestBuilder._build_annotation_page(
+            create_id_url(canvas_id), image
+        )
+        page.context = True
+        page.modified = get_modified(resource, version)
+        return page
+
+    @staticmethod
+    def build_annotation(
+        resource: dict,
+        record: dict,
+        image_number: int,
+        page_number: int,
+        annotation_number: int,
+        version: Optional[int] = None,
+    ) -> Annotation:
+        """
+        Given a resource, a record, an image number, a page number and an annotation
+        number, build the IIIF annotation on the image's canvas's annotation page. Each
+        annotation page currently has a single annotation painting the image onto the
+        canvas.
+
+        :param resource: the resource dict
+        :param record: the record data
+        :param image_number: the number of the image on the record
+        :param page_number: the number of the annotation page on the image's canvas
+        :param annotation_number: the number of the annotation on the page
+        :param version: the record's version, if known, used to work out when the
+            annotation was last modified
+        :returns: the IIIF annotation
+        :raises IIIFBuildError: if the record doesn't have the image, the canvas doesn't
+            have the annotation page or the page doesn't have the annotation
+        """
+        page = RecordCanvasBuilder.build_annotation_page(
+            resource, record, image_number, page_number, version
+        )
+        if annotation_number >= len(page.items):
+            manifest_id = RecordManifestBuilder._build_record_manifest_id(
+                resource, record
+            )
+            raise IIIFBuildError(
+                f'{manifest_id}/canvas/{image_number}/{page_number}/{annotation_number}',
+                f'Annotation {annotation_number} not found',
+            )
+        annotation = page.items[annotation_number]
+        annotation.context = True
+        annotation.modified = page.modified
+        return annotation
+
+    @staticmethod
+    def _get_image(resource: dict, record: dict, image_number: int) -> str:
+        """
+        Returns the URL of the given image on the record.
+
+        :param resource: the resource dict
+        :param record: the record data
+        :param image_number: the number of the image on the record
+        :returns: the image URL
+        :raises IIIFBuildError: if the record doesn't have the image
+        """
+        images = get_template(resource).get_images(record)
+        if image_number >= len(images):
+            manifest_id = RecordManifestBuilder._build_record_manifest_id(
+                resource, record
+            )
+            raise IIIFBuildError(
+                f'{manifest_id}/canvas/{image_number}',
+                f'Image {image_number} not found',
+            )
+        return images[image_number]
@@ -0,0 +1,186 @@
+import base64
+import json
+import re
+from typing import List, Optional
+
+from ckan.logic import NotFound
+from ckan.plugins import toolkit
+
+from ..lib.search import multi_query
+from .abc import IIIFResourceBuilder
+from .manifest import RecordManifestBuilder
+from .utils import IIIFBuildError, create_id_url, wrap_language
+
+# the largest number of manifests that will be put in one page of a collection, this
+# bounds the memory used to build a page regardless of the configured page size
+MAX_PAGE_SIZE = 1000
+
+
+class ResourceCollectionBuilder(IIIFResourceBuilder):
+    """
+    Builds IIIF Collections of the manifests of all the image-bearing records in a
+    resource.
+
+    Resources can contain millions of records so each collection only contains a page of
+    manifest references. If there are more records, the last item in the collection is a
+    reference to the collection containing the next page. Pages are keyset paginated
+    using the after value from the versioned datastore which is encoded in the
+    identifier of the next page, this means any page can be built without walking
+    through the pages before it.
+    """
+
+    BUILDER_ID = 'collection'
+    IDENTIFIER_REGEX = re.compile(
+        'resource/(?P<resource_id>[^/]+)/collection(?:/(?P<after>[^/]+))?$'
+    )
+
+    prefixes = ('resource/*/collection',)
+
+    def build_identifier(self, resource_id: str, after: Optional[str] = None) -> str:
+        """
+        Given a resource_id, builds the collection identifier and returns it.
+
+        :param resource_id: the resource ID
+        :param after: the encoded after value of the page, if not the first page
+        :returns: the identifier
+        """
+        return ResourceCollectionBuilder._build_collection_id(resource_id, after)
+
+    def match_and_build(self, identifier: str) -> Optional[dict]:
+        """
+        Build the collection for the given resource id & optional page identifier. If
+        the identifier does not match format required then None is returned, otherwise
+        an attempt to build the collection is made and any issues will result in raised
+        exceptions.
+
+        :param identifier: the collection ID
+        :returns: the collection as a dict or None if the identifier wasn't a match to
+            the required format
+        :raises IIIFBuildError: if anything goes wrong after the identifier is matched
+        """
+        match = ResourceCollectionBuilder.IDENTIFIER_REGEX.match(identifier)
+        if not match:
+            return None
+        resource_id, encoded_after = match.groups()
+
+        try:
+            resource = toolkit.get_action('resource_show')({}, {'id': resource_id})
+        except NotFound:
+            raise IIIFBuildError(identifier, f'Resource {resource_id} not found')
+
+        image_field = resource.get('_image_field')
+        if not image_field:
+            raise IIIFBuildError(identifier, 'Resource has no image field')
+
+        after = None
+        if encoded_after:
+            try:
+                after = decode_after(encoded_after)
+            except ValueError:
+                raise IIIFBuildError(identifier, 'Invalid page')
+
+        page_size = toolkit.asint(
+            toolkit.config.get('ckanext.iiif.collection.page_size', 100)
+        )
+        page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+        query = {'filters': {'and': [{'exists': {'fields': [image_field]}}]}}
+        result = multi_query(resource_id, query, page_size, after)
+
+        items = ResourceCollectionBuilder._build_items(resource, result['records'])
+        if result.get('after') and result['records']:
+            next_id = ResourceCollectionBuilder._build_collection_id(
+                resource_id, encode_after(result['after'])
+            )
+            items.append(
+                {
+                    'id': create_id_url(next_id),
+                    'type': 'Collection',
+                    'label': wrap_language('Next page'),
+                }
+            )
+
+        collection = {
+            '@context': 'http://iiif.io/api/presentation/3/context.json',
+            'id': create_id_url(identifier),
+            'type': 'Collection',
+            'label': wrap_language(resource.get('name') or resource_id),
+            'items': items,
+        }
+        if encoded_after:
+            collection['partOf'] = [
+                {
+                    'id': create_id_url(
+                        ResourceCollectionBuilder._build_collection_id(resource_id)
+                    ),
+                    'type': 'Collection',
+                }
+            ]
+        return collection
+
+    @staticmethod
+    def _build_collection_id(resource_id: str, after: Optional[str] = None) -> str:
+        """
+        Builds the collection ID from the given resource ID and encoded after value.
+
+        :param resource_id: the resource ID
+        :param after: the encoded after value of the page, if not the first page
+        :returns: the collection ID
+        """
+        collection_id = f'resource/{resource_id}/collection'
+        return f'{collection_id}/{after}' if after else collection_id
+
+    @staticmethod
+    def _build_items(resource: dict, records: List[dict]) -> List[dict]:
+        """
+        Builds the manifest references for the given records. Records which don't have
+        any images are skipped.
+
+        :param resource: the resource dict
+        :param records: the records from the versioned datastore search
+        :returns: a list of manifest references
+        """
+        items = []
+        for record in records:
+            try:
+                reference = RecordManifestBuilder.build_record_manifest_reference(
+                    resource, record['data']
+                )
+            except IIIFBuildError:
+                continue
+            items.append(
+                {
+                    'id': reference['id'],
+                    'type': reference['type'],
+                    'label': reference['label'],
+                }
+            )
+        return items
+
+
+def encode_after(after: list) -> str:
+    """
+    Encodes the given versioned datastore after value into a URL safe string.
+
+    :param after: the after value
+    :returns: the encoded after value
+    """
+    encoded = base64.urlsafe_b64encode(json.dumps(after).encode('utf-8'))
+    return encoded.decode('ascii').rstrip('=')
+
+
+def decode_after(encoded: str) -> list:
+    """
+    Decodes the given encoded after value back into a versioned datastore after value.
+
+    :param encoded: the encoded after value
+    :returns: the after value
+    :raises ValueError: if the encoded value is invalid
+    """
+    try:
+        padded = encoded + '=' * (-len(encoded) % 4)
+        after = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, UnicodeError) as e:
+        raise ValueError(f'Invalid after value: {encoded}') from e
+    if not isinstance(after, list):
+        raise ValueError(f'Invalid after value: {encoded}')
+    return after
@@ -0,0 +1,67 @@
+import threading
+from importlib import import_module
+from typing import Dict, List, Optional, Tuple, Union
+
+from .abc import IIIFResourceBuilder
+from .model import IIIFResource
+from .utils import IIIFBuildError
+
+
+class LazyBuilder(IIIFResourceBuilder):
+    """
+    Stands in for a builder which is only imported and instantiated the first time it's
+    used. This means the modules the builder needs (and everything they import) aren't
+    loaded when the plugin is, just when the first identifier is dispatched to the
+    builder.
+
+    The builder's ID and identifier prefixes are given up front so that the builder can
+    be registered and indexed without loading it.
+    """
+
+    def __init__(self, builder_id: str, path: str, prefixes: Tuple[str, ...] = ()):
+        """
+        :param builder_id: the ID of the builder, used in metrics
+        :param path: the builder class to load in the form "module:ClassName"
+        :param prefixes: the identifier prefixes the builder declares
+        """
+        self.BUILDER_ID = builder_id
+        self.path = path
+        self.prefixes = prefixes
+        self._builder: Optional[IIIFResourceBuilder] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        """
+        :returns: whether the builder has been loaded yet
+        """
+        return self._builder is not None
+
+    @property
+    def builder(self) -> IIIFResourceBuilder:
+        """
+        :returns: the builder, which is imported and instantiated on first access
+        """
+        if self._builder is None:
+            with self._lock:
+                if self._builder is None:
+                    module_name, _, class_name = self.path.partition(':')
+                    builder_class = getattr(import_module(module_name), class_name)
+                    self._builder = builder_class()
+        return self._builder
+
+    def match_and_build(self, identifier: str) -> Optional[Union[dict, IIIFResource]]:
+        return self.builder.match_and_build(identifier)
+
+    async def match_and_build_async(
+        self, identifier: str
+    ) -> Optional[Union[dict, IIIFResource]]:
+        return await self.builder.match_and_build_async(identifier)
+
+    def match_and_build_many(
+        self, identifiers: List[str]
+    ) -> Dict[str, Union[dict, IIIFResource, IIIFBuildError]]:
+        return self.builder.match_and_build_many(identifiers)
+
+    def build_identifier(self, **kwargs) -> str:
+        return self.builder.build_identifier(**kwargs)
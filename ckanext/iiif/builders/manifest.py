@@ -1,18 +1,28 @@
+import asyncio
 import re
-from typing import Dict, List, Optional, Union
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple, Union
 
-from ckan import model
-from ckan.common import config
-from ckan.lib.helpers import url_for_static_or_external
 from ckan.logic import NotFound
 from ckan.plugins import toolkit
 
-from .abc import IIIFResourceBuilder
-from .utils import IIIFBuildError, create_id_url, wrap_language
+from ..lib import metrics
+from ..lib.concurrency import action_context, run_in_thread
+from ..lib.dimensions import DEFAULT_DIMENSIONS, Dimensions, resolve_dimensions
+from ..lib.search import get_records
+from .abc import AsyncIIIFResourceBuilder
+from .model import Annotation, AnnotationPage, Canvas, Manifest
+from .template import ManifestTemplate, get_template
+from .utils import IIIFBuildError, create_id_url, get_modified
 
 
-class RecordManifestBuilder(IIIFResourceBuilder):
+class RecordManifestBuilder(AsyncIIIFResourceBuilder):
     BUILDER_ID = 'record'
+    IDENTIFIER_REGEX = re.compile(
+        'resource/(?P<resource_id>.+?)/record/(?P<record_id>[^/]+)$'
+    )
+
+    prefixes = ('resource/*/record',)
 
     def build_identifier(self, resource_id: str, record_id: Union[str, int]) -> str:
         """
@@ -27,82 +37,261 @@ class RecordManifestBuilder(IIIFResourceBuilder):
             resource_id, str(record_id)
         )
 
-    def match_and_build(self, identifier: str) -> Optional[dict]:
+    async def match_and_build_async(self, identifier: str) -> Optional[Manifest]:
         """
         Build the manifest for the given resource id & record id identifier. If the
         identifier does not match format required then None is returned, otherwise an
         attempt to build the manifest is made and any issues will result in raised
-        exceptions.
+        exceptions. The resource and the record are retrieved concurrently.
 
         :param identifier: the manifest ID
-        :returns: the manifest as a dict or None if the identifier wasn't a match to the
-            required format
+        :returns: the manifest or None if the identifier wasn't a match to the required
+            format
         :raises IIIFBuildError: if anything goes wrong after the identifier is matched
         """
-        regex = re.compile(
-            'resource/(?P<resource_id>.+?)/record/(?P<record_id>[^/]+).*$'
-        )
-        match = regex.match(identifier)
+        match = RecordManifestBuilder.IDENTIFIER_REGEX.match(identifier)
         if not match:
             return None
         resource_id, record_id = match.groups()
 
+        (
+            resource,
+            record,
+            version,
+        ) = await RecordManifestBuilder._get_resource_and_record(
+            identifier, resource_id, record_id
+        )
+        return RecordManifestBuilder.build_record_manifest_model(
+            resource, record, version
+        )
+
+    @staticmethod
+    async def _get_resource_and_record(
+        identifier: str, resource_id: str, record_id: str
+    ) -> Tuple[dict, dict, Optional[int]]:
+        """
+        Retrieves the given resource and the data and version of the given record
+        concurrently.
+
+        :param identifier: the IIIF resource ID, used in errors
+        :param resource_id: the resource ID
+        :param record_id: the record ID
+        :returns: a 3-tuple of the resource dict, the record data and the record's
+            version (None if it isn't known)
+        :raises IIIFBuildError: if the resource or record doesn't exist
+        """
+        resource, record = await asyncio.gather(
+            run_in_thread(RecordManifestBuilder._get_resource, identifier, resource_id),
+            run_in_thread(
+                RecordManifestBuilder._get_record, identifier, resource_id, record_id
+            ),
+            return_exceptions=True,
+        )
+        # if both fail then the resource's error is the more useful one
+        for result in (resource, record):
+            if isinstance(result, BaseException):
+                raise result
+        data, version = record
+        return resource, data, version
+
+    @staticmethod
+    def _get_resource(identifier: str, resource_id: str) -> dict:
+        """
+        Retrieves the given resource.
+
+        :param identifier: the manifest ID, used in errors
+        :param resource_id: the resource ID
+        :returns: the resource dict
+        :raises IIIFBuildError: if the resource doesn't exist
+        """
         try:
-            resource = toolkit.get_action('resource_show')({}, {'id': resource_id})
+            with metrics.ACTION.time(action='resource_show') as labels:
+                resource = toolkit.get_action('resource_show')(
+                    action_context(), {'id': resource_id}
+                )
+                labels['outcome'] = 'ok'
+                return resource
         except NotFound:
             raise IIIFBuildError(identifier, f'Resource {resource_id} not found')
 
+    @staticmethod
+    def _get_record(
+        identifier: str, resource_id: str, record_id: str
+    ) -> Tuple[dict, Optional[int]]:
+        """
+        Retrieves the data and version of the given record.
+
+        :param identifier: the manifest ID, used in errors
+        :param resource_id: the resource ID
+        :param record_id: the record ID
+        :returns: a 2-tuple of the record data and the record's version, or None if the
+            versioned datastore didn't include it
+        :raises IIIFBuildError: if the record doesn't exist
+        """
         try:
-            result = toolkit.get_action('vds_data_get')(
-                {}, {'resource_id': resource_id, 'record_id': record_id}
-            )
-            # we're only going to use the data part
-            record = result['data']
+            with metrics.ACTION.time(action='vds_data_get') as labels:
+                result = toolkit.get_action('vds_data_get')(
+                    action_context(),
+                    {'resource_id': resource_id, 'record_id': record_id},
+                )
+                labels['outcome'] = 'ok'
+            # we're only going to use the data part and the version, which is used to
+            # work out when the IIIF resources built from the record were modified
+            return result['data'], result.get('version')
         except NotFound:
             raise IIIFBuildError(identifier, f'Record {record_id} not found')
 
-        return RecordManifestBuilder.build_record_manifest(resource, record)
+    def match_and_build_many(
+        self, identifiers: List[str]
+    ) -> Dict[str, Union[Manifest, IIIFBuildError]]:
+        """
+        Build the manifests for all the given identifiers that match the resource id &
+        record id format. Each resource is only retrieved once and the records from
+        each resource are retrieved in bulk.
+
+        :param identifiers: the manifest IDs
+        :returns: a dict of identifier -> manifest or the IIIFBuildError raised when
+            building it, identifiers which weren't matched are not included
+        """
+        results = {}
+
+        # resource_id -> record_id -> identifiers
+        grouped = defaultdict(lambda: defaultdict(list))
+        for identifier in identifiers:
+            match = RecordManifestBuilder.IDENTIFIER_REGEX.match(identifier)
+            if match:
+                resource_id, record_id = match.groups()
+                grouped[resource_id][record_id].append(identifier)
+
+        resource_show = toolkit.get_action('resource_show')
+        for resource_id, record_identifiers in grouped.items():
+            try:
+                resource = resource_show({}, {'id': resource_id})
+                records = get_records(resource_id, record_identifiers.keys())
+            except NotFound:
+                for matched in record_identifiers.values():
+                    for identifier in matched:
+                        results[identifier] = IIIFBuildError(
+                            identifier, f'Resource {resource_id} not found'
+                        )
+                continue
+
+            for record_id, matched in record_identifiers.items():
+                record = records.get(record_id)
+                for identifier in matched:
+                    if record is None:
+                        results[identifier] = IIIFBuildError(
+                            identifier, f'Record {record_id} not found'
+                        )
+                        continue
+                    try:
+                        results[identifier] = (
+                            RecordManifestBuilder.build_record_manifest_model(
+                                resource, record
+                            )
+                        )
+                    except IIIFBuildError as e:
+                        results[identifier] = e
+
+        return results
 
     @staticmethod
-    def build_record_manifest(resource: dict, record: dict) -> Optional[dict]:
+    def build_record_manifest(resource: dict, record: dict) -> dict:
         """
         Given a resource and a record, build a IIIF manifest for the images held within
-        the record.
+        the record and return it as a dict. See build_record_manifest_model.
 
         :param resource: the resource dict
         :param record: the record data
+        :returns: the IIIF manifest for the record and its images as a dict
+        :raises IIIFBuildError: if no images are present on the record or the resource's
+            licence is unknown
+        """
+        return RecordManifestBuilder.build_record_manifest_model(
+            resource, record
+        ).to_dict()
+
+    @staticmethod
+    def build_record_manifest_model(
+        resource: dict, record: dict, version: Optional[int] = None
+    ) -> Manifest:
+        """
+        Given a resource and a record, build a IIIF manifest for the images held within
+        the record. The manifest is returned in the compact internal representation,
+        which can be rendered straight to JSON or converted to a dict.
+
+        :param resource: the resource dict
+        :param record: the record data
+        :param version: the record's version, if known, used to work out when the
+            manifest was last modified
         :returns: the IIIF manifest for the record and its images
-        :raises IIIFBuildError: if no images are present on the record
+        :raises IIIFBuildError: if no images are present on the record or the resource's
+            licence is unknown
         """
+        template = get_template(resource)
         manifest_id = RecordManifestBuilder._build_record_manifest_id(resource, record)
 
-        images = RecordManifestBuilder._get_images(resource, record)
+        images = template.get_images(record)
         # if there are no images, raise an exception
         if not images:
             raise IIIFBuildError(manifest_id, 'No images found')
 
+        rights = template.rights
+        if rights is None:
+            raise IIIFBuildError(manifest_id, f'Unknown licence {template.licence_id}')
+
+        dimensions = resolve_dimensions(images)
+        # if a threshold is configured, large manifests reference their canvases'
+        # annotation pages rather than embedding them to keep the manifest small, the
+        # pages are then retrieved on demand using the RecordCanvasBuilder. This is off
+        # by default as not every viewer retrieves referenced annotation pages
+        threshold = toolkit.asint(
+            toolkit.config.get('ckanext.iiif.manifest.page_threshold', 0)
+        )
+        reference_pages = 0 < threshold < len(images)
+
         # TODO: add more properties
+        return Manifest(
+            id=create_id_url(manifest_id),
+            label=template.build_label(record),
+            metadata=RecordManifestBuilder._build_metadata(record, template),
+            rights=rights,
+            items=[
+                RecordManifestBuilder._build_canvas(
+                    manifest_id, i, image, dimensions.get(image), reference_pages
+                )
+                for i, image in enumerate(images)
+            ],
+            logo=template.logo,
+            modified=get_modified(resource, version),
+        )
+
+    @staticmethod
+    def build_record_manifest_reference(resource: dict, record: dict) -> dict:
+        """
+        Given a resource and a record, build a lightweight reference to the IIIF
+        manifest for the images held within the record. This includes the manifest's
+        URL, type and label (i.e. what is required to reference a manifest in IIIF)
+        along with the number of canvases the manifest contains, and is much cheaper to
+        build and serialise than the manifest itself.
+
+        :param resource: the resource dict
+        :param record: the record data
+        :returns: the reference to the IIIF manifest for the record
+        :raises IIIFBuildError: if no images are present on the record
+        """
+        template = get_template(resource)
+        manifest_id = RecordManifestBuilder._build_record_manifest_id(resource, record)
+
+        images = template.get_images(record)
+        if not images:
+            raise IIIFBuildError(manifest_id, 'No images found')
+
         return {
-            '@context': 'http://iiif.io/api/presentation/3/context.json',
             'id': create_id_url(manifest_id),
             'type': 'Manifest',
-            'label': RecordManifestBuilder._build_label(resource, record),
-            'metadata': RecordManifestBuilder._build_metadata(record),
-            'rights': RecordManifestBuilder._build_rights(resource),
-            'items': [
-                RecordManifestBuilder._build_canvas(manifest_id, i, image)
-                for i, image in enumerate(images)
-            ],
-            'logo': [
-                {
-                    'id': url_for_static_or_external(config.get('ckan.site_logo')),
-                    'type': 'Image',
-                    # TODO: need get these from somewhere dynamic?
-                    'format': 'image/png',
-                    'width': 120,
-                    'height': 56,
-                }
-            ],
+            'label': template.build_label(record),
+            'canvas_count': len(images),
         }
 
     @staticmethod
@@ -133,105 +322,93 @@ class RecordManifestBuilder(IIIFResourceBuilder):
         :param record: the record dict
         :returns: the label to use for this manifest
         """
-        title_field = resource.get('_title_field')
-        if not title_field:
-            title_field = '_id'
-        # make sure the value is a string (this should only be necessary if the _id is
-        # used)
-        return wrap_language(str(record.get(title_field, record.get('_id'))))
+        return get_template(resource).build_label(record)
 
     @staticmethod
-    def _build_rights(resource: dict) -> str:
+    def _build_rights(resource: dict) -> Optional[str]:
         """
         Returns the rights to use in the given resource's manifest. If no license is
         specified on the resource then cc-by is used as a default.
 
         :param resource: the resource dict
-        :returns: the license URL to use
+        :returns: the license URL to use or None if the licence is unknown
         """
-        license_id = resource.get('_image_licence', None)
-        # if the license is '' or None we override it
-        if not license_id:
-            # default the license to cc-by
-            license_id = 'cc-by'
-        return model.Package.get_license_register()[license_id].url
+        return get_template(resource).rights
 
     @staticmethod
-    def _build_metadata(record: dict) -> List[Dict[str, Dict[str, list]]]:
+    def _build_metadata(
+        record: dict, template: Optional[ManifestTemplate] = None
+    ) -> List[Dict[str, Dict[str, list]]]:
         """
         Given a record dict, builds a list of language wrapped values to use in the
-        manifest. This loops through every field in the record and adds it to the
-        returned list.
+        manifest. See ManifestTemplate.build_metadata for how the fields are selected,
+        flattened and capped.
 
         :param record: the record dict
+        :param template: the template of the record's resource, if not given then all
+            the record's fields are used
         :returns: a list of language wrapped labels and values
         """
-        # TODO: handle nested dicts and lists
-        metadata = []
-        for field, value in record.items():
-            if isinstance(value, list):
-                value = list(map(str, value))
-            elif not isinstance(value, str):
-                value = str(value)
-            metadata.append(
-                {'label': wrap_language(field), 'value': wrap_language(value)}
-            )
-
-        return metadata
+        if template is None:
+            template = ManifestTemplate({})
+        return template.build_metadata(record)
 
     @staticmethod
-    def _build_canvas(manifest_id: str, image_number: int, image_id: str) -> dict:
+    def _build_canvas(
+        manifest_id: str,
+        image_number: int,
+        image_id: str,
+        dimensions: Optional[Dimensions] = None,
+        reference_pages: bool = False,
+    ) -> Canvas:
         """
-        Builds a canvas dict for the given image.
+        Builds a canvas for the given image.
 
         :param manifest_id: the manifest id
         :param image_number: the image number on the record
         :param image_id: the image URL
-        :returns: the canvas definition
+        :param dimensions: the (width, height) of the image, if known
+        :param reference_pages: whether to only reference the canvas's annotation page
+            (by its id and type) rather than embed it
+        :returns: the canvas
         """
         canvas_id = create_id_url(f'{manifest_id}/canvas/{image_number}')
-        annotation_page_id = f'{canvas_id}/0'
-        annotation_id = f'{annotation_page_id}/0'
+        # if we don't know the image's dimensions, just use 1000x1000
+        width, height = dimensions or DEFAULT_DIMENSIONS
+        if reference_pages:
+            annotation_page = AnnotationPage(
+                RecordManifestBuilder._build_annotation_page_id(canvas_id)
+            )
+        else:
+            annotation_page = RecordManifestBuilder._build_annotation_page(
+                canvas_id, image_id
+            )
 
-        return {
-            'id': canvas_id,
-            'type': 'Canvas',
-            # we don't have access to the image data or metadata here so just use
-            # 1000x1000
-            'width': 1000,
-            'height': 1000,
-            # TODO: label needs to be using a field defined by the user
-            'label': wrap_language(image_id),
-            'items': [
-                {
-                    'id': annotation_page_id,
-                    'type': 'AnnotationPage',
-                    'items': [
-                        {
-                            'id': annotation_id,
-                            'type': 'Annotation',
-                            'motivation': 'painting',
-                            'body': {
-                                'id': image_id,
-                                'type': 'Image',
-                                # TODO: this is assuming the image is being served by a
-                                #       IIIF service and it's level2, which is will work
-                                #       for the key scenario we're supporting but
-                                #       nothing else
-                                'service': [
-                                    {
-                                        'id': image_id,
-                                        'type': 'ImageService3',
-                                        'profile': 'level2',
-                                    },
-                                ],
-                            },
-                            'target': canvas_id,
-                        },
-                    ],
-                }
-            ],
-        }
+        # TODO: label needs to be using a field defined by the user
+        return Canvas(canvas_id, width, height, image_id, (annotation_page,))
+
+    @staticmethod
+    def _build_annotation_page_id(canvas_id: str) -> str:
+        """
+        Builds the ID of the annotation page painting the image onto the given canvas.
+
+        :param canvas_id: the canvas URL
+        :returns: the annotation page URL
+        """
+        return f'{canvas_id}/0'
+
+    @staticmethod
+    def _build_annotation_page(canvas_id: str, image_id: str) -> AnnotationPage:
+        """
+        Builds the annotation page painting the given image onto its canvas.
+
+        :param canvas_id: the canvas URL
+        :param image_id: the image URL
+        :returns: the annotation page
+        """
+        annotation_page_id = RecordManifestBuilder._build_annotation_page_id(canvas_id)
+        annotation = Annotation(f'{annotation_page_id}/0', image_id, canvas_id)
+        return AnnotationPage(annotation_page_id, (annotation,))
 
     @staticmethod
     def _get_images(resource: dict, record: dict) -> List[str]:
@@ -243,19 +420,4 @@ class RecordManifestBuilder(IIIFResourceBuilder):
         :param record: the record data dict
         :returns: a list of image URLs
         """
-        image_field = resource.get('_image_field')
-        if not image_field or image_field not in record:
-            return []
-
-        value = record[image_field]
-
-        if isinstance(value, list):
-            # TODO: handle mix of dicts and str?
-            # TODO: handle non-'identifier' keyed urls?
-            if isinstance(value[0], dict):
-                return [image['identifier'] for image in value]
-            else:
-                return value
-        else:
-            image_delimiter = resource.get('_image_delimiter')
-            return value.split(image_delimiter) if image_delimiter else [value]
+        return get_template(resource).get_images(record)
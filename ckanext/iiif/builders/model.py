@@ -0,0 +1,373 @@
+import abc
+from datetime import datetime
+from itertools import islice
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from ..lib.serialisation import STREAM_CHUNK_SIZE, dumps
+
+CONTEXT = 'http://iiif.io/api/presentation/3/context.json'
+
+# the serialised context, which is the same in every standalone resource
+_CONTEXT_JSON = b'"@context":' + dumps(CONTEXT) + b','
+
+
+class IIIFResource(abc.ABC):
+    """
+    Base class of the compact internal representation of the IIIF resources built by
+    this extension. Rather than assembling deeply nested dicts, builders can return one
+    of these which holds just the values that vary between resources and renders them
+    straight to JSON bytes when the resource is served. A dict view of the resource is
+    available through to_dict for anything that needs one, such as the
+    build_iiif_resource action.
+
+    Rendering to JSON produces the same bytes as serialising the dict view with
+    ckanext.iiif.lib.serialisation.dumps.
+    """
+
+    __slots__ = ()
+
+    @abc.abstractmethod
+    def to_dict(self) -> dict:
+        """
+        :returns: the IIIF resource as a dict
+        """
+        ...
+
+    def to_json(self) -> bytes:
+        """
+        :returns: the IIIF resource serialised as JSON
+        """
+        return b''.join(self.iter_json())
+
+    def iter_json(self, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+        """
+        Yields the IIIF resource serialised as JSON in chunks. By default, the resource
+        is serialised in one chunk.
+
+        :param chunk_size: the number of items to serialise in each chunk, for resources
+            which can be streamed
+        :returns: an iterator of JSON chunks
+        """
+        yield dumps(self.to_dict())
+
+    @property
+    def item_count(self) -> int:
+        """
+        :returns: the number of items in the IIIF resource
+        """
+        return 0
+
+    @property
+    def modified(self) -> Optional[datetime]:
+        """
+        :returns: when the data the IIIF resource was built from was last modified, or
+            None if this isn't known
+        """
+        return None
+
+
+class Annotation(IIIFResource):
+    """
+    An annotation painting an image served by a level 2 IIIF image service onto a
+    canvas.
+    """
+
+    __slots__ = ('id', 'image_id', 'target', 'context', 'modified')
+
+    def __init__(
+        self,
+        id: str,
+        image_id: str,
+        target: str,
+        context: bool = False,
+        modified: Optional[datetime] = None,
+    ):
+        """
+        :param id: the annotation URL
+        :param image_id: the image URL
+        :param target: the URL of the canvas the image is painted onto
+        :param context: whether to include the context, i.e. whether this is a
+            standalone resource rather than part of an annotation page
+        :param modified: when the data the resource was built from was last modified,
+            if known
+        """
+        self.id = id
+        self.image_id = image_id
+        self.target = target
+        self.context = context
+        self.modified = modified
+
+    def to_dict(self) -> dict:
+        annotation = {'@context': CONTEXT} if self.context else {}
+        annotation['id'] = self.id
+        annotation['type'] = 'Annotation'
+        annotation['motivation'] = 'painting'
+        annotation['body'] = {
+            'id': self.image_id,
+            'type': 'Image',
+            # TODO: this is assuming the image is being served by a IIIF service and
+            #       it's level2, which is will work for the key scenario we're
+            #       supporting but nothing else
+            'service': [
+                {
+                    'id': self.image_id,
+                    'type': 'ImageService3',
+                    'profile': 'level2',
+                },
+            ],
+        }
+        annotation['target'] = self.target
+        return annotation
+
+    def iter_json(self, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+        image_id = dumps(self.image_id)
+        yield b''.join(
+            (
+                b'{',
+                _CONTEXT_JSON if self.context else b'',
+                b'"id":',
+                dumps(self.id),
+                b',"type":"Annotation","motivation":"painting","body":{"id":',
+                image_id,
+                b',"type":"Image","service":[{"id":',
+                image_id,
+                b',"type":"ImageService3","profile":"level2"}]},"target":',
+                dumps(self.target),
+                b'}',
+            )
+        )
+
+
+class AnnotationPage(IIIFResource):
+    """
+    A page of annotations on a canvas. If the page has no items then it's a reference
+    to the page (just its id and type) which is retrieved separately.
+    """
+
+    __slots__ = ('id', 'items', 'context', 'modified')
+
+    def __init__(
+        self,
+        id: str,
+        items: Optional[Sequence[Annotation]] = None,
+        context: bool = False,
+        modified: Optional[datetime] = None,
+    ):
+        """
+        :param id: the annotation page URL
+        :param items: the annotations on the page, or None if this is a reference
+        :param context: whether to include the context, i.e. whether this is a
+            standalone resource rather than part of a canvas
+        :param modified: when the data the resource was built from was last modified,
+            if known
+        """
+        self.id = id
+        self.items = items
+        self.context = context
+        self.modified = modified
+
+    @property
+    def item_count(self) -> int:
+        return len(self.items) if self.items is not None else 0
+
+    def to_dict(self) -> dict:
+        page = {'@context': CONTEXT} if self.context else {}
+        page['id'] = self.id
+        page['type'] = 'AnnotationPage'
+        if self.items is not None:
+            page['items'] = [annotation.to_dict() for annotation in self.items]
+        return page
+
+    def iter_json(self, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+        parts = [b'{', _CONTEXT_JSON if self.context else b'', b'"id":', dumps(self.id)]
+        if self.items is None:
+            parts.append(b',"type":"AnnotationPage"}')
+        else:
+            parts.append(b',"type":"AnnotationPage","items":[')
+            parts.append(b','.join(annotation.to_json() for annotation in self.items))
+            parts.append(b']}')
+        yield b''.join(parts)
+
+
+class Canvas(IIIFResource):
+    """
+    A canvas showing a single image.
+    """
+
+    __slots__ = (
+        'id',
+        'width',
+        'height',
+        'label',
+        'items',
+        'part_of',
+        'context',
+        'modified',
+    )
+
+    def __init__(
+        self,
+        id: str,
+        width: int,
+        height: int,
+        label: str,
+        items: Sequence[AnnotationPage],
+        part_of: Optional[str] = None,
+        context: bool = False,
+        modified: Optional[datetime] = None,
+    ):
+        """
+        :param id: the canvas URL
+        :param width: the width of the canvas
+        :param height: the height of the canvas
+        :param label: the label of the canvas, this is wrapped with the "none" language
+        :param items: the annotation pages on the canvas
+        :param part_of: the URL of the manifest this canvas is part of, if it should be
+            referenced
+        :param context: whether to include the context, i.e. whether this is a
+            standalone resource rather than part of a manifest
+        :param modified: when the data the resource was built from was last modified,
+            if known
+        """
+        self.id = id
+        self.width = width
+        self.height = height
+        self.label = label
+        self.items = items
+        self.part_of = part_of
+        self.context = context
+        self.modified = modified
+
+    @property
+    def item_count(self) -> int:
+        return len(self.items)
+
+    def to_dict(self) -> dict:
+        canvas = {'@context': CONTEXT} if self.context else {}
+        canvas['id'] = self.id
+        canvas['type'] = 'Canvas'
+        canvas['width'] = self.width
+        canvas['height'] = self.height
+        # TODO: label needs to be using a field defined by the user
+        canvas['label'] = {'none': [self.label]}
+        canvas['items'] = [page.to_dict() for page in self.items]
+        if self.part_of is not None:
+            canvas['partOf'] = [{'id': self.part_of, 'type': 'Manifest'}]
+        return canvas
+
+    def iter_json(self, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+        parts = [
+            b'{',
+            _CONTEXT_JSON if self.context else b'',
+            b'"id":',
+            dumps(self.id),
+            b',"type":"Canvas","width":',
+            dumps(self.width),
+            b',"height":',
+            dumps(self.height),
+            b',"label":{"none":[',
+            dumps(self.label),
+            b']},"items":[',
+            b','.join(page.to_json() for page in self.items),
+            b']',
+        ]
+        if self.part_of is not None:
+            parts.append(b',"partOf":[{"id":')
+            parts.append(dumps(self.part_of))
+            parts.append(b',"type":"Manifest"}]')
+        parts.append(b'}')
+        yield b''.join(parts)
+
+
+class Manifest(IIIFResource):
+    """
+    A manifest of canvases. The label, metadata and logo are held as the values that go
+    in the manifest as they are built by the ManifestTemplate and are small compared to
+    the canvases.
+    """
+
+    __slots__ = ('id', 'label', 'metadata', 'rights', 'items', 'logo', 'modified')
+
+    def __init__(
+        self,
+        id: str,
+        label: Dict[str, List[str]],
+        metadata: List[dict],
+        rights: str,
+        items: Sequence[Canvas],
+        logo: Any,
+        modified: Optional[datetime] = None,
+    ):
+        """
+        :param id: the manifest URL
+        :param label: the language wrapped label
+        :param metadata: the language wrapped metadata
+        :param rights: the licence URL
+        :param items: the canvases
+        :param logo: the logo block
+        :param modified: when the data the resource was built from was last modified,
+            if known
+        """
+        self.id = id
+        self.label = label
+        self.metadata = metadata
+        self.rights = rights
+        self.items = items
+        self.logo = logo
+        self.modified = modified
+
+    @property
+    def item_count(self) -> int:
+        return len(self.items)
+
+    def to_dict(self) -> dict:
+        return {
+            '@context': CONTEXT,
+            'id': self.id,
+            'type': 'Manifest',
+            'label': self.label,
+            'metadata': self.metadata,
+            'rights': self.rights,
+            'items': [canvas.to_dict() for canvas in self.items],
+            'logo': self.logo,
+        }
+
+    def iter_json(self, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+        """
+        Yields the manifest serialised as JSON, with the canvases serialised a few at a
+        time so that the manifest can be streamed. Joining the chunks together produces
+        the same bytes as calling to_json.
+
+        :param chunk_size: the number of canvases to serialise in each chunk
+        :returns: an iterator of JSON chunks
+        """
+        yield b''.join(
+            (
+                b'{',
+                _CONTEXT_JSON,
+                b'"id":',
+                dumps(self.id),
+                b',"type":"Manifest","label":',
+                dumps(self.label),
+                b',"metadata":',
+                dumps(self.metadata),
+                b',"rights":',
+                dumps(self.rights),
+                b',"items":[',
+            )
+        )
+        canvases = iter(self.items)
+        first = True
+        while True:
+            chunk = b','.join(
+                canvas.to_json() for canvas in islice(canvases, chunk_size)
+            )
+            if not chunk:
+                break
+            yield chunk if first else b',' + chunk
+            first = False
+        yield b'],"logo":' + dumps(self.logo) + b'}'
+
+    def to_json(self) -> bytes:
+        # no point chunking if everything is joined together anyway
+        return b''.join(self.iter_json(chunk_size=len(self.items) or 1))
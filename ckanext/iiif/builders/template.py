@@ -0,0 +1,244 @@
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from ckan.common import config
+from ckan.plugins import toolkit
+
+from ..lib import metrics
+from ..lib.cache import ManifestCache, resource_prefix
+from ..lib.licences import get_licence_url
+from .utils import wrap_language
+
+# compiled templates keyed by resource ID and metadata_modified, this means a template
+# is only used until its resource is modified as the edited resource's dict will have a
+# new metadata_modified value
+TEMPLATES = ManifestCache(max_size=1000)
+metrics.register_cache('templates', lambda: TEMPLATES)
+
+
+class ManifestTemplate:
+    """
+    The parts of a record manifest which only depend on the resource the record is in,
+    resolved once from the resource dict so that building each record's manifest only
+    has to do the work which depends on the record.
+    """
+
+    __slots__ = (
+        'resource_id',
+        'title_field',
+        'image_field',
+        'image_delimiter',
+        'licence_id',
+        'metadata_fields',
+        'metadata_exclude',
+        'max_value_length',
+        'max_metadata_length',
+        '_logo',
+    )
+
+    def __init__(self, resource: dict):
+        """
+        :param resource: the resource dict
+        """
+        self.resource_id = resource.get('id')
+        self.title_field = resource.get('_title_field') or '_id'
+        self.image_field = resource.get('_image_field')
+        self.image_delimiter = resource.get('_image_delimiter')
+        # if the license is '' or None we default it to cc-by
+        self.licence_id = resource.get('_image_licence') or 'cc-by'
+        # the fields to include in the metadata, None means all the record's fields
+        self.metadata_fields = parse_fields(resource.get('_metadata_fields')) or None
+        self.metadata_exclude = frozenset(
+            parse_fields(resource.get('_metadata_exclude'))
+        )
+        self.max_value_length = toolkit.asint(
+            config.get('ckanext.iiif.metadata.max_value_length', 0)
+        )
+        self.max_metadata_length = toolkit.asint(
+            config.get('ckanext.iiif.metadata.max_length', 0)
+        )
+        # this is resolved when it is first needed, see below
+        self._logo = None
+
+    @property
+    def rights(self) -> Optional[str]:
+        """
+        The rights to use in the resource's manifests. This is looked up in the process
+        level licence index each time so that it reflects any changes to the licence
+        register when the index is refreshed.
+
+        :returns: the license URL to use or None if the licence is unknown
+        """
+        return get_licence_url(self.licence_id)
+
+    @property
+    def logo(self) -> List[dict]:
+        """
+        The logo block to use in the resource's manifests. This is resolved when it is
+        first needed as resolving it requires a request context and lightweight manifest
+        references don't include it. The same list is returned every time so it must not
+        be modified.
+
+        :returns: the logo block
+        """
+        if self._logo is None:
+            # the helpers module is slow to import so it's only imported when needed
+            from ckan.lib.helpers import url_for_static_or_external
+
+            self._logo = [
+                {
+                    'id': url_for_static_or_external(config.get('ckan.site_logo')),
+                    'type': 'Image',
+                    # TODO: need get these from somewhere dynamic?
+                    'format': 'image/png',
+                    'width': 120,
+                    'height': 56,
+                }
+            ]
+        return self._logo
+
+    def build_label(self, record: dict) -> Dict[str, List[str]]:
+        """
+        Returns the label to use for the given record. This uses the title field if one
+        is specified on the resource, otherwise the record ID is used.
+
+        :param record: the record dict
+        :returns: the label to use for the record's manifest
+        """
+        # make sure the value is a string (this should only be necessary if the _id is
+        # used)
+        return wrap_language(str(record.get(self.title_field, record.get('_id'))))
+
+    def build_metadata(self, record: dict) -> List[Dict[str, Dict[str, list]]]:
+        """
+        Given a record dict, builds a list of language wrapped labels and values to use
+        in the manifest's metadata.
+
+        Only the resource's allowed fields (or all the record's fields if it doesn't
+        have any) which aren't denied are included. Nested dicts are flattened into
+        separate entries with dotted labels (e.g. "media.title") and the values of
+        lists are combined into one entry per label. Each value is truncated to the
+        maximum value length and once the total length of the values reaches the
+        maximum metadata length the rest of the record is skipped. Values are only
+        converted to strings once they are known to be included.
+
+        :param record: the record dict
+        :returns: a list of language wrapped labels and values
+        """
+        fields = record if self.metadata_fields is None else self.metadata_fields
+        entries = {}
+        length = 0
+        for field in fields:
+            if field in self.metadata_exclude or field not in record:
+                continue
+            for label, value in flatten(field, record[field]):
+                if label in self.metadata_exclude:
+                    continue
+                if not isinstance(value, str):
+                    value = str(value)
+                if self.max_value_length and len(value) > self.max_value_length:
+                    value = f'{value[: self.max_value_length]}…'
+                length += len(value)
+                if self.max_metadata_length and length > self.max_metadata_length:
+                    return _wrap_entries(entries)
+                entries.setdefault(label, []).append(value)
+        return _wrap_entries(entries)
+
+    def get_images(self, record: dict) -> List[str]:
+        """
+        Returns any images found within the given record as a list of URLs.
+
+        :param record: the record data dict
+        :returns: a list of image URLs
+        """
+        if not self.image_field or self.image_field not in record:
+            return []
+
+        value = record[self.image_field]
+
+        if isinstance(value, list):
+            # TODO: handle mix of dicts and str?
+            # TODO: handle non-'identifier' keyed urls?
+            if value and isinstance(value[0], dict):
+                return [image['identifier'] for image in value]
+            else:
+                return value
+        else:
+            delimiter = self.image_delimiter
+            return value.split(delimiter) if delimiter else [value]
+
+
+def parse_fields(value: Union[str, List[str], None]) -> List[str]:
+    """
+    Parses a list of field names from a resource extra. Resource extras are usually
+    strings so this can be a comma separated string of field names, or a list of them.
+
+    :param value: the resource extra value
+    :returns: a list of field names
+    """
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    return [field.strip() for field in value if field.strip()]
+
+
+def flatten(label: str, value: Any) -> Iterator[Tuple[str, Any]]:
+    """
+    Recursively flattens the given value into (label, value) pairs. Dicts are flattened
+    into their values with their keys appended to the label and lists are flattened
+    into their elements with the same label. None values are skipped.
+
+    :param label: the label of the value
+    :param value: the value
+    :returns: an iterator of (label, value) pairs where every value is a scalar
+    """
+    if isinstance(value, dict):
+        for key, nested in value.items():
+            yield from flatten(f'{label}.{key}', nested)
+    elif isinstance(value, (list, tuple)):
+        for element in value:
+            yield from flatten(label, element)
+    elif value is not None:
+        yield label, value
+
+
+def _wrap_entries(entries: Dict[str, List[str]]) -> List[Dict[str, Dict[str, list]]]:
+    return [
+        {'label': wrap_language(label), 'value': wrap_language(values)}
+        for label, values in entries.items()
+    ]
+
+
+def get_template(resource: dict) -> ManifestTemplate:
+    """
+    Returns the compiled manifest template for the given resource, compiling it if there
+    isn't an up-to-date one already cached. Resource dicts without an ID and
+    metadata_modified value (i.e. ones which haven't come from resource_show) can't be
+    versioned and therefore always get a newly compiled template.
+
+    :param resource: the resource dict
+    :returns: the manifest template
+    """
+    key = _get_key(resource)
+    if key is None:
+        return ManifestTemplate(resource)
+
+    template = TEMPLATES.get(key)
+    if template is None:
+        template = ManifestTemplate(resource)
+        TEMPLATES.set(key, template)
+    return template
+
+
+def _get_key(resource: dict) -> Optional[str]:
+    """
+    Returns the key to cache the given resource's template under.
+
+    :param resource: the resource dict
+    :returns: the key or None if the resource can't be cached
+    """
+    resource_id = resource.get('id')
+    modified = resource.get('metadata_modified')
+    if not resource_id or not modified:
+        return None
+    return f'{resource_prefix(resource_id)}{modified}'
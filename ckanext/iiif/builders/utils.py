@@ -1,16 +1,51 @@
-from typing import Dict, List, Union
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 from ckan.plugins import toolkit
+from flask import current_app, g, has_app_context
+
+# a value which won't be quoted in a URL and won't appear in any real URLs, used to
+# create the template URL that all the IIIF resource URLs are generated from
+ID_PLACEHOLDER = 'IIIFIDENTIFIERPLACEHOLDER'
 
 
 def create_id_url(identifier: str) -> str:
     """
     Given the identifier of a IIIF resource, creates the full URL for it.
 
+    Building URLs with url_for is slow and this is called for every canvas in a
+    manifest, so instead url_for is called once per app context (i.e. per request) with
+    a placeholder identifier and then each URL is created by substituting the quoted
+    identifier into this template. The result is the same as calling url_for directly.
+
     :param identifier: the IIIF resource ID
     :returns: the full URL for the IIIF resource (e.g. a manifest)
     """
-    return toolkit.url_for('iiif.resource', identifier=identifier, _external=True)
+    if not has_app_context():
+        return toolkit.url_for('iiif.resource', identifier=identifier, _external=True)
+    prefix, suffix, quote = _get_id_url_template()
+    return f'{prefix}{quote(identifier)}{suffix}'
+
+
+def _get_id_url_template() -> Tuple[str, str, Callable[[str], str]]:
+    """
+    Returns the template used to create IIIF resource URLs in the current app context,
+    creating it if necessary. The template is the part of the URL before the identifier,
+    the part after it, and the function used by the URL map to quote the identifier.
+
+    :returns: a 3-tuple of the prefix, suffix and quote function
+    """
+    template = getattr(g, '_iiif_id_url_template', None)
+    if template is None:
+        url = toolkit.url_for(
+            'iiif.resource', identifier=ID_PLACEHOLDER, _external=True
+        )
+        prefix, _, suffix = url.partition(ID_PLACEHOLDER)
+        url_map = current_app.url_map
+        quote = url_map.converters['path'](url_map).to_url
+        template = (prefix, suffix, quote)
+        g._iiif_id_url_template = template
+    return template
 
 
 def wrap_language(
@@ -29,6 +64,32 @@ def wrap_language(
     return {language: value}
 
 
+def get_modified(resource: dict, version: Optional[int]) -> Optional[datetime]:
+    """
+    Returns when the data the IIIF resources built from the given resource and one of
+    its records was last modified. This is the later of the resource's
+    metadata_modified value and the record's version (a timestamp in milliseconds) as
+    changes to either change the IIIF resources. Updating a record doesn't change its
+    resource's metadata_modified value, so if the record's version isn't known then
+    neither is the modification time.
+
+    :param resource: the resource dict
+    :param version: the version of the record, or None if it isn't known
+    :returns: the modification time as a UTC datetime, or None if the record's version
+        isn't known or the resource doesn't have a valid metadata_modified value
+    """
+    if version is None:
+        return None
+    try:
+        modified = datetime.fromisoformat(resource.get('metadata_modified'))
+    except (TypeError, ValueError):
+        return None
+    if modified.tzinfo is None:
+        # CKAN's timestamps are naive but in UTC
+        modified = modified.replace(tzinfo=timezone.utc)
+    return max(modified, datetime.fromtimestamp(version / 1000, timezone.utc))
+
+
 class IIIFBuildError(Exception):
     """
     An error class that should be thrown during the build process if something goes
@@ -0,0 +1,131 @@
+import click
+from ckan.plugins import toolkit
+
+from .builders.utils import IIIFBuildError
+from .lib.store import ManifestStore
+
+
+def get_commands():
+    return [iiif]
+
+
+def default_workers() -> int:
+    """
+    :returns: the default number of prebuild worker processes
+    """
+    # the prebuild module imports the builders so it's only imported when it's needed
+    from .lib.prebuild import default_workers
+
+    return default_workers()
+
+
+@click.group()
+def iiif():
+    """
+    IIIF commands.
+    """
+    pass
+
+
+@iiif.command()
+@click.argument('resource_ids', nargs=-1, required=True)
+@click.option(
+    '--store',
+    'store_dir',
+    help='The directory to write the manifests to, defaults to the '
+    'ckanext.iiif.store.dir config option',
+)
+@click.option(
+    '--workers',
+    type=click.IntRange(min=1),
+    default=default_workers,
+    show_default='the number of CPUs',
+    help='The number of worker processes to build the manifests with',
+)
+@click.option(
+    '--page-size',
+    type=click.IntRange(min=1),
+    default=1000,
+    show_default=True,
+    help='The number of records to retrieve at once',
+)
+@click.option(
+    '--chunk-size',
+    type=click.IntRange(min=1),
+    default=100,
+    show_default=True,
+    help='The number of records to send to a worker at once',
+)
+@click.option(
+    '--compress/--no-compress',
+    default=True,
+    show_default=True,
+    help='Whether to write compressed copies of the manifests to serve to clients '
+    'which accept them',
+)
+@click.option(
+    '--restart',
+    is_flag=True,
+    help='Ignore any progress made by a previous run and build every manifest again',
+)
+def prebuild(
+    resource_ids, store_dir, workers, page_size, chunk_size, compress, restart
+):
+    """
+    Builds the manifests of every record in the given resources and writes them to the
+    store. Interrupted runs resume from where they got to unless --restart is used.
+    """
+    from .lib.prebuild import PrebuildStats, prebuild_resource
+
+    store_dir = store_dir or toolkit.config.get('ckanext.iiif.store.dir')
+    if not store_dir:
+        raise click.UsageError(
+            'No store directory, use --store or set ckanext.iiif.store.dir'
+        )
+    store = ManifestStore(store_dir)
+
+    def on_progress(stats: PrebuildStats):
+        click.echo(
+            f'{stats.resource_id}: {stats.total} records, {stats.built} built, '
+            f'{stats.failed} failed ({stats.throughput:.1f}/s)'
+        )
+
+    def on_failure(failure):
+        identifier, message = failure
+        click.secho(f'Failed {identifier}: {message}', fg='red', err=True)
+
+    failed = False
+    for resource_id in resource_ids:
+        try:
+            stats = prebuild_resource(
+                resource_id,
+                store,
+                workers=workers,
+                page_size=page_size,
+                chunk_size=chunk_size,
+                restart=restart,
+                compress=compress,
+                on_progress=on_progress,
+                on_failure=on_failure,
+            )
+        except IIIFBuildError as e:
+            click.secho(str(e), fg='red', err=True)
+            failed = True
+            continue
+
+        if stats.already_complete:
+            message = 'already complete'
+        else:
+            message = (
+                f'built {stats.run_built} manifests in {stats.elapsed:.1f}s '
+                f'({stats.throughput:.1f}/s)'
+            )
+        click.secho(
+            f'{resource_id}: {message}, {stats.built} built and {stats.failed} failed '
+            f'in total',
+            fg='yellow' if stats.failed else 'green',
+        )
+        failed = failed or bool(stats.failed)
+
+    if failed:
+        raise click.exceptions.Exit(1)
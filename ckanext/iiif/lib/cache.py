@@ -0,0 +1,471 @@
+import abc
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+from typing import Any, Callable, Optional
+
+log = logging.getLogger(__name__)
+
+
+class CacheBackend(abc.ABC):
+    """
+    Abstract base class for a cache of built IIIF resources keyed by their identifier.
+    Each entry has its own expiry time, which is the cache's TTL after the entry is set
+    unless a different TTL is given when setting it.
+
+    The hits and misses attributes count the lookups which were and weren't found in the
+    cache so that they can be reported as metrics, along with the size property.
+    """
+
+    def __init__(self, ttl: float = 0):
+        """
+        :param ttl: the default number of seconds an entry is valid for, 0 means entries
+            never expire
+        """
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """
+        :returns: True if this cache will store values, False if not
+        """
+        return True
+
+    @property
+    def size(self) -> Optional[int]:
+        """
+        :returns: the number of entries in the cache, or None if they can't be counted
+            cheaply enough to report regularly
+        """
+        return len(self)
+
+    def _get_ttl(self, ttl: Optional[float]) -> float:
+        return self.ttl if ttl is None else ttl
+
+    def _record(self, hit: bool):
+        """
+        Counts a lookup as a hit or a miss. The cache can be used from several threads
+        at once, so the counts are updated under a lock.
+
+        :param hit: whether the lookup was found in the cache
+        """
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @abc.abstractmethod
+    def get(self, identifier: str) -> Optional[Any]:
+        """
+        Retrieve the value cached under the given identifier. If there isn't a value or
+        the value has expired, None is returned.
+
+        :param identifier: the IIIF resource identifier
+        :returns: the cached value or None
+        """
+        ...
+
+    @abc.abstractmethod
+    def set(self, identifier: str, value: Any, ttl: Optional[float] = None):
+        """
+        Cache the given value under the given identifier.
+
+        :param identifier: the IIIF resource identifier
+        :param value: the value to cache
+        :param ttl: the number of seconds the entry is valid for, 0 means it never
+            expires and None means the cache's TTL is used
+        """
+        ...
+
+    @abc.abstractmethod
+    def invalidate(self, prefix: str) -> int:
+        """
+        Remove all the entries with identifiers that start with the given prefix.
+
+        :param prefix: the identifier prefix
+        :returns: the number of entries removed
+        """
+        ...
+
+    @abc.abstractmethod
+    def clear(self):
+        """
+        Remove all entries from the cache.
+        """
+        ...
+
+    @abc.abstractmethod
+    def __len__(self) -> int: ...
+
+
+class ManifestCache(CacheBackend):
+    """
+    A bounded, thread safe, in-process cache for built IIIF resources keyed by their
+    identifier. Entries are evicted in least recently used order once the cache is full
+    and expire once they are older than their TTL.
+
+    Cached values are returned as is (i.e. not copied) so callers must not modify them.
+    """
+
+    def __init__(self, max_size: int = 0, ttl: float = 0):
+        """
+        :param max_size: the maximum number of entries to hold, 0 disables the cache
+        :param ttl: the default number of seconds an entry is valid for, 0 means entries
+            never expire
+        """
+        super().__init__(ttl)
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """
+        :returns: True if this cache will store values, False if not
+        """
+        return self.max_size > 0
+
+    def get(self, identifier: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(identifier)
+            value = None
+            if entry is not None:
+                expires, value = entry
+                if expires is not None and expires <= time.monotonic():
+                    del self._entries[identifier]
+                    value = None
+                else:
+                    self._entries.move_to_end(identifier)
+        self._record(value is not None)
+        return value
+
+    def set(self, identifier: str, value: Any, ttl: Optional[float] = None):
+        """
+        Cache the given value under the given identifier, evicting the least recently
+        used entries if the cache is full.
+
+        :param identifier: the IIIF resource identifier
+        :param value: the value to cache
+        :param ttl: the number of seconds the entry is valid for, 0 means it never
+            expires and None means the cache's TTL is used
+        """
+        if not self.enabled:
+            return
+        ttl = self._get_ttl(ttl)
+        expires = time.monotonic() + ttl if ttl > 0 else None
+        with self._lock:
+            self._entries[identifier] = (expires, value)
+            self._entries.move_to_end(identifier)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, prefix: str) -> int:
+        with self._lock:
+            identifiers = [
+                identifier
+                for identifier in self._entries
+                if identifier.startswith(prefix)
+            ]
+            for identifier in identifiers:
+                del self._entries[identifier]
+        return len(identifiers)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteCache(CacheBackend):
+    """
+    A cache of built IIIF resources stored in a SQLite database file. The file can be
+    shared by all the processes (e.g. web workers) on a server so that a resource built
+    by one of them is served from the cache by the others, and the cached resources
+    survive restarts. Values are serialised to bytes when they are set and deserialised
+    when they are retrieved, so each retrieval returns a new object.
+
+    Errors using the database are logged and treated as cache misses, as failing to
+    cache a resource shouldn't fail the request for it.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        dump: Callable[[Any], bytes],
+        load: Callable[[bytes], Any],
+        max_size: int = 0,
+        ttl: float = 0,
+    ):
+        """
+        :param path: the path of the SQLite database file
+        :param dump: a function serialising a value to bytes
+        :param load: a function deserialising a value from bytes
+        :param max_size: the maximum number of entries to hold, entries which aren't
+            among the last max_size set are evicted, 0 means no limit
+        :param ttl: the default number of seconds an entry is valid for, 0 means entries
+            never expire
+        """
+        super().__init__(ttl)
+        self.path = path
+        self.dump = dump
+        self.load = load
+        self.max_size = max_size
+        # each thread gets its own connection as they can't be shared between threads
+        self._local = threading.local()
+        with closing(self._connect()) as connection, connection:
+            # write ahead logging lets the processes read while another one writes
+            connection.execute('pragma journal_mode=wal')
+            connection.execute(
+                'create table if not exists entries ('
+                'identifier text primary key, expires real, value blob)'
+            )
+            connection.execute(
+                'create index if not exists entries_expires on entries (expires)'
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=5)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        :returns: this thread's connection to the database
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        return connection
+
+    def get(self, identifier: str) -> Optional[Any]:
+        try:
+            row = self.connection.execute(
+                'select value from entries where identifier = ? and '
+                '(expires is null or expires > ?)',
+                (identifier, time.time()),
+            ).fetchone()
+            value = self.load(row[0]) if row is not None else None
+        except Exception:
+            log.warning('Failed to read from the SQLite cache', exc_info=True)
+            value = None
+        self._record(value is not None)
+        return value
+
+    def set(self, identifier: str, value: Any, ttl: Optional[float] = None):
+        """
+        Cache the given value under the given identifier. Expired entries are removed
+        and, if the cache is full, the least recently set entries are evicted.
+
+        :param identifier: the IIIF resource identifier
+        :param value: the value to cache
+        :param ttl: the number of seconds the entry is valid for, 0 means it never
+            expires and None means the cache's TTL is used
+        """
+        ttl = self._get_ttl(ttl)
+        now = time.time()
+        expires = now + ttl if ttl > 0 else None
+        try:
+            payload = self.dump(value)
+            with self.connection as connection:
+                connection.execute(
+                    'delete from entries where expires <= ?',
+                    (now,),
+                )
+                # replacing the entry gives it a new rowid, so the rowids are in the
+                # order the entries were last set
+                rowid = connection.execute(
+                    'insert or replace into entries (identifier, expires, value) '
+                    'values (?, ?, ?)',
+                    (identifier, expires, payload),
+                ).lastrowid
+                if self.max_size > 0:
+                    # evicting the entries set before the last max_size sets only
+                    # touches the rows being evicted, whereas counting the entries
+                    # would read the whole table on every write. The cache can hold
+                    # fewer than max_size entries if some were set more than once or
+                    # removed in that time
+                    connection.execute(
+                        'delete from entries where rowid <= ?',
+                        (rowid - self.max_size,),
+                    )
+        except Exception:
+            log.warning('Failed to write to the SQLite cache', exc_info=True)
+
+    def invalidate(self, prefix: str) -> int:
+        try:
+            with self.connection as connection:
+                return connection.execute(
+                    'delete from entries where substr(identifier, 1, ?) = ?',
+                    (len(prefix), prefix),
+                ).rowcount
+        except Exception:
+            log.warning('Failed to invalidate the SQLite cache', exc_info=True)
+            return 0
+
+    def clear(self):
+        try:
+            with self.connection as connection:
+                connection.execute('delete from entries')
+        except Exception:
+            log.warning('Failed to clear the SQLite cache', exc_info=True)
+
+    def __len__(self) -> int:
+        return self.connection.execute(
+            'select count(*) from entries where expires is null or expires > ?',
+            (time.time(),),
+        ).fetchone()[0]
+
+
+class RedisCache(CacheBackend):
+    """
+    A cache of built IIIF resources stored in Redis (or anything which speaks the Redis
+    protocol), which can be shared by all the processes on all the servers. Each entry
+    is stored under its own key with its TTL set as the key's expiry, so Redis removes
+    the expired entries itself. There's no size limit, Redis' own memory limit and
+    eviction policy should be used instead. Values are serialised to bytes when they are
+    set and deserialised when they are retrieved, so each retrieval returns a new
+    object.
+
+    Errors using Redis are logged and treated as cache misses, as failing to cache a
+    resource shouldn't fail the request for it.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], Any],
+        dump: Callable[[Any], bytes],
+        load: Callable[[bytes], Any],
+        ttl: float = 0,
+        prefix: str = 'ckanext-iiif:cache:',
+    ):
+        """
+        :param connect: a function returning a Redis client
+        :param dump: a function serialising a value to bytes
+        :param load: a function deserialising a value from bytes
+        :param ttl: the default number of seconds an entry is valid for, 0 means entries
+            never expire
+        :param prefix: the prefix of the Redis keys used
+        """
+        super().__init__(ttl)
+        self.connect = connect
+        self.dump = dump
+        self.load = load
+        self.prefix = prefix
+        self._redis = None
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = self.connect()
+        return self._redis
+
+    def get(self, identifier: str) -> Optional[Any]:
+        try:
+            payload = self.redis.get(f'{self.prefix}{identifier}')
+            value = self.load(payload) if payload is not None else None
+        except Exception:
+            log.warning('Failed to read from the Redis cache', exc_info=True)
+            value = None
+        self._record(value is not None)
+        return value
+
+    def set(self, identifier: str, value: Any, ttl: Optional[float] = None):
+        ttl = self._get_ttl(ttl)
+        try:
+            self.redis.set(
+                f'{self.prefix}{identifier}',
+                self.dump(value),
+                px=int(ttl * 1000) if ttl > 0 else None,
+            )
+        except Exception:
+            log.warning('Failed to write to the Redis cache', exc_info=True)
+
+    def _delete_matching(self, pattern: str) -> int:
+        """
+        Deletes all the keys matching the given pattern, in batches.
+
+        :param pattern: the Redis glob style pattern
+        :returns: the number of keys deleted
+        """
+        deleted = 0
+        batch = []
+        for key in self.redis.scan_iter(match=pattern, count=1000):
+            batch.append(key)
+            if len(batch) == 1000:
+                deleted += self.redis.delete(*batch)
+                batch = []
+        if batch:
+            deleted += self.redis.delete(*batch)
+        return deleted
+
+    def invalidate(self, prefix: str) -> int:
+        try:
+            return self._delete_matching(f'{escape_pattern(self.prefix + prefix)}*')
+        except Exception:
+            log.warning('Failed to invalidate the Redis cache', exc_info=True)
+            return 0
+
+    def clear(self):
+        try:
+            self._delete_matching(f'{escape_pattern(self.prefix)}*')
+        except Exception:
+            log.warning('Failed to clear the Redis cache', exc_info=True)
+
+    @property
+    def size(self) -> Optional[int]:
+        """
+        :returns: None, as counting the entries means scanning all the keys in Redis
+        """
+        return None
+
+    def __len__(self) -> int:
+        # this has to scan all the keys so it's only suitable for occasional use and
+        # isn't reported in the metrics
+        pattern = f'{escape_pattern(self.prefix)}*'
+        return sum(1 for _ in self.redis.scan_iter(match=pattern, count=1000))
+
+
+def connect_to_redis_url(url: str):
+    """
+    Connects to the Redis server at the given URL. The redis module is only imported
+    when it's needed.
+
+    :param url: the Redis URL, e.g. redis://localhost:6379/1
+    :returns: a Redis client
+    """
+    import redis
+
+    return redis.Redis.from_url(url)
+
+
+def escape_pattern(text: str) -> str:
+    """
+    Escapes the characters which have a special meaning in Redis glob style patterns.
+
+    :param text: the text to escape
+    :returns: the escaped text
+    """
+    return re.sub(r'([*?\[\]\\])', r'\\\1', text)
+
+
+def resource_prefix(resource_id: str) -> str:
+    """
+    Returns the prefix shared by the identifiers of all the IIIF resources which are
+    built from the given CKAN resource. This is used to invalidate cached entries when
+    the resource changes.
+
+    :param resource_id: the resource ID
+    :returns: the identifier prefix
+    """
+    return f'resource/{resource_id}/'
@@ -0,0 +1,41 @@
+import gzip
+import zlib
+from typing import Callable, Dict, Iterable, Iterator
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _gzip(body: bytes) -> bytes:
+    # a fixed mtime means the same body always compresses to the same bytes
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+
+# content encoding -> function compressing bytes with it, in order of preference. Brotli
+# is only available if the brotli package is installed
+COMPRESSORS: Dict[str, Callable[[bytes], bytes]] = {}
+if brotli is not None:
+    COMPRESSORS['br'] = lambda body: brotli.compress(body, quality=5)
+COMPRESSORS['gzip'] = _gzip
+
+# content encoding -> the suffix added to the names of files compressed with it
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+
+def iter_gzip(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Compresses the given chunks with gzip as they are yielded, for compressing streamed
+    responses.
+
+    :param chunks: the chunks to compress
+    :returns: an iterator of compressed chunks
+    """
+    # wbits of 31 produces gzip output rather than a raw zlib stream
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -0,0 +1,120 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+from ckan.plugins import toolkit
+
+T = TypeVar('T')
+
+# the threads blocking calls made by async builders are run in, this is shared by every
+# request in the process so that threads aren't created and destroyed for each one
+EXECUTOR = ThreadPoolExecutor(max_workers=32, thread_name_prefix='iiif-async')
+
+# each thread which runs async code gets its own event loop which is kept for the life
+# of the thread rather than creating a new one each time
+_local = threading.local()
+
+# the name of the user making the current request, captured in the request's thread and
+# carried into the threads blocking calls are run in. On older versions of Flask (e.g.
+# in CKAN 2.9) the request is held in thread locals rather than context variables, so
+# copying the context doesn't carry the request itself into other threads and actions
+# called in them can't work out the user for themselves
+_user: contextvars.ContextVar = contextvars.ContextVar(
+    'ckanext_iiif_user', default=None
+)
+
+
+def current_user() -> Optional[str]:
+    """
+    Returns the name of the user making the current request. In a thread running a
+    blocking call for a request, this is the user captured when the call was made.
+
+    :returns: the user's name, an empty string if the user is anonymous, or None if
+        there isn't a request
+    """
+    user = _user.get()
+    if user is None:
+        try:
+            user = toolkit.c.user or ''
+        except (AttributeError, RuntimeError, TypeError):
+            # not in a request
+            return None
+    return user
+
+
+def action_context() -> dict:
+    """
+    Creates a context for calling a CKAN action as the user making the current request.
+    Actions called in other threads (e.g. with run_in_thread) should be passed one of
+    these so that they're authorised as the right user.
+
+    :returns: a new context dict
+    """
+    user = current_user()
+    return {} if user is None else {'user': user}
+
+
+def run_async(awaitable: Awaitable[T]) -> T:
+    """
+    Runs the given awaitable to completion from synchronous code (e.g. a Flask view or
+    CKAN action) and returns its result. The awaitable is run in the current thread's
+    event loop, unless the current thread is already running an event loop in which
+    case it's run in a new thread as it can't be run in this one.
+
+    :param awaitable: the coroutine or other awaitable to run
+    :returns: the result of the awaitable
+    """
+    token = _user.set(current_user())
+    try:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            loop = getattr(_local, 'loop', None)
+            if loop is None or loop.is_closed():
+                loop = _local.loop = asyncio.new_event_loop()
+            return loop.run_until_complete(awaitable)
+
+        context = contextvars.copy_context()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(context.run, run_async, awaitable).result()
+    finally:
+        _user.reset(token)
+
+
+async def run_in_thread(function: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    Calls the given blocking function (e.g. a CKAN action) in the EXECUTOR and waits for
+    the result without blocking the event loop, allowing other calls to run at the same
+    time. The function is called with a copy of the current context so that it sees the
+    current Flask app and request where the version of Flask allows it. The user making
+    the request is always available through current_user and action_context.
+
+    :param function: the function to call
+    :param args: the args to call the function with
+    :param kwargs: the kwargs to call the function with
+    :returns: the result of the function
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    context.run(_user.set, current_user())
+    call = functools.partial(context.run, _call, function, *args, **kwargs)
+    return await loop.run_in_executor(EXECUTOR, call)
+
+
+def _call(function: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    Calls the given function and then removes the thread's database session, if it used
+    one, so that the connection goes back to the pool rather than being held by the
+    thread until it's next used.
+    """
+    try:
+        return function(*args, **kwargs)
+    finally:
+        # imported here as the model is slow to import and not needed until a builder
+        # actually runs something in a thread
+        from ckan import model
+
+        model.Session.remove()
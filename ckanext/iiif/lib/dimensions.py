@@ -0,0 +1,199 @@
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import closing
+from typing import Dict, Iterable, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+# the width and height used for canvases when the real dimensions aren't known
+DEFAULT_DIMENSIONS = (1000, 1000)
+
+Dimensions = Tuple[int, int]
+
+
+class DimensionStore:
+    """
+    Stores the dimensions of images keyed by image ID. If a path is given then the
+    dimensions are stored in a SQLite database at that path and therefore persist
+    between restarts and are shared between processes, otherwise they are just stored
+    in memory.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        :param path: the path of the SQLite database file, or None to store in memory
+        """
+        self.path = path
+        self._memory: Dict[str, Dimensions] = {}
+        self._lock = threading.Lock()
+        if self.path:
+            with closing(self._connect()) as connection, connection:
+                connection.execute(
+                    'create table if not exists dimensions ('
+                    'image_id text primary key, width integer, height integer)'
+                )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get_many(self, image_ids: Iterable[str]) -> Dict[str, Dimensions]:
+        """
+        Retrieves the stored dimensions of the given images.
+
+        :param image_ids: the image IDs
+        :returns: a dict of image ID -> (width, height), images without stored
+            dimensions are not included
+        """
+        image_ids = list(image_ids)
+        if not self.path:
+            with self._lock:
+                return {
+                    image_id: self._memory[image_id]
+                    for image_id in image_ids
+                    if image_id in self._memory
+                }
+
+        found = {}
+        with closing(self._connect()) as connection:
+            # stay well under SQLite's limit on the number of parameters per statement
+            for start in range(0, len(image_ids), 500):
+                chunk = image_ids[start : start + 500]
+                rows = connection.execute(
+                    'select image_id, width, height from dimensions where image_id in '
+                    f'({",".join("?" * len(chunk))})',
+                    chunk,
+                )
+                for image_id, width, height in rows:
+                    found[image_id] = (width, height)
+        return found
+
+    def set_many(self, dimensions: Dict[str, Dimensions]):
+        """
+        Stores the given image dimensions.
+
+        :param dimensions: a dict of image ID -> (width, height)
+        """
+        if not dimensions:
+            return
+        if not self.path:
+            with self._lock:
+                self._memory.update(dimensions)
+            return
+
+        with closing(self._connect()) as connection, connection:
+            connection.executemany(
+                'insert or replace into dimensions values (?, ?, ?)',
+                [(image_id, w, h) for image_id, (w, h) in dimensions.items()],
+            )
+
+
+class DimensionResolver:
+    """
+    Resolves the real dimensions of images served by a IIIF image service by requesting
+    each image's info.json. Requests are made concurrently and the results are kept in a
+    DimensionStore so that each image is only requested once. Images which can't be
+    resolved in time are left out and will be requested again next time.
+    """
+
+    def __init__(self, store: DimensionStore, timeout: float = 2, workers: int = 8):
+        """
+        :param store: the store to keep resolved dimensions in
+        :param timeout: the maximum number of seconds to spend resolving images
+        :param workers: the maximum number of concurrent requests
+        """
+        self.store = store
+        self.timeout = timeout
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='iiif-dimensions'
+        )
+        # sessions aren't guaranteed to be thread safe so each worker gets its own
+        self._local = threading.local()
+
+    def resolve(self, image_ids: Iterable[str]) -> Dict[str, Dimensions]:
+        """
+        Returns the dimensions of the given images, using the store where possible and
+        requesting the rest.
+
+        :param image_ids: the image IDs
+        :returns: a dict of image ID -> (width, height), images which couldn't be
+            resolved are not included
+        """
+        image_ids = list(dict.fromkeys(image_ids))
+        dimensions = self.store.get_many(image_ids)
+        missing = [image_id for image_id in image_ids if image_id not in dimensions]
+        if missing:
+            fetched = self._fetch_many(missing)
+            self.store.set_many(fetched)
+            dimensions.update(fetched)
+        return dimensions
+
+    def _fetch_many(self, image_ids: Iterable[str]) -> Dict[str, Dimensions]:
+        """
+        Requests the dimensions of the given images concurrently, waiting no longer than
+        the timeout for them all.
+
+        :param image_ids: the image IDs
+        :returns: a dict of image ID -> (width, height) for the images that were
+            resolved
+        """
+        futures = {
+            self._executor.submit(self.fetch, image_id): image_id
+            for image_id in image_ids
+        }
+        done, not_done = wait(futures, timeout=self.timeout)
+        for future in not_done:
+            future.cancel()
+
+        fetched = {}
+        for future in done:
+            dimensions = future.result()
+            if dimensions is not None:
+                fetched[futures[future]] = dimensions
+        return fetched
+
+    def fetch(self, image_id: str) -> Optional[Dimensions]:
+        """
+        Requests the dimensions of the given image from its info.json.
+
+        :param image_id: the image ID (i.e. the image service URL)
+        :returns: the (width, height) or None if they couldn't be retrieved
+        """
+        try:
+            session = getattr(self._local, 'session', None)
+            if session is None:
+                # requests is only needed if dimension resolving is enabled so it isn't
+                # imported until it's used
+                import requests
+
+                session = self._local.session = requests.Session()
+            response = session.get(
+                f'{image_id.rstrip("/")}/info.json', timeout=self.timeout
+            )
+            response.raise_for_status()
+            info = response.json()
+            return int(info['width']), int(info['height'])
+        except Exception as e:
+            log.warning(f'Failed to get dimensions for {image_id}: {e}')
+            return None
+
+
+# the resolver used when building canvases, this is None (i.e. the default dimensions
+# are always used) unless it is enabled in the config and set up when the plugin is
+# configured
+RESOLVER: Optional[DimensionResolver] = None
+
+
+def resolve_dimensions(image_ids: Iterable[str]) -> Dict[str, Dimensions]:
+    """
+    Returns the real dimensions of the given images if dimension resolving is enabled.
+
+    :param image_ids: the image IDs
+    :returns: a dict of image ID -> (width, height), images which couldn't be resolved
+        are not included
+    """
+    if RESOLVER is None:
+        return {}
+    return RESOLVER.resolve(image_ids)
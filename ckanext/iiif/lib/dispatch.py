@@ -0,0 +1,133 @@
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Set, Tuple
+
+from ..builders.abc import IIIFResourceBuilder
+
+# the prefix segment which matches any single path segment of an identifier
+WILDCARD = '*'
+
+
+def get_prefixes(builder: Any) -> Tuple[str, ...]:
+    """
+    Returns the identifier prefixes declared by the given builder. Builders which don't
+    subclass IIIFResourceBuilder can't declare prefixes and therefore will always be
+    probed.
+
+    :param builder: the builder
+    :returns: a tuple of prefixes, empty if the builder doesn't declare any
+    """
+    if isinstance(builder, IIIFResourceBuilder):
+        return tuple(builder.prefixes)
+    return ()
+
+
+def get_resource_id(identifier: str) -> Optional[str]:
+    """
+    Returns the ID of the CKAN resource the given identifier's IIIF resource is built
+    from, if it has the "resource" prefix used by this extension's builders (e.g.
+    "resource/<resource_id>/record/<record_id>").
+
+    :param identifier: the IIIF resource identifier
+    :returns: the resource ID, or None if the identifier doesn't have the prefix
+    """
+    prefix, _, rest = identifier.partition('/')
+    if prefix != 'resource':
+        return None
+    return rest.partition('/')[0] or None
+
+
+class _Node:
+    """
+    A node in the BuilderIndex's tree of prefix segments.
+    """
+
+    __slots__ = ('children', 'positions')
+
+    def __init__(self):
+        # path segment (or the wildcard) -> child node
+        self.children: Dict[str, '_Node'] = {}
+        # the registration positions of the builders whose prefixes end at this node
+        self.positions: Set[int] = set()
+
+
+class BuilderIndex:
+    """
+    An index of the registered builders by the identifier prefixes they declare. This
+    allows the builders that could match an identifier to be found by walking the
+    identifier's path segments through a tree of the prefixes, rather than asking every
+    registered builder in turn.
+
+    A prefix is one or more path segments, where a segment of "*" matches any single
+    segment (e.g. "resource/*/record" matches "resource/1/record/2"). The builders are
+    returned in the same order as they were registered so that the first matching
+    builder still wins. Builders which don't declare any prefixes are included for every
+    identifier.
+    """
+
+    def __init__(self, builders: Mapping[str, Any]):
+        """
+        :param builders: the registered builders
+        """
+        self.builders = builders
+        self.size = len(builders)
+
+        self._ordered = list(builders.values())
+        self._fallback = set()
+        self._root = _Node()
+        for position, builder in enumerate(self._ordered):
+            prefixes = get_prefixes(builder)
+            if not prefixes:
+                self._fallback.add(position)
+            for prefix in prefixes:
+                node = self._root
+                for segment in prefix.split('/'):
+                    node = node.children.setdefault(segment, _Node())
+                node.positions.add(position)
+
+    def is_current(self, builders: Mapping[str, Any]) -> bool:
+        """
+        Checks whether this index was built from the given builders and is therefore
+        still valid to use.
+
+        :param builders: the registered builders
+        :returns: True if the index can be used, False if not
+        """
+        return builders is self.builders and len(builders) == self.size
+
+    def candidates(self, identifier: str) -> List[Any]:
+        """
+        Returns the builders which could match the given identifier, in order.
+
+        :param identifier: the IIIF resource identifier
+        :returns: a list of builders
+        """
+        positions = set(self._fallback)
+        nodes = [self._root]
+        for segment in identifier.split('/'):
+            nodes = [
+                node.children[key]
+                for node in nodes
+                for key in {segment, WILDCARD}
+                if key in node.children
+            ]
+            if not nodes:
+                break
+            for node in nodes:
+                positions.update(node.positions)
+        return [self._ordered[position] for position in sorted(positions)]
+
+
+def iter_candidates(
+    index: Optional[BuilderIndex], builders: Mapping[str, Any], identifier: str
+) -> Iterable[Any]:
+    """
+    Returns the builders which should be asked to match the given identifier. If the
+    index isn't available or is out of date then all the builders are returned.
+
+    :param index: the builder index, or None if one hasn't been built
+    :param builders: the registered builders
+    :param identifier: the IIIF resource identifier
+    :returns: an iterable of builders
+    """
+    if index is not None and index.is_current(builders):
+        return index.candidates(identifier)
+    return builders.values()
@@ -0,0 +1,85 @@
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+log = logging.getLogger(__name__)
+
+
+class LicenceIndex:
+    """
+    A process level index of licence IDs to licence URLs, built from CKAN's licence
+    register. Getting the licence register can mean loading and parsing the licence
+    list so the index is only built once and then rebuilt when it is older than the
+    refresh interval.
+    """
+
+    def __init__(self, refresh_interval: float = 3600):
+        """
+        :param refresh_interval: the number of seconds after which the index is rebuilt,
+            0 means it is never rebuilt
+        """
+        self.refresh_interval = refresh_interval
+        self._urls: Optional[Dict[str, str]] = None
+        self._built = None
+        self._lock = threading.Lock()
+
+    @property
+    def stale(self) -> bool:
+        """
+        :returns: True if the index needs building or rebuilding, False if not
+        """
+        if self._urls is None:
+            return True
+        if self.refresh_interval <= 0:
+            return False
+        return time.monotonic() - self._built >= self.refresh_interval
+
+    def refresh(self):
+        """
+        Rebuilds the index from the licence register. If the register can't be loaded
+        and there is already an index then the existing index is kept until the next
+        refresh.
+        """
+        # the model is slow to import so it's only imported when the index is built
+        from ckan import model
+
+        with self._lock:
+            try:
+                register = model.Package.get_license_register()
+                self._urls = {
+                    licence_id: licence.url for licence_id, licence in register.items()
+                }
+            except Exception:
+                if self._urls is None:
+                    raise
+                log.exception(
+                    'Failed to refresh the licence index, keeping the old one'
+                )
+            self._built = time.monotonic()
+
+    def get_url(self, licence_id: str) -> Optional[str]:
+        """
+        Returns the URL of the given licence.
+
+        :param licence_id: the licence ID
+        :returns: the licence URL or None if the licence is unknown
+        """
+        if self.stale:
+            self.refresh()
+        return self._urls.get(licence_id)
+
+
+# the licence index used when building manifests, this is replaced with one using the
+# configured refresh interval when the plugin is configured
+LICENCES = LicenceIndex()
+
+
+def get_licence_url(licence_id: str) -> Optional[str]:
+    """
+    Returns the URL of the given licence.
+
+    :param licence_id: the licence ID
+    :returns: the licence URL or None if the licence is unknown
+    """
+    return LICENCES.get_url(licence_id)
@@ -0,0 +1,324 @@
+import abc
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+# the default histogram buckets in seconds, these cover everything from a cache hit to
+# building a manifest for a record with thousands of images
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], **extra) -> str:
+    """
+    Formats the given label names and values for the Prometheus text format.
+
+    :param names: the label names
+    :param values: the label values, in the same order as the names
+    :param extra: any extra labels to add
+    :returns: the formatted labels, including the braces, or an empty string if there
+        aren't any labels
+    """
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ''
+    formatted = ','.join(f'{name}="{_escape(str(value))}"' for name, value in pairs)
+    return f'{{{formatted}}}'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(abc.ABC):
+    """
+    Base class for metrics which are made up of one or more labelled samples.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        """
+        :param name: the name of the metric
+        :param documentation: the help text of the metric
+        :param labels: the names of the labels the metric's samples are labelled with
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    @abc.abstractmethod
+    def samples(self) -> Iterator[str]:
+        """
+        Yields the metric's samples in the Prometheus text format.
+
+        :returns: an iterator of sample lines
+        """
+        ...
+
+    def render(self) -> Iterator[str]:
+        """
+        Yields the metric in the Prometheus text format, including the help and type.
+
+        :returns: an iterator of lines
+        """
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.kind}'
+        yield from self.samples()
+
+
+class Histogram(Metric):
+    """
+    A metric which observes the distribution of values, e.g. how long something took.
+    """
+
+    kind = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        """
+        :param name: the name of the metric
+        :param documentation: the help text of the metric
+        :param labels: the names of the labels the metric's samples are labelled with
+        :param buckets: the upper bounds of the buckets, in ascending order
+        """
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [bucket counts..., sum, count]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        """
+        Records the given value with the given labels.
+
+        :param value: the value
+        :param labels: the label values
+        """
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[Dict[str, str]]:
+        """
+        Context manager which records the time taken by the code it wraps. The labels
+        are yielded as a dict so that they can be changed (e.g. to record the outcome)
+        before the time is recorded. If the wrapped code raises an exception and the
+        metric has an outcome label which hasn't been set, the outcome is set to error.
+
+        :param labels: the label values
+        :returns: a dict of the label values
+        """
+        start = time.perf_counter()
+        try:
+            yield labels
+        except BaseException:
+            if 'outcome' in self.labels:
+                labels.setdefault('outcome', 'error')
+            raise
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get_count(self, **labels) -> int:
+        """
+        :param labels: the label values
+        :returns: the number of values observed with the given labels
+        """
+        values = self._values.get(self._key(labels))
+        return int(values[-1]) if values else 0
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = [(key, list(value)) for key, value in self._values.items()]
+        for key, value in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, value):
+                cumulative += count
+                labels = _format_labels(self.labels, key, le=_format_value(bound))
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labels, key, le='+Inf')
+            yield f'{self.name}_bucket{labels} {int(value[-1])}'
+            labels = _format_labels(self.labels, key)
+            yield f'{self.name}_sum{labels} {_format_value(value[-2])}'
+            yield f'{self.name}_count{labels} {int(value[-1])}'
+
+
+class Gauge(Metric):
+    """
+    A metric whose samples are collected from a callback each time it is rendered, e.g.
+    the current size of a cache.
+    """
+
+    kind = 'gauge'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str],
+        collect: Callable[[], Dict[Tuple[str, ...], float]],
+    ):
+        """
+        :param name: the name of the metric
+        :param documentation: the help text of the metric
+        :param labels: the names of the labels the metric's samples are labelled with
+        :param collect: a function returning a dict of label values -> value
+        """
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self.collect().items():
+            labels = _format_labels(self.labels, key)
+            yield f'{self.name}{labels} {_format_value(value)}'
+
+
+class MetricsRegistry:
+    """
+    A collection of metrics which can be rendered together in the Prometheus text
+    format.
+
+    The metrics are held in memory in the process which records them, so when CKAN is
+    run with several worker processes each has its own registry and a scrape only
+    reports the metrics of the worker which answered it.
+    """
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        """
+        Adds the given metric to the registry.
+
+        :param metric: the metric
+        :returns: the metric
+        """
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        :returns: all the metrics in the Prometheus text format
+        """
+        lines = [line for metric in self.metrics for line in metric.render()]
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+DISPATCH = REGISTRY.register(
+    Histogram(
+        'ckanext_iiif_dispatch_seconds',
+        'Time taken to get a IIIF resource by identifier, by the builder that matched '
+        'it and whether it was a cache hit, served prebuilt, a cache miss which was '
+        'built, shared from a concurrent build, an error or not found (404).',
+        ('builder', 'outcome'),
+    )
+)
+BUILDER = REGISTRY.register(
+    Histogram(
+        'ckanext_iiif_builder_seconds',
+        'Time taken by builders to match and build a IIIF resource, by builder and '
+        'whether the resource was built, not matched or errored.',
+        ('builder', 'outcome'),
+    )
+)
+ACTION = REGISTRY.register(
+    Histogram(
+        'ckanext_iiif_action_seconds',
+        'Time taken by the CKAN actions called when building IIIF resources.',
+        ('action', 'outcome'),
+    )
+)
+SEARCH_HOOK = REGISTRY.register(
+    Histogram(
+        'ckanext_iiif_search_hook_seconds',
+        'Time taken to add IIIF resources to a page of search results, by search mode.',
+        ('mode',),
+    )
+)
+
+# name -> function returning the cache, the cache is retrieved each time the metrics
+# are rendered as the caches can be replaced when the plugin is configured
+CACHES: Dict[str, Callable[[], object]] = {}
+
+
+def register_cache(name: str, get_cache: Callable[[], object]):
+    """
+    Registers a cache to report the hits, misses, hit ratio and size of. The cache must
+    have hits, misses and size attributes. A size of None means it isn't reported.
+
+    :param name: the name of the cache, used as the cache label
+    :param get_cache: a function returning the cache
+    """
+    CACHES[name] = get_cache
+
+
+def _collect_caches(stat: Callable[[object], float]) -> Callable[[], dict]:
+    def collect() -> Dict[Tuple[str, ...], float]:
+        values = {(name,): stat(get_cache()) for name, get_cache in CACHES.items()}
+        return {labels: value for labels, value in values.items() if value is not None}
+
+    return collect
+
+
+def _hit_ratio(cache) -> float:
+    lookups = cache.hits + cache.misses
+    return cache.hits / lookups if lookups else 0.0
+
+
+REGISTRY.register(
+    Gauge(
+        'ckanext_iiif_cache_hits',
+        'The number of lookups which were found in the cache.',
+        ('cache',),
+        _collect_caches(lambda cache: cache.hits),
+    )
+)
+REGISTRY.register(
+    Gauge(
+        'ckanext_iiif_cache_misses',
+        "The number of lookups which weren't found in the cache.",
+        ('cache',),
+        _collect_caches(lambda cache: cache.misses),
+    )
+)
+REGISTRY.register(
+    Gauge(
+        'ckanext_iiif_cache_hit_ratio',
+        'The proportion of lookups which were found in the cache.',
+        ('cache',),
+        _collect_caches(_hit_ratio),
+    )
+)
+REGISTRY.register(
+    Gauge(
+        'ckanext_iiif_cache_entries',
+        'The number of entries in the cache.',
+        ('cache',),
+        _collect_caches(lambda cache: cache.size),
+    )
+)
@@ -0,0 +1,298 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from ckan.logic import NotAuthorized, NotFound
+from ckan.plugins import toolkit
+
+from ..builders.manifest import RecordManifestBuilder
+from ..builders.template import get_template
+from ..builders.utils import IIIFBuildError
+from . import dimensions
+from .search import multi_query
+from .store import ManifestStore
+
+# a failure to build a manifest, the identifier and the error message
+Failure = Tuple[str, str]
+
+
+class PrebuildStats:
+    """
+    The progress of prebuilding the manifests of a resource. The built, failed and total
+    counts include any progress made by previous runs which were resumed from.
+    """
+
+    def __init__(self, resource_id: str, checkpoint: Optional[dict] = None):
+        """
+        :param resource_id: the resource ID
+        :param checkpoint: the checkpoint being resumed from, if there is one
+        """
+        self.resource_id = resource_id
+        self.resumed = checkpoint is not None
+        checkpoint = checkpoint or {}
+        self.built = checkpoint.get('built', 0)
+        self.failed = checkpoint.get('failed', 0)
+        self.total = checkpoint.get('total', 0)
+        # whether the previous run finished, in which case nothing is built
+        self.already_complete = bool(checkpoint.get('complete'))
+        # the number of manifests built and seconds spent building in this run
+        self.run_built = 0
+        self.elapsed = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """
+        :returns: the number of manifests built per second in this run
+        """
+        return self.run_built / self.elapsed if self.elapsed else 0.0
+
+
+def action_context() -> dict:
+    """
+    Returns a new context to run the actions used when prebuilding with. Prebuilding is
+    run from the command line where there's no user, so auth is skipped to let the
+    manifests of private resources be prebuilt too. They're only served to users who
+    can see the resource.
+
+    :returns: the context dict
+    """
+    return {'ignore_auth': True}
+
+
+def iter_pages(
+    resource: dict, page_size: int, after: Optional[list] = None
+) -> Iterator[Tuple[List[dict], Optional[list]]]:
+    """
+    Yields pages of the records in the given resource which have a value in the
+    resource's image field. Only one page of records is retrieved at a time.
+
+    :param resource: the resource dict
+    :param page_size: the number of records in each page
+    :param after: the after value to start from, or None to start from the beginning
+    :returns: an iterator of 2-tuples of the page's record data and the after value of
+        the next page (None if this is the last page)
+    :raises IIIFBuildError: if the records can't be searched
+    """
+    query = {'filters': {'and': [{'exists': {'fields': [resource['_image_field']]}}]}}
+    while True:
+        try:
+            result = multi_query(
+                resource['id'], query, page_size, after, context=action_context()
+            )
+        except NotAuthorized:
+            raise IIIFBuildError(
+                f'resource/{resource["id"]}', 'Not authorised to search the resource'
+            )
+        records = [record['data'] for record in result['records']]
+        after = result.get('after') if records else None
+        yield records, after
+        if not after:
+            break
+
+
+def build_chunk(
+    store_root: str, resource: dict, records: List[dict], compress: bool = True
+) -> Tuple[int, List[Failure]]:
+    """
+    Builds the manifest of each of the given records and writes it to the store. This is
+    run in the worker processes so only the counts and failures are returned to the
+    main process, not the manifests themselves.
+
+    :param store_root: the root directory of the store
+    :param resource: the resource dict
+    :param records: the record data
+    :param compress: whether to write compressed copies of the manifests too
+    :returns: a 2-tuple of the number of manifests built and a list of failures
+    """
+    store = ManifestStore(store_root)
+    built = 0
+    failures = []
+    for record in records:
+        identifier = RecordManifestBuilder._build_record_manifest_id(resource, record)
+        try:
+            body = RecordManifestBuilder.build_record_manifest_model(
+                resource, record
+            ).to_json()
+            if compress:
+                store.write_compressed(identifier, body)
+            else:
+                store.write(identifier, body)
+            built += 1
+        except (IIIFBuildError, OSError, ValueError) as e:
+            failures.append((identifier, str(e)))
+    return built, failures
+
+
+def init_worker():
+    """
+    Initialises a worker process. The worker is forked from the main process so it
+    shares its config and plugins, but the dimension resolver's thread pool doesn't
+    survive the fork so a new resolver is created.
+    """
+    resolver = dimensions.RESOLVER
+    if resolver is not None:
+        dimensions.RESOLVER = dimensions.DimensionResolver(
+            resolver.store, timeout=resolver.timeout, workers=resolver.workers
+        )
+
+
+class InlineExecutor:
+    """
+    Runs submitted functions immediately in the current process, used instead of a
+    process pool when only one worker is requested.
+    """
+
+    def submit(self, function: Callable, *args) -> Future:
+        future = Future()
+        try:
+            future.set_result(function(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait: bool = True):
+        pass
+
+
+def prebuild_resource(
+    resource_id: str,
+    store: ManifestStore,
+    workers: int = 1,
+    page_size: int = 1000,
+    chunk_size: int = 100,
+    restart: bool = False,
+    compress: bool = True,
+    on_progress: Optional[Callable[[PrebuildStats], None]] = None,
+    on_failure: Optional[Callable[[Failure], None]] = None,
+) -> PrebuildStats:
+    """
+    Builds the manifest of every record with images in the given resource and writes
+    them to the given store.
+
+    Records are retrieved a page at a time and each page is split into chunks which are
+    built by a pool of worker processes. At most two chunks per worker are queued at
+    once and the workers write the manifests to the store themselves, so the memory used
+    is bounded by the page size no matter how big the resource is. After each page is
+    finished a checkpoint is written to the store so that an interrupted run can resume
+    from the last finished page. Checkpoints are ignored if the resource has been
+    modified since they were written.
+
+    :param resource_id: the resource ID
+    :param store: the store to write the manifests to
+    :param workers: the number of worker processes, 1 builds in this process
+    :param page_size: the number of records to retrieve at once
+    :param chunk_size: the number of records to send to a worker at once
+    :param restart: whether to ignore any existing checkpoint and start from scratch
+    :param compress: whether to write compressed copies of the manifests too
+    :param on_progress: a function called with the stats after each page
+    :param on_failure: a function called with each failure
+    :returns: the final stats
+    :raises IIIFBuildError: if the resource doesn't exist, can't be accessed or can't
+        have manifests
+    """
+    try:
+        resource = toolkit.get_action('resource_show')(
+            action_context(), {'id': resource_id}
+        )
+    except NotFound:
+        raise IIIFBuildError(f'resource/{resource_id}', 'Resource not found')
+    except NotAuthorized:
+        raise IIIFBuildError(
+            f'resource/{resource_id}', 'Not authorised to see the resource'
+        )
+    if not resource.get('_image_field'):
+        raise IIIFBuildError(f'resource/{resource_id}', 'Resource has no image field')
+
+    # compile the template and load the licences now so that they're inherited by the
+    # workers rather than each worker doing it again
+    template = get_template(resource)
+    if template.rights is None:
+        raise IIIFBuildError(
+            f'resource/{resource_id}', f'Unknown licence {template.licence_id}'
+        )
+
+    modified = resource.get('metadata_modified')
+    checkpoint = None if restart else store.read_checkpoint(resource_id)
+    if checkpoint is not None and checkpoint.get('metadata_modified') != modified:
+        checkpoint = None
+    stats = PrebuildStats(resource_id, checkpoint)
+    if stats.already_complete:
+        return stats
+    after = checkpoint['after'] if checkpoint is not None else None
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            # fork so that the workers inherit CKAN's config, plugins and app context
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=init_worker,
+        )
+    else:
+        executor = InlineExecutor()
+
+    start = time.monotonic()
+    try:
+        for records, next_after in iter_pages(resource, page_size, after):
+            pending = set()
+            for offset in range(0, len(records), chunk_size):
+                # don't queue too many chunks at once to keep memory use down
+                while len(pending) >= max(workers, 1) * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    _collect(done, stats, on_failure)
+                chunk = records[offset : offset + chunk_size]
+                pending.add(
+                    executor.submit(build_chunk, store.root, resource, chunk, compress)
+                )
+            _collect(wait(pending).done, stats, on_failure)
+
+            stats.total += len(records)
+            stats.elapsed = time.monotonic() - start
+            store.write_checkpoint(
+                resource_id,
+                {
+                    'metadata_modified': modified,
+                    'after': next_after,
+                    'complete': not next_after,
+                    'built': stats.built,
+                    'failed': stats.failed,
+                    'total': stats.total,
+                },
+            )
+            if on_progress is not None:
+                on_progress(stats)
+    finally:
+        # if we're stopping early this waits for the few queued chunks to finish, which
+        # is fine as the next run resumes from the last checkpoint anyway
+        executor.shutdown(wait=True)
+        stats.elapsed = time.monotonic() - start
+
+    return stats
+
+
+def _collect(
+    futures, stats: PrebuildStats, on_failure: Optional[Callable[[Failure], None]]
+):
+    """
+    Adds the results of the given finished futures to the stats.
+
+    :param futures: the finished futures
+    :param stats: the stats to update
+    :param on_failure: a function called with each failure
+    """
+    for future in futures:
+        built, failures = future.result()
+        stats.built += built
+        stats.run_built += built
+        stats.failed += len(failures)
+        if on_failure is not None:
+            for failure in failures:
+                on_failure(failure)
+
+
+def default_workers() -> int:
+    """
+    :returns: the default number of worker processes, the number of CPUs
+    """
+    return os.cpu_count() or 1
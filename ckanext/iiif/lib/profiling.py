@@ -0,0 +1,152 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Any, Callable, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+# the request arg used to request a profile of a single request
+PROFILE_PARAM = 'iiif_profile'
+
+# the proportion of requests which are profiled, 0 disables sampling, this is set when
+# the plugin is configured
+SAMPLE_RATE = 0.0
+# the directory to write profiles to, if None they are returned inline (when requested)
+# or logged (when sampled), this is set when the plugin is configured
+OUTPUT_DIR: Optional[str] = None
+# the number of functions to include in inline profile stats
+STATS_LIMIT = 50
+
+# only one profile can run at a time as tracemalloc is process wide and Python doesn't
+# allow more than one active profiler in some versions
+_lock = threading.Lock()
+
+
+def sampled() -> bool:
+    """
+    Decides whether the current request should be profiled based on the sample rate.
+    This is just a float comparison when sampling is disabled.
+
+    :returns: True if the request should be profiled, False if not
+    """
+    return SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE
+
+
+def profile(
+    label: str, function: Callable[..., Any], *args, **kwargs
+) -> Tuple[Any, Optional[dict]]:
+    """
+    Calls the given function with the given args and kwargs under cProfile and
+    tracemalloc and returns the result along with a report. The report includes the
+    duration and the peak and net memory allocated during the call. If an output
+    directory is configured then the stats are written to a file in it (along with a
+    JSON copy of the report) and the report includes the file's path, otherwise the
+    report includes the formatted stats of the slowest functions.
+
+    If another profile is already running then the function is called without
+    profiling and the report is None.
+
+    Only the current thread is profiled, so anything the function runs in other threads
+    (e.g. the blocking calls async builders run with run_in_thread) is missing from the
+    stats, though the time spent waiting for it is included in the duration.
+
+    :param label: a label for the profile, e.g. the IIIF resource identifier
+    :param function: the function to call
+    :param args: the args to call the function with
+    :param kwargs: the kwargs to call the function with
+    :returns: a 2-tuple of the function's result and the report
+    """
+    if not _lock.acquire(blocking=False):
+        return function(*args, **kwargs), None
+
+    try:
+        profiler = cProfile.Profile()
+        already_tracing = tracemalloc.is_tracing()
+        if not already_tracing:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        start_memory, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            profiler.disable()
+            duration = time.perf_counter() - start
+            end_memory, peak_memory = tracemalloc.get_traced_memory()
+            if not already_tracing:
+                tracemalloc.stop()
+    finally:
+        _lock.release()
+
+    report = {
+        'label': label,
+        'duration': duration,
+        'peak_memory': peak_memory - start_memory,
+        'net_memory': end_memory - start_memory,
+    }
+    if OUTPUT_DIR:
+        report['file'] = _write(profiler, report)
+    else:
+        report['stats'] = _format_stats(profiler)
+    return result, report
+
+
+def log_report(report: Optional[dict]):
+    """
+    Logs a summary of the given profile report.
+
+    :param report: the report, or None if no profile was made
+    """
+    if report is None:
+        return
+    log.info(
+        f'Profiled {report["label"]}: {report["duration"]:.4f}s, '
+        f'peak memory {report["peak_memory"]} bytes, '
+        f'net memory {report["net_memory"]} bytes'
+        + (f', written to {report["file"]}' if 'file' in report else '')
+    )
+
+
+def _format_stats(profiler: cProfile.Profile) -> str:
+    """
+    Formats the stats of the slowest functions, by cumulative time, in the given
+    profile.
+
+    :param profiler: the profiler
+    :returns: the formatted stats
+    """
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats('cumulative').print_stats(STATS_LIMIT)
+    return stream.getvalue()
+
+
+def _write(profiler: cProfile.Profile, report: dict) -> str:
+    """
+    Writes the stats of the given profile to the output directory, along with a JSON
+    copy of the report. The stats file can be loaded with pstats or a viewer like
+    snakeviz.
+
+    :param profiler: the profiler
+    :param report: the report
+    :returns: the path of the stats file
+    """
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    timestamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+    safe_label = re.sub(r'[^A-Za-z0-9_.-]+', '_', report['label'])[:100]
+    path = os.path.join(OUTPUT_DIR, f'{timestamp}-{safe_label}.prof')
+    profiler.dump_stats(path)
+    with open(f'{path}.json', 'w') as f:
+        json.dump({**report, 'file': path}, f)
+    return path
@@ -0,0 +1,241 @@
+import hashlib
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, Optional, Union
+
+from ..builders.model import IIIFResource
+from .compression import COMPRESSORS
+from .serialisation import dumps, iter_dumps, loads
+
+
+class BuiltResource:
+    """
+    A built IIIF resource along with the details needed to serve it over HTTP. The
+    serialised body, the ETag and any compressed copies of the body are only computed
+    when they are first needed and are then kept so that cached resources are only ever
+    serialised (and compressed) once.
+
+    The resource's modification time, which is sent as its Last-Modified header, is when
+    the data it was built from was last modified if the builder provided it (see
+    IIIFResource.modified) and when it was built if not. This means clients can make
+    conditional requests for resources which are rebuilt for each request.
+
+    When the builder provided the modification time, the ETag is a weak one derived from
+    it rather than from the body, so conditional requests can be answered without
+    serialising the resource.
+    """
+
+    __slots__ = (
+        'resource',
+        'built',
+        'modified',
+        'weak_etag',
+        '_data',
+        '_body',
+        '_etag',
+        '_compressed',
+    )
+
+    def __init__(
+        self,
+        data: Optional[Union[dict, IIIFResource]],
+        built: Optional[datetime] = None,
+        modified: Optional[datetime] = None,
+    ):
+        """
+        :param data: the IIIF resource as a dict or an IIIFResource, or None if the body
+            is going to be set directly (see load)
+        :param built: when the resource was built, defaults to now
+        :param modified: when the data the resource was built from was last modified,
+            defaults to the IIIFResource's modification time if it has one and when the
+            resource was built if not
+        """
+        if isinstance(data, IIIFResource):
+            self.resource = data
+            self._data = None
+            if modified is None:
+                modified = data.modified
+        else:
+            self.resource = None
+            self._data = data
+        if built is None:
+            built = datetime.now(timezone.utc)
+        # HTTP dates only have second precision so drop anything smaller now to avoid
+        # any confusion when comparing to If-Modified-Since headers
+        self.built = built.replace(microsecond=0)
+        self.modified = (
+            self.built if modified is None else modified.replace(microsecond=0)
+        )
+        # the ETag can only be derived from the modification time if the builder
+        # provided it, as the time the resource was built doesn't identify its content
+        self.weak_etag = modified is not None
+        self._body = None
+        self._etag = None
+        # content encoding -> compressed body
+        self._compressed: Dict[str, bytes] = {}
+
+    @property
+    def data(self) -> dict:
+        """
+        The IIIF resource as a dict. If the resource was built as an IIIFResource then
+        its dict view is created each time this is accessed rather than being kept, as
+        it's only needed by the actions and is much larger than the IIIFResource. The
+        same goes for resources loaded from their serialised body, which is parsed each
+        time this is accessed.
+
+        :returns: the IIIF resource as a dict
+        """
+        if self.resource is not None:
+            return self.resource.to_dict()
+        if self._data is None:
+            return loads(self._body)
+        return self._data
+
+    @property
+    def item_count(self) -> int:
+        """
+        :returns: the number of items in the IIIF resource
+        """
+        if self.resource is not None:
+            return self.resource.item_count
+        items = self.data.get('items')
+        return len(items) if isinstance(items, list) else 0
+
+    @property
+    def body(self) -> bytes:
+        """
+        :returns: the IIIF resource serialised as JSON
+        """
+        if self._body is None:
+            if self.resource is not None:
+                self._body = self.resource.to_json()
+            else:
+                self._body = dumps(self._data)
+        return self._body
+
+    @property
+    def serialised(self) -> bool:
+        """
+        :returns: True if the body has already been serialised, False if not
+        """
+        return self._body is not None
+
+    def iter_body(self) -> Iterator[bytes]:
+        """
+        Yields the IIIF resource serialised as JSON in chunks. If the body has already
+        been serialised then it is yielded as is, otherwise the resource's items are
+        serialised in chunks as they are yielded and the body is not kept.
+
+        :returns: an iterator of JSON chunks
+        """
+        if self._body is not None:
+            yield self._body
+        elif self.resource is not None:
+            yield from self.resource.iter_json()
+        else:
+            yield from iter_dumps(self._data)
+
+    @property
+    def etag(self) -> str:
+        """
+        :returns: an ETag for the IIIF resource based on when the data it was built from
+            was last modified if that's known (see weak_etag), otherwise on its
+            serialised content
+        """
+        if self._etag is None:
+            if self.weak_etag:
+                timestamp = str(int(self.modified.timestamp())).encode('ascii')
+                self._etag = hashlib.sha1(timestamp).hexdigest()
+            else:
+                self._etag = hashlib.sha1(self.body).hexdigest()
+        return self._etag
+
+    def get_body(self, encoding: Optional[str] = None) -> bytes:
+        """
+        Returns the IIIF resource serialised as JSON and compressed with the given
+        content encoding.
+
+        :param encoding: one of the content encodings in COMPRESSORS, or None for the
+            uncompressed body
+        :returns: the compressed body
+        """
+        if encoding is None:
+            return self.body
+        compressed = self._compressed.get(encoding)
+        if compressed is None:
+            compressed = self._compressed[encoding] = COMPRESSORS[encoding](self.body)
+        return compressed
+
+    def get_etag(self, encoding: Optional[str] = None) -> str:
+        """
+        Returns the ETag of the IIIF resource compressed with the given content
+        encoding. Each encoding is a different representation of the resource so each
+        gets its own ETag, unless the ETag is weak as the representations are all
+        semantically the same.
+
+        :param encoding: the content encoding, or None for the uncompressed body
+        :returns: the ETag
+        """
+        if encoding is None or self.weak_etag:
+            return self.etag
+        return f'{self.etag}-{encoding}'
+
+    def dump(self, encodings: Iterable[str] = (), min_size: int = 0) -> bytes:
+        """
+        Serialises this built resource to bytes so that it can be shared with other
+        processes (e.g. through Redis). The result is the time the resource was built
+        and the time it was modified as Unix timestamps on the first line, along with
+        the content encoding and length of each compressed copy of the body, followed by
+        the compressed copies and then the body.
+
+        Compressed copies are included so that the processes which load the resource
+        don't have to compress it again. As the resource is usually dumped before it's
+        served, the encodings to compress it with first can be given.
+
+        :param encodings: content encodings in COMPRESSORS to compress the body with
+            before dumping it, if it hasn't been already
+        :param min_size: the size in bytes the body must be to compress it with the
+            given encodings
+        :returns: the serialised built resource
+        """
+        if len(self.body) >= min_size:
+            for encoding in encodings:
+                self.get_body(encoding)
+        fields = [str(int(self.built.timestamp())), str(int(self.modified.timestamp()))]
+        fields.extend(
+            f'{encoding}={len(compressed)}'
+            for encoding, compressed in self._compressed.items()
+        )
+        header = ' '.join(fields).encode('ascii')
+        return b''.join([header, b'\n', *self._compressed.values(), self.body])
+
+    @classmethod
+    def load(cls, payload: bytes) -> 'BuiltResource':
+        """
+        Deserialises a built resource serialised by dump. The body and any compressed
+        copies of it are kept as is so that it doesn't need to be serialised or
+        compressed again and is only parsed if the resource's data is needed, which it
+        isn't to serve the resource.
+
+        :param payload: the serialised built resource
+        :returns: a BuiltResource
+        """
+        header, body = payload.split(b'\n', 1)
+        built_at, modified, *lengths = header.decode('ascii').split()
+        compressed = {}
+        offset = 0
+        for field in lengths:
+            encoding, length = field.split('=')
+            compressed[encoding] = body[offset : offset + int(length)]
+            offset += int(length)
+        built = cls(
+            None,
+            datetime.fromtimestamp(int(built_at), timezone.utc),
+            # the modification time defaults to when the resource was built, in which
+            # case it wasn't provided by the builder
+            None
+            if modified == built_at
+            else datetime.fromtimestamp(int(modified), timezone.utc),
+        )
+        built._body = body[offset:]
+        built._compressed = compressed
+        return built
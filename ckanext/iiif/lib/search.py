@@ -0,0 +1,136 @@
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional
+
+from ckan.logic import NotFound
+from ckan.plugins import toolkit
+from flask import has_request_context, request
+
+# the ways IIIF manifests can be added to versioned datastore search results, "full"
+# includes the whole manifest in each record while "reference" just includes a reference
+# to the manifest along with the number of canvases it has
+SEARCH_MODE_FULL = 'full'
+SEARCH_MODE_REFERENCE = 'reference'
+SEARCH_MODES = (SEARCH_MODE_FULL, SEARCH_MODE_REFERENCE)
+
+# flag set while this extension is querying the versioned datastore itself, this allows
+# the vds_after_multi_query hook to skip adding manifests to results that are only ever
+# used internally
+_internal_query = contextvars.ContextVar('ckanext_iiif_internal_query', default=False)
+
+
+@contextmanager
+def internal_query():
+    """
+    Context manager which marks any versioned datastore queries made within it as
+    internal to this extension.
+    """
+    token = _internal_query.set(True)
+    try:
+        yield
+    finally:
+        _internal_query.reset(token)
+
+
+def is_internal_query() -> bool:
+    """
+    :returns: True if the current versioned datastore query was made by this extension
+    """
+    return _internal_query.get()
+
+
+def get_search_mode() -> str:
+    """
+    Returns the mode to use when adding IIIF manifests to versioned datastore search
+    results. This is set by the ckanext.iiif.search_mode config option but can be
+    overridden per request with the iiif_mode query parameter.
+
+    :returns: one of the SEARCH_MODES
+    """
+    if has_request_context():
+        mode = request.args.get('iiif_mode')
+        if mode in SEARCH_MODES:
+            return mode
+    mode = toolkit.config.get('ckanext.iiif.search_mode', SEARCH_MODE_FULL)
+    return mode if mode in SEARCH_MODES else SEARCH_MODE_FULL
+
+
+def multi_query(
+    resource_id: str,
+    query: dict,
+    size: int,
+    after: Optional[list] = None,
+    context: Optional[dict] = None,
+) -> dict:
+    """
+    Runs the given query against the given resource using the vds_multi_query action.
+
+    :param resource_id: the resource ID
+    :param query: the query dict
+    :param size: the number of records to return
+    :param after: the after value from a previous result, used to get the next page
+    :param context: the context to run the action with, defaults to an empty one
+    :returns: the vds_multi_query result dict
+    """
+    data_dict = {'resource_ids': [resource_id], 'query': query, 'size': size}
+    if after is not None:
+        data_dict['after'] = after
+    with internal_query():
+        return toolkit.get_action('vds_multi_query')(context or {}, data_dict)
+
+
+def get_records(
+    resource_id: str, record_ids: Iterable[str], chunk_size: int = 100
+) -> Dict[str, dict]:
+    """
+    Retrieves the data of the given records from the given resource. Where possible this
+    is done in bulk with a search, otherwise each record is retrieved individually.
+    Records that can't be found are not included in the returned dict.
+
+    :param resource_id: the resource ID
+    :param record_ids: the record IDs
+    :param chunk_size: the maximum number of records to search for at once
+    :returns: a dict of record ID -> record data
+    """
+    record_ids = list(dict.fromkeys(map(str, record_ids)))
+    if not all(record_id.isdigit() for record_id in record_ids):
+        return _get_records_individually(resource_id, record_ids)
+
+    records = {}
+    for start in range(0, len(record_ids), chunk_size):
+        chunk = record_ids[start : start + chunk_size]
+        query = {
+            'filters': {
+                'or': [
+                    {'number_equals': {'fields': ['_id'], 'value': int(record_id)}}
+                    for record_id in chunk
+                ]
+            }
+        }
+        result = multi_query(resource_id, query, len(chunk))
+        for record in result['records']:
+            records[str(record['data']['_id'])] = record['data']
+    return records
+
+
+def _get_records_individually(
+    resource_id: str, record_ids: List[str]
+) -> Dict[str, dict]:
+    """
+    Retrieves each of the given records from the given resource one by one.
+
+    :param resource_id: the resource ID
+    :param record_ids: the record IDs
+    :returns: a dict of record ID -> record data
+    """
+    vds_data_get = toolkit.get_action('vds_data_get')
+    records = {}
+    for record_id in record_ids:
+        try:
+            result = vds_data_get(
+                {}, {'resource_id': resource_id, 'record_id': record_id}
+            )
+        except NotFound:
+            continue
+        records[record_id] = result['data']
+    return records
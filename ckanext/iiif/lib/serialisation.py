@@ -0,0 +1,72 @@
+import json
+from typing import Any, Iterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# the number of array elements to serialise into each chunk when streaming
+STREAM_CHUNK_SIZE = 50
+
+
+def dumps(value: Any) -> bytes:
+    """
+    Serialises the given value as compact JSON. If orjson is installed it is used as it
+    is much faster than the standard library, otherwise (or if orjson can't serialise
+    the value) the json module is used.
+
+    :param value: the value to serialise
+    :returns: the JSON as UTF-8 bytes
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            pass
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def loads(body: bytes) -> Any:
+    """
+    Deserialises the given JSON, using orjson if it is installed.
+
+    :param body: the JSON as UTF-8 bytes
+    :returns: the deserialised value
+    """
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def iter_dumps(
+    data: dict, stream_key: str = 'items', chunk_size: int = STREAM_CHUNK_SIZE
+) -> Iterator[bytes]:
+    """
+    Serialises the given dict as compact JSON, yielding it in chunks. The value under
+    the stream key is serialised a few elements at a time rather than all at once, which
+    means that the whole serialised dict is never held in memory and the first chunk can
+    be sent before the rest is serialised. Joining the chunks together produces the same
+    bytes as calling dumps on the dict.
+
+    :param data: the dict to serialise
+    :param stream_key: the key of the list value to stream
+    :param chunk_size: the number of list elements to serialise in each chunk
+    :returns: an iterator of JSON chunks as UTF-8 bytes
+    """
+    buffer = [b'{']
+    for index, (key, value) in enumerate(data.items()):
+        entry = (b',' if index else b'') + dumps(key) + b':'
+        if key == stream_key and isinstance(value, list):
+            # flush everything before the list and then stream the list's elements
+            buffer.append(entry + b'[')
+            yield b''.join(buffer)
+            buffer = []
+            for start in range(0, len(value), chunk_size):
+                chunk = b','.join(map(dumps, value[start : start + chunk_size]))
+                yield b',' + chunk if start else chunk
+            buffer.append(b']')
+        else:
+            buffer.append(entry + dumps(value))
+    buffer.append(b'}')
+    yield b''.join(buffer)
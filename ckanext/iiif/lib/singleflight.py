@@ -0,0 +1,224 @@
+import logging
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+# where the result of a coalesced call came from: the caller called the function itself,
+# another thread in this process called it, or another process called it
+CALLED = 'called'
+THREAD = 'thread'
+PROCESS = 'process'
+
+# releases the lock only if it's still held by us, so that a lock which expired and was
+# then taken by another worker isn't released by mistake
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+else
+    return 0
+end
+"""
+
+
+class _Call:
+    """
+    An in-flight call which other callers of the same key wait on.
+    """
+
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class SharedFlight:
+    """
+    Coalesces calls with the same key across processes (e.g. web workers) using a lock
+    in Redis. The process which gets the lock calls the function and publishes its
+    result in Redis for a short time, while the other processes poll for the result
+    rather than calling the function themselves. If the result doesn't appear within the
+    timeout (or the function returns None, which isn't published), the waiting processes
+    give up and call the function themselves, as they do if Redis can't be reached.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], Any],
+        dump: Callable[[Any], bytes],
+        load: Callable[[bytes], Any],
+        timeout: float = 10,
+        lock_timeout: float = 30,
+        poll_interval: float = 0.05,
+        prefix: str = 'ckanext-iiif:flight:',
+    ):
+        """
+        :param connect: a function returning a Redis client
+        :param dump: a function serialising a result to bytes
+        :param load: a function deserialising a result from bytes
+        :param timeout: the maximum number of seconds to wait for another process's
+            result
+        :param lock_timeout: the number of seconds after which the lock expires, in case
+            the process holding it dies
+        :param poll_interval: the number of seconds to wait between checks for another
+            process's result
+        :param prefix: the prefix of the Redis keys used
+        """
+        self.connect = connect
+        self.dump = dump
+        self.load = load
+        self.timeout = timeout
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.prefix = prefix
+        self._redis = None
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = self.connect()
+        return self._redis
+
+    def do(self, key: str, function: Callable[[], Any]) -> Tuple[Any, str]:
+        """
+        Calls the given function, unless another process is already calling it for the
+        same key in which case its result is used.
+
+        :param key: the key identifying the call
+        :param function: the function to call
+        :returns: a 2-tuple of the result and where it came from, CALLED or PROCESS
+        """
+        lock_key = f'{self.prefix}lock:{key}'
+        result_key = f'{self.prefix}result:{key}'
+        deadline = time.monotonic() + self.timeout
+        token = uuid.uuid4().hex
+        waited = False
+        while True:
+            try:
+                # once we've waited for another process, check for its result before
+                # trying the lock again as it's released as soon as the result is
+                # published
+                payload = self.redis.get(result_key) if waited else None
+                locked = payload is None and self.redis.set(
+                    lock_key, token, nx=True, px=int(self.lock_timeout * 1000)
+                )
+            except Exception:
+                log.warning('Failed to coalesce %s through Redis', key, exc_info=True)
+                return function(), CALLED
+            if payload is not None:
+                return self.load(payload), PROCESS
+            if locked:
+                return self._lead(lock_key, result_key, token, function), CALLED
+            if time.monotonic() >= deadline:
+                return function(), CALLED
+            time.sleep(self.poll_interval)
+            waited = True
+
+    def _lead(
+        self, lock_key: str, result_key: str, token: str, function: Callable[[], Any]
+    ) -> Any:
+        """
+        Calls the function while holding the lock and publishes the result.
+
+        :param lock_key: the lock's key
+        :param result_key: the key to publish the result under
+        :param token: the value identifying our hold on the lock
+        :param function: the function to call
+        :returns: the function's result
+        """
+        try:
+            # clear out the result of any previous call so that waiters only get the
+            # result of this one
+            self._safely(self.redis.delete, result_key)
+            result = function()
+            if result is not None:
+                self._safely(
+                    self.redis.set,
+                    result_key,
+                    self.dump(result),
+                    px=int(self.timeout * 1000),
+                )
+            return result
+        finally:
+            self._safely(self.redis.eval, RELEASE_SCRIPT, 1, lock_key, token)
+
+    @staticmethod
+    def _safely(function: Callable, *args, **kwargs):
+        """
+        Calls the given Redis function, logging rather than raising any errors as
+        failing to coalesce shouldn't fail the call itself.
+        """
+        try:
+            function(*args, **kwargs)
+        except Exception:
+            log.warning('Redis call failed while coalescing', exc_info=True)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key so that the function is only called
+    once and every caller gets its result. This works across the threads in a process
+    and, if a SharedFlight is given, across processes too. If the call doesn't finish
+    within the timeout, the waiting callers give up and call the function themselves.
+    """
+
+    def __init__(self, shared: Optional[SharedFlight] = None, timeout: float = 10):
+        """
+        :param shared: a SharedFlight to coalesce calls across processes with, or None
+            to only coalesce calls within this process
+        :param timeout: the maximum number of seconds to wait for another caller's call
+        """
+        self.shared = shared
+        self.timeout = timeout
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, function: Callable[[], Any]) -> Tuple[Any, str]:
+        """
+        Calls the given function, unless it's already being called for the same key in
+        which case this waits for that call to finish and returns its result (or raises
+        its error). If that call doesn't finish within the timeout, the function is
+        called anyway.
+
+        :param key: the key identifying the call
+        :param function: the function to call
+        :returns: a 2-tuple of the result and where it came from, one of CALLED, THREAD
+            or PROCESS
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if call.event.wait(self.timeout):
+                if call.error is not None:
+                    raise call.error
+                return call.result, THREAD
+            log.warning('Timed out waiting for %s, calling it anyway', key)
+            return function(), CALLED
+
+        try:
+            if self.shared is not None:
+                call.result, origin = self.shared.do(key, function)
+            else:
+                call.result, origin = function(), CALLED
+            return call.result, origin
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def __len__(self) -> int:
+        """
+        :returns: the number of calls in flight
+        """
+        return len(self._calls)
@@ -0,0 +1,189 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from contextlib import suppress
+from typing import Iterable, Optional, Tuple
+
+from .compression import COMPRESSORS, SUFFIXES
+
+# the name of the file in each resource's directory which records the progress of
+# prebuilding the resource's manifests
+CHECKPOINT_NAME = '.prebuild.json'
+
+
+class ManifestStore:
+    """
+    Stores prebuilt IIIF resources on disk as JSON files. Each identifier is mapped to a
+    path under the store's root directory by treating each part of the identifier as a
+    directory, e.g. resource/abc/record/1 is stored in
+    <root>/resource/abc/record/1.json. Files are written atomically so readers never see
+    a partially written resource. Compressed copies of each file can be stored alongside
+    it (e.g. 1.json.gz) so that they can be served without compressing them on every
+    request.
+    """
+
+    def __init__(self, root: str):
+        """
+        :param root: the directory to store the IIIF resources in
+        """
+        self.root = os.path.abspath(root)
+
+    def get_path(self, identifier: str, suffix: str = '.json') -> str:
+        """
+        Returns the path the given identifier is stored at.
+
+        :param identifier: the IIIF resource identifier
+        :param suffix: the suffix to add to the path
+        :returns: the path
+        :raises ValueError: if the identifier can't be safely mapped to a path
+        """
+        parts = identifier.split('/')
+        if any(part in ('', '.', '..') or part.startswith('.') for part in parts):
+            raise ValueError(f'Invalid identifier {identifier}')
+        return os.path.join(self.root, *parts) + suffix
+
+    def get_resource_dir(self, resource_id: str) -> str:
+        """
+        Returns the directory the IIIF resources built from the given CKAN resource are
+        stored in.
+
+        :param resource_id: the CKAN resource ID
+        :returns: the path of the directory
+        """
+        return os.path.dirname(self.get_path(f'resource/{resource_id}/_', ''))
+
+    def write(self, identifier: str, body: bytes, suffix: str = '.json'):
+        """
+        Writes the given serialised IIIF resource to the store, replacing any existing
+        version.
+
+        :param identifier: the IIIF resource identifier
+        :param body: the serialised IIIF resource
+        :param suffix: the suffix of the file to write
+        """
+        write_atomic(self.get_path(identifier, suffix), body)
+
+    def write_compressed(self, identifier: str, body: bytes):
+        """
+        Writes the given serialised IIIF resource to the store along with a copy
+        compressed with each of the available COMPRESSORS.
+
+        :param identifier: the IIIF resource identifier
+        :param body: the serialised IIIF resource
+        """
+        self.write(identifier, body)
+        for encoding, compress in COMPRESSORS.items():
+            self.write(identifier, compress(body), f'.json{SUFFIXES[encoding]}')
+
+    def find(
+        self, identifier: str, encodings: Iterable[str] = ()
+    ) -> Optional[Tuple[str, Optional[str]]]:
+        """
+        Finds the file to serve for the given identifier. The first of the given
+        encodings with a compressed copy in the store is used, otherwise the
+        uncompressed file is used.
+
+        :param identifier: the IIIF resource identifier
+        :param encodings: the content encodings the client accepts, in order of
+            preference
+        :returns: a 2-tuple of the path and the content encoding of the file (None if
+            it isn't compressed), or None if the identifier isn't in the store
+        """
+        try:
+            path = self.get_path(identifier)
+        except ValueError:
+            return None
+        for encoding in encodings:
+            suffix = SUFFIXES.get(encoding)
+            if suffix is not None and os.path.isfile(f'{path}{suffix}'):
+                return f'{path}{suffix}', encoding
+        if os.path.isfile(path):
+            return path, None
+        return None
+
+    def invalidate(self, resource_id: str) -> bool:
+        """
+        Removes all the IIIF resources built from the given CKAN resource. The
+        resource's directory is renamed out of the way immediately (so nothing in it
+        can be found) and then deleted in a background thread as there could be a lot
+        of files in it.
+
+        :param resource_id: the CKAN resource ID
+        :returns: True if there was anything to remove, False if not
+        """
+        stale = os.path.join(self.root, f'.stale-{uuid.uuid4().hex}')
+        try:
+            os.rename(self.get_resource_dir(resource_id), stale)
+        except (OSError, ValueError):
+            return False
+        threading.Thread(
+            target=shutil.rmtree, args=(stale,), kwargs={'ignore_errors': True}
+        ).start()
+        return True
+
+    def exists(self, identifier: str) -> bool:
+        """
+        :param identifier: the IIIF resource identifier
+        :returns: True if the IIIF resource is in the store, False if not
+        """
+        try:
+            return os.path.isfile(self.get_path(identifier))
+        except ValueError:
+            return False
+
+    def read_checkpoint(self, resource_id: str) -> Optional[dict]:
+        """
+        Reads the prebuild checkpoint of the given CKAN resource.
+
+        :param resource_id: the CKAN resource ID
+        :returns: the checkpoint dict or None if there isn't one (or it's unreadable)
+        """
+        path = os.path.join(self.get_resource_dir(resource_id), CHECKPOINT_NAME)
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_checkpoint(self, resource_id: str, checkpoint: dict):
+        """
+        Writes the prebuild checkpoint of the given CKAN resource.
+
+        :param resource_id: the CKAN resource ID
+        :param checkpoint: the checkpoint dict
+        """
+        path = os.path.join(self.get_resource_dir(resource_id), CHECKPOINT_NAME)
+        write_atomic(path, json.dumps(checkpoint).encode('utf-8'))
+
+
+def write_atomic(path: str, body: bytes):
+    """
+    Writes the given bytes to the given path by writing them to a temporary file in the
+    same directory and then renaming it, creating the directory if necessary.
+
+    :param path: the path to write to
+    :param body: the bytes to write
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(body)
+        # mkstemp only makes the file readable by us but the store is likely to be
+        # served by other processes
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        with suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+
+# the store prebuilt IIIF resources are served from, this is None (i.e. everything is
+# built dynamically) unless a store directory is configured and set up when the plugin
+# is configured
+STORE: Optional[ManifestStore] = None
@@ -1,24 +1,68 @@
 import logging
 from collections import OrderedDict
-from typing import Optional
+from functools import partial
+from typing import Dict, List, Optional, Union
 from typing import OrderedDict as OrderedDictType
 
 from ckan.plugins import toolkit
 from ckantools.decorators import action
 
 from ..builders.abc import IIIFResourceBuilder
-from ..builders.manifest import RecordManifestBuilder
+from ..builders.lazy import LazyBuilder
 from ..builders.utils import IIIFBuildError
+from ..lib import metrics, profiling
+from ..lib.cache import CacheBackend, ManifestCache
+from ..lib.dispatch import BuilderIndex, get_resource_id, iter_candidates
+from ..lib.resources import BuiltResource
+from ..lib.singleflight import CALLED, PROCESS, SingleFlight
+from .auth import can_access
 
 log = logging.getLogger(__name__)
 
 BUILDERS: OrderedDictType[str, IIIFResourceBuilder] = OrderedDict()
 
-# register the basic record manifest builder by default
-BUILDERS[RecordManifestBuilder.BUILDER_ID] = RecordManifestBuilder()
+# register the basic record manifest and resource collection builders by default, along
+# with the canvas builder which builds the canvases, annotation pages and annotations in
+# record manifests. These are loaded lazily so that the builder modules are only
+# imported when an identifier is first dispatched to them
+BUILDERS['canvas'] = LazyBuilder(
+    'canvas',
+    'ckanext.iiif.builders.canvas:RecordCanvasBuilder',
+    ('resource/*/record/*/canvas',),
+)
+BUILDERS['record'] = LazyBuilder(
+    'record',
+    'ckanext.iiif.builders.manifest:RecordManifestBuilder',
+    ('resource/*/record',),
+)
+BUILDERS['collection'] = LazyBuilder(
+    'collection',
+    'ckanext.iiif.builders.collection:ResourceCollectionBuilder',
+    ('resource/*/collection',),
+)
+
+# cache of built IIIF resources, this is disabled by default and replaced with a
+# configured cache, using the configured backend, when the plugin is configured
+CACHE: CacheBackend = ManifestCache()
+
+metrics.register_cache('resources', lambda: CACHE)
+
+# coalesces concurrent builds of the same identifier so that only one of them actually
+# builds the resource and the others share its result. This is replaced when the plugin
+# is configured and set to None if coalescing is disabled
+FLIGHTS: Optional[SingleFlight] = SingleFlight()
+
+# index of the BUILDERS by identifier prefix, this is built when the plugin is
+# configured and until then (or if the BUILDERS are changed after it is built) every
+# builder is asked to match each identifier
+INDEX: Optional[BuilderIndex] = None
 
 build_iiif_resource_schema = {
     'identifier': [toolkit.get_validator('not_empty'), str],
+    'profile': [
+        toolkit.get_validator('ignore_missing'),
+        toolkit.get_validator('boolean_validator'),
+    ],
 }
 build_iiif_resource_help = """
 Given an identifier, builds the corresponding IIIF resource (e.g. manifest) and returns
@@ -26,32 +70,267 @@ it as a dict (or JSON if calling action via HTTP).
 
 Params:
 - identifier: the IIIF resource identifier as a string
+- profile: (optional, sysadmins only) if true, the resource is built under the profiler
+           (skipping the cache) and a dict of {"result": <the IIIF resource>,
+           "profile": <the profile report>} is returned instead
 
 Returns: a dict or None if no builder could be found to build the identifier
 """
 
 
 @action(build_iiif_resource_schema, build_iiif_resource_help, toolkit.side_effect_free)
-def build_iiif_resource(identifier: str) -> Optional[dict]:
+def build_iiif_resource(
+    identifier: str, profile: bool = False, context: Optional[dict] = None
+) -> Optional[dict]:
     """
     Given a IIIF resource identifier, build the resource from the first matching builder
     in the BUILDERS list and then return the result. If no builder can be matched then
     None is returned.
 
     :param identifier: the IIIF resource identifier
+    :param profile: whether to profile the build and return the report with the result
+    :param context: the action context
     :returns: a dict or None
     """
-    for builder in BUILDERS.values():
+    if profile:
+        toolkit.check_access(
+            'profile_iiif_resource', context or {}, {'identifier': identifier}
+        )
+        built, report = profiling.profile(
+            identifier, get_iiif_resource, identifier, use_cache=False
+        )
+        profiling.log_report(report)
+        return {
+            'result': built.data if built is not None else None,
+            'profile': report,
+        }
+
+    if profiling.sampled():
+        built, report = profiling.profile(identifier, get_iiif_resource, identifier)
+        profiling.log_report(report)
+    else:
+        built = get_iiif_resource(identifier)
+    return built.data if built is not None else None
+
+
+def get_iiif_resource(
+    identifier: str, use_cache: bool = True
+) -> Optional[BuiltResource]:
+    """
+    Given a IIIF resource identifier, build the resource from the first matching builder
+    in the BUILDERS list (using the INDEX to skip builders which can't match the
+    identifier's prefix) and return it wrapped in a BuiltResource. If no builder can be
+    matched then None is returned. Successfully built resources are stored in the CACHE
+    and returned from there on subsequent calls until they expire or are invalidated.
+    Concurrent calls for the same identifier which miss the cache are coalesced using
+    FLIGHTS so that the resource is only built once.
+
+    This isn't an action and therefore doesn't do any auth checks, it's the shared
+    implementation of the build_iiif_resource action and the iiif blueprint. As cached
+    resources are returned without being built, callers must check the user can access
+    the identifier first (see the build_iiif_resource auth function).
+
+    :param identifier: the IIIF resource identifier
+    :param use_cache: whether to look for the resource in the CACHE (or join an
+        in-flight build of it) before building it, the built resource is always cached
+    :returns: a BuiltResource or None
+    """
+    with metrics.DISPATCH.time() as labels:
+        if not use_cache:
+            return build_resource(identifier, labels)
+
+        cached = CACHE.get(identifier)
+        if cached is not None:
+            labels['outcome'] = 'hit'
+            return cached
+
+        if FLIGHTS is None:
+            return build_resource(identifier, labels)
+
+        built, origin = FLIGHTS.do(
+            identifier, partial(build_resource, identifier, labels)
+        )
+        if origin != CALLED:
+            labels['builder'] = ''
+            labels['outcome'] = 'shared'
+            # results built by another thread in this process have already been cached
+            # by it, but results built by another process have only been cached there
+            if origin == PROCESS and built is not None:
+                CACHE.set(identifier, built)
+        return built
+
+
+def build_resource(identifier: str, labels: dict) -> Optional[BuiltResource]:
+    """
+    Builds the resource from the first matching builder in the BUILDERS list and stores
+    it in the CACHE. The builder and outcome are recorded in the given dispatch metric
+    labels.
+
+    :param identifier: the IIIF resource identifier
+    :param labels: the dispatch metric labels
+    :returns: a BuiltResource or None
+    """
+    for builder in iter_candidates(INDEX, BUILDERS, identifier):
+        builder_id = get_builder_id(builder)
+        labels['builder'] = builder_id
         try:
-            result = builder.match_and_build(identifier)
+            with metrics.BUILDER.time(builder=builder_id) as builder_labels:
+                result = builder.match_and_build(identifier)
+                builder_labels['outcome'] = 'no_match' if result is None else 'built'
             if result is not None:
-                return result
+                built = BuiltResource(result)
+                CACHE.set(identifier, built)
+                labels['outcome'] = 'miss'
+                return built
         except IIIFBuildError as e:
             log.error(str(e), exc_info=e)
-            break
+            labels['outcome'] = 'error'
+            return None
+
+    labels['builder'] = ''
+    labels['outcome'] = '404'
     return None
 
 
+def get_builder_id(builder: IIIFResourceBuilder) -> str:
+    """
+    Returns the ID of the given builder for use in metrics. This is the builder's
+    BUILDER_ID if it has one, otherwise its class name.
+
+    :param builder: the builder
+    :returns: the builder's ID
+    """
+    builder_id = getattr(builder, 'BUILDER_ID', None)
+    return builder_id if isinstance(builder_id, str) else type(builder).__name__
+
+
+build_iiif_resources_schema = {
+    'identifiers': [
+        toolkit.get_validator('not_empty'),
+        toolkit.get_validator('list_of_strings'),
+    ],
+}
+build_iiif_resources_help = """
+Given a list of identifiers, builds the corresponding IIIF resources (e.g. manifests)
+and returns them in a dict keyed by identifier. Where possible, the work needed to build
+the resources is shared between them (e.g. each CKAN resource is only retrieved once).
+
+The maximum number of identifiers that can be requested at once is set by the
+ckanext.iiif.batch.max_size config option (default 500).
+
+Params:
+- identifiers: a list of IIIF resource identifiers
+
+Returns: a dict of identifier -> result where each result is either {"result": <the IIIF
+         resource>} or {"error": <an error message>}
+"""
+
+
+@action(
+    build_iiif_resources_schema, build_iiif_resources_help, toolkit.side_effect_free
+)
+def build_iiif_resources(
+    identifiers: List[str], context: Optional[dict] = None
+) -> Dict[str, dict]:
+    """
+    Given a list of IIIF resource identifiers, build each resource and return them all
+    in a dict keyed by identifier. IIIF resources built from CKAN resources the user
+    can't see get an error rather than being built.
+
+    :param identifiers: the IIIF resource identifiers
+    :param context: the action context
+    :returns: a dict of identifier -> {"result": resource} or {"error": message}
+    """
+    max_size = toolkit.asint(toolkit.config.get('ckanext.iiif.batch.max_size', 500))
+    if len(identifiers) > max_size:
+        raise toolkit.ValidationError(
+            {'identifiers': [f'A maximum of {max_size} identifiers can be requested']}
+        )
+
+    results = {}
+    allowed = []
+    # resource ID -> whether the user can see it, batches usually contain lots of
+    # identifiers from the same resource and each one only needs checking once
+    access = {}
+    for identifier in identifiers:
+        resource_id = get_resource_id(identifier)
+        if resource_id not in access:
+            access[resource_id] = can_access(context or {}, identifier)
+        if access[resource_id]:
+            allowed.append(identifier)
+        else:
+            results[identifier] = {'error': 'Not authorised to see this IIIF resource'}
+
+    for identifier, built in get_iiif_resources(allowed).items():
+        if isinstance(built, BuiltResource):
+            results[identifier] = {'result': built.data}
+        elif isinstance(built, IIIFBuildError):
+            results[identifier] = {'error': str(built)}
+        else:
+            results[identifier] = {'error': 'Unknown IIIF identifier'}
+    # return the results in the order the identifiers were given
+    return {identifier: results[identifier] for identifier in identifiers}
+
+
+def get_iiif_resources(
+    identifiers: List[str],
+) -> Dict[str, Union[BuiltResource, IIIFBuildError, None]]:
+    """
+    Given a list of IIIF resource identifiers, build each resource from the first
+    matching builder in the BUILDERS list, just like get_iiif_resource. Rather than
+    asking the builders to match each identifier one by one, each builder is asked to
+    match and build all the identifiers which are still unmatched at once so that it can
+    share work between them.
+
+    Like get_iiif_resource, this doesn't do any auth checks so callers must check the
+    user can access each identifier first.
+
+    :param identifiers: the IIIF resource identifiers
+    :returns: a dict of identifier -> BuiltResource, the IIIFBuildError raised when
+        building it, or None if no builder matched the identifier
+    """
+    results = {}
+    # identifier -> the builders that could still match it, in order
+    pending = {}
+    for identifier in identifiers:
+        if identifier in results or identifier in pending:
+            continue
+        cached = CACHE.get(identifier)
+        if cached is not None:
+            results[identifier] = cached
+        else:
+            pending[identifier] = list(iter_candidates(INDEX, BUILDERS, identifier))
+
+    while pending:
+        # group the pending identifiers by the next builder they need to be offered to
+        groups = OrderedDict()
+        for identifier, candidates in list(pending.items()):
+            if not candidates:
+                results[identifier] = None
+                del pending[identifier]
+                continue
+            builder = candidates.pop(0)
+            groups.setdefault(id(builder), (builder, []))[1].append(identifier)
+
+        for builder, group in groups.values():
+            if isinstance(builder, IIIFResourceBuilder):
+                built = builder.match_and_build_many(group)
+            else:
+                built = IIIFResourceBuilder.match_and_build_many(builder, group)
+
+            for identifier, result in built.items():
+                del pending[identifier]
+                if isinstance(result, IIIFBuildError):
+                    log.error(str(result), exc_info=result)
+                    results[identifier] = result
+                else:
+                    results[identifier] = BuiltResource(result)
+                    CACHE.set(identifier, results[identifier])
+
+    # return the results in the order the identifiers were given
+    return {identifier: results[identifier] for identifier in identifiers}
+
+
 build_iiif_identifier_schema = {
     'builder_id': [toolkit.get_validator('not_empty'), str],
 }
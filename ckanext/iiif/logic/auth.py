@@ -1,15 +1,52 @@
+from ckan.plugins import toolkit
 from ckantools.decorators import auth
 
+from ..lib.dispatch import get_resource_id
+
+
+def can_access(context: dict, identifier: str) -> bool:
+    """
+    Checks whether the user in the given context can see the CKAN resource the given
+    IIIF resource is built from, if it's built from one. This can't be left to the
+    builders as IIIF resources are served from the cache and the store without being
+    built.
+
+    :param context: the action context
+    :param identifier: the IIIF resource identifier
+    :returns: False if the user can't see the CKAN resource, otherwise True (including
+        if the CKAN resource doesn't exist, which is then reported by the builder)
+    """
+    resource_id = get_resource_id(identifier)
+    if resource_id is None:
+        return True
+    # the auth functions keep the objects they load in the context, so give them a copy
+    # to avoid one check reusing another's resource
+    context = {
+        key: value
+        for key, value in context.items()
+        if key not in ('resource', 'package')
+    }
+    try:
+        toolkit.check_access('resource_show', context, {'id': resource_id})
+    except toolkit.NotAuthorized:
+        return False
+    except toolkit.ObjectNotFound:
+        pass
+    return True
+
 
 @auth(anon=True)
 def build_iiif_resource(context, data_dict):
     """
-    Auth for building a IIIF resource, always allowed.
+    Auth for building a IIIF resource, allowed if the user can see the CKAN resource the
+    IIIF resource is built from (if it's built from one).
 
     :param context:
     :param data_dict:
     """
-    return {'success': True}
+    if can_access(context, (data_dict or {}).get('identifier', '')):
+        return {'success': True}
+    return {'success': False, 'msg': 'Not authorised to see this IIIF resource'}
 
 
 @auth(anon=True)
@@ -21,3 +58,39 @@ def build_iiif_identifier(context, data_dict):
     :param data_dict:
     """
     return {'success': True}
+
+
+@auth(anon=True)
+def build_iiif_resources(context, data_dict):
+    """
+    Auth for building several IIIF resources at once, always allowed. The user's access
+    to each IIIF resource is checked by the action.
+
+    :param context:
+    :param data_dict:
+    """
+    return {'success': True}
+
+
+@auth()
+def view_iiif_metrics(context, data_dict):
+    """
+    Auth for viewing the IIIF metrics, only sysadmins are allowed (and they skip auth
+    checks so this always fails).
+
+    :param context:
+    :param data_dict:
+    """
+    return {'success': False}
+
+
+@auth()
+def profile_iiif_resource(context, data_dict):
+    """
+    Auth for profiling the building of a IIIF resource, only sysadmins are allowed (and
+    they skip auth checks so this always fails).
+
+    :param context:
+    :param data_dict:
+    """
+    return {'success': False}
@@ -1,13 +1,26 @@
 import logging
 from contextlib import suppress
+from functools import partial
 
 import ckan.plugins as plugins
 from ckan.plugins import toolkit
-from ckantools.loaders import create_actions, create_auth
 
-from . import interfaces, routes
-from .builders.manifest import RecordManifestBuilder
-from .logic import actions, auth
+from . import interfaces
+from .lib import dimensions, licences, metrics, profiling, store
+from .lib.cache import (
+    CacheBackend,
+    ManifestCache,
+    RedisCache,
+    SQLiteCache,
+    connect_to_redis_url,
+    resource_prefix,
+)
+from .lib.dispatch import BuilderIndex
+from .lib.singleflight import SharedFlight, SingleFlight
+
+# the actions, builders, blueprints and commands (and the heavier modules they need) are
+# imported in the hooks that use them rather than here so that importing the plugin is
+# cheap, see the import budget test in tests/unit/test_import.py
 
 log = logging.getLogger(__name__)
 
@@ -16,7 +29,9 @@ class IIIFPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IActions)
     plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.IBlueprint)
+    plugins.implements(plugins.IClick)
     plugins.implements(plugins.IConfigurable)
+    plugins.implements(plugins.IResourceController, inherit=True)
 
     try:
         # hook if we can
@@ -30,44 +45,234 @@ class IIIFPlugin(plugins.SingletonPlugin):
         """
         IActions hook.
         """
+        from ckantools.loaders import create_actions
+
+        from .logic import actions
+
         return create_actions(actions)
 
     def get_auth_functions(self):
         """
         IAuthFunctions hook.
         """
+        from ckantools.loaders import create_auth
+
+        from .logic import auth
+
         return create_auth(auth)
 
     def configure(self, ckan_config):
         """
         IConfigurable hook. Here, the builders from other plugins are added to the
-        BUILDERS list.
+        BUILDERS list, the BUILDERS are indexed, and the manifest cache, build
+        coalescing, licence index, profiling and image dimension resolver are set up.
 
         :param ckan_config:
         """
+        from .logic import actions
+
+        actions.CACHE = create_cache(ckan_config)
+        if toolkit.asbool(ckan_config.get('ckanext.iiif.coalesce.enabled', True)):
+            timeout = float(ckan_config.get('ckanext.iiif.coalesce.timeout', 10))
+            shared = None
+            if toolkit.asbool(ckan_config.get('ckanext.iiif.coalesce.shared', False)):
+                from ckan.lib.redis import connect_to_redis
+
+                from .lib.resources import BuiltResource
+
+                shared = SharedFlight(
+                    connect_to_redis,
+                    BuiltResource.dump,
+                    BuiltResource.load,
+                    timeout=timeout,
+                    lock_timeout=float(
+                        ckan_config.get('ckanext.iiif.coalesce.lock_timeout', 30)
+                    ),
+                )
+            actions.FLIGHTS = SingleFlight(shared, timeout=timeout)
+        else:
+            actions.FLIGHTS = None
+        # this is recreated so that the licences are reloaded along with the config
+        licences.LICENCES = licences.LicenceIndex(
+            refresh_interval=toolkit.asint(
+                ckan_config.get('ckanext.iiif.licences.refresh_interval', 3600)
+            )
+        )
+        profiling.SAMPLE_RATE = float(
+            ckan_config.get('ckanext.iiif.profiling.sample_rate', 0)
+        )
+        profiling.OUTPUT_DIR = ckan_config.get('ckanext.iiif.profiling.dir') or None
+        store_dir = ckan_config.get('ckanext.iiif.store.dir')
+        store.STORE = store.ManifestStore(store_dir) if store_dir else None
+        if toolkit.asbool(ckan_config.get('ckanext.iiif.dimensions.enabled', False)):
+            dimensions.RESOLVER = dimensions.DimensionResolver(
+                dimensions.DimensionStore(
+                    ckan_config.get('ckanext.iiif.dimensions.store') or None
+                ),
+                timeout=float(ckan_config.get('ckanext.iiif.dimensions.timeout', 2)),
+                workers=toolkit.asint(
+                    ckan_config.get('ckanext.iiif.dimensions.workers', 8)
+                ),
+            )
+        else:
+            dimensions.RESOLVER = None
         for plugin in plugins.PluginImplementations(interfaces.IIIIF):
             plugin.register_iiif_builders(actions.BUILDERS)
+        actions.INDEX = BuilderIndex(actions.BUILDERS)
 
     def get_blueprint(self):
         """
         IBlueprint hook.
         """
+        from . import routes
+
         return routes.blueprints
 
+    def get_commands(self):
+        """
+        IClick hook.
+        """
+        from . import cli
+
+        return cli.get_commands()
+
+    def after_resource_update(self, context, resource):
+        """
+        IResourceController hook. Removes any cached or prebuilt IIIF resources and
+        manifest templates built from the updated resource.
+        """
+        invalidate_resource(resource['id'])
+
+    def before_resource_delete(self, context, resource, resources):
+        """
+        IResourceController hook. Removes any cached or prebuilt IIIF resources and
+        manifest templates built from the resource that is about to be deleted.
+        """
+        invalidate_resource(resource['id'])
+
+    # CKAN 2.9 names for the above IResourceController hooks
+    after_update = after_resource_update
+    before_delete = before_resource_delete
+
     def vds_after_multi_query(self, response, result):
         """
         IVersionedDatastore hook.
 
-        Only used if ckanext-versioned-datastore is installed.
+        Only used if ckanext-versioned-datastore is installed. Queries made by this
+        extension itself are skipped as they don't need manifests adding. Depending on
+        the search mode, either the full manifest or just a reference to it is added to
+        each record.
         """
-        resource_cache = {}
-        resource_show = toolkit.get_action('resource_show')
+        from .builders.manifest import RecordManifestBuilder
+        from .lib.search import (
+            SEARCH_MODE_REFERENCE,
+            get_search_mode,
+            is_internal_query,
+        )
 
-        for record in result['records']:
-            resource_id = record['resource']
-            if resource_id not in resource_cache:
-                resource_cache[resource_id] = resource_show({}, {'id': resource_id})
-            with suppress(Exception):
-                record['iiif'] = RecordManifestBuilder.build_record_manifest(
-                    resource_cache[resource_id], record['data']
-                )
+        if is_internal_query():
+            return
+
+        mode = get_search_mode()
+        with metrics.SEARCH_HOOK.time(mode=mode):
+            if mode == SEARCH_MODE_REFERENCE:
+                build = RecordManifestBuilder.build_record_manifest_reference
+            else:
+                build = RecordManifestBuilder.build_record_manifest
+
+            resource_cache = {}
+            resource_show = toolkit.get_action('resource_show')
+            for record in result['records']:
+                resource_id = record['resource']
+                if resource_id not in resource_cache:
+                    resource_cache[resource_id] = resource_show({}, {'id': resource_id})
+
+            if dimensions.RESOLVER is not None and mode != SEARCH_MODE_REFERENCE:
+                # resolve the dimensions of all the images on this page of results at
+                # once, this means they are all fetched concurrently rather than record
+                # by record
+                images = []
+                for record in result['records']:
+                    with suppress(Exception):
+                        images.extend(
+                            RecordManifestBuilder._get_images(
+                                resource_cache[record['resource']], record['data']
+                            )
+                        )
+                dimensions.RESOLVER.resolve(images)
+
+            for record in result['records']:
+                resource_id = record['resource']
+                with suppress(Exception):
+                    record['iiif'] = build(resource_cache[resource_id], record['data'])
+
+
+def create_cache(ckan_config) -> CacheBackend:
+    """
+    Creates the cache of built IIIF resources using the backend set in the config. The
+    memory backend is local to each process, while the sqlite and redis backends are
+    shared between the processes on a server and all servers respectively.
+
+    :param ckan_config: the CKAN config
+    :returns: the cache
+    :raises ValueError: if the backend is unknown or its required options are missing
+    """
+    backend = ckan_config.get('ckanext.iiif.cache.backend', 'memory')
+    size = toolkit.asint(ckan_config.get('ckanext.iiif.cache.size', 0))
+    ttl = toolkit.asint(ckan_config.get('ckanext.iiif.cache.ttl', 300))
+
+    if backend == 'memory':
+        return ManifestCache(max_size=size, ttl=ttl)
+
+    from .lib.compression import COMPRESSORS
+    from .lib.resources import BuiltResource
+
+    # the shared backends store the compressed copies of each resource's body too, so
+    # the processes serving it from the cache don't all have to compress it themselves
+    dump = BuiltResource.dump
+    if toolkit.asbool(ckan_config.get('ckanext.iiif.compression.enabled', True)):
+        dump = partial(
+            BuiltResource.dump,
+            encodings=tuple(COMPRESSORS),
+            min_size=toolkit.asint(
+                ckan_config.get('ckanext.iiif.compression.min_size', 1024)
+            ),
+        )
+
+    if backend == 'sqlite':
+        path = ckan_config.get('ckanext.iiif.cache.path')
+        if not path:
+            raise ValueError(
+                'ckanext.iiif.cache.path must be set to use the sqlite cache backend'
+            )
+        return SQLiteCache(path, dump, BuiltResource.load, max_size=size, ttl=ttl)
+
+    if backend == 'redis':
+        url = ckan_config.get('ckanext.iiif.cache.redis_url')
+        if url:
+            connect = partial(connect_to_redis_url, url)
+        else:
+            from ckan.lib.redis import connect_to_redis
+
+            connect = connect_to_redis
+        return RedisCache(connect, dump, BuiltResource.load, ttl=ttl)
+
+    raise ValueError(f'Unknown cache backend: {backend}')
+
+
+def invalidate_resource(resource_id: str):
+    """
+    Removes any cached or prebuilt IIIF resources and manifest templates built from the
+    given resource. The memory cache and the manifest templates are per process, so
+    they are only cleared in the process this is called in.
+
+    :param resource_id: the resource ID
+    """
+    from .builders import template
+    from .logic import actions
+
+    prefix = resource_prefix(resource_id)
+    actions.CACHE.invalidate(prefix)
+    template.TEMPLATES.invalidate(prefix)
+    if store.STORE is not None:
+        store.STORE.invalidate(resource_id)
@@ -1,13 +1,279 @@
+import time
+from datetime import timezone
+from typing import Iterable, List, Optional
+
 from ckan.plugins import toolkit
-from flask import Blueprint, jsonify
+from flask import (
+    Blueprint,
+    Response,
+    jsonify,
+    request,
+    send_file,
+    stream_with_context,
+)
+
+from ..lib import metrics, profiling, store
+from ..lib.compression import COMPRESSORS, SUFFIXES, iter_gzip
+from ..lib.resources import BuiltResource
+from ..lib.serialisation import dumps
+from ..logic import actions
 
 blueprint = Blueprint(name='iiif', import_name=__name__, url_prefix='/iiif')
 
 
 @blueprint.route('/<path:identifier>')
 def resource(identifier):
-    result = toolkit.get_action('build_iiif_resource')({}, {'identifier': identifier})
-    if result:
-        return jsonify(result)
+    # this checks the user can see the CKAN resource the IIIF resource is built from
+    # before it's served from the store or the cache
+    try:
+        toolkit.check_access('build_iiif_resource', {}, {'identifier': identifier})
+    except toolkit.NotAuthorized:
+        return toolkit.abort(
+            status_code=403, detail='Not authorised to see this IIIF resource'
+        )
+    if profiling.PROFILE_PARAM in request.args:
+        return profile_resource(identifier)
+    prebuilt = send_prebuilt(identifier)
+    if prebuilt is not None:
+        return prebuilt
+    if profiling.sampled():
+        built, report = profiling.profile(
+            identifier, actions.get_iiif_resource, identifier
+        )
+        profiling.log_report(report)
     else:
+        built = actions.get_iiif_resource(identifier)
+    if built is None:
         return toolkit.abort(status_code=404, detail='Unknown IIIF identifier')
+
+    # weak ETags don't depend on the body or the encoding, so the conditional headers
+    # can be checked before the resource is serialised to choose the encoding
+    if built.weak_etag and is_not_modified(built):
+        response = Response(status=304)
+        set_encoding(response, None)
+        set_validators(response, built)
+        return response
+
+    if should_stream(built):
+        # strong ETags are derived from the whole body so we can't provide one when
+        # streaming, but the Last-Modified header can still be used by clients
+        body = built.iter_body()
+        encoding = choose_stream_encoding()
+        if encoding == 'gzip':
+            body = iter_gzip(body)
+        response = Response(stream_with_context(body), mimetype='application/json')
+        set_encoding(response, encoding)
+        if built.weak_etag:
+            set_validators(response, built)
+        else:
+            response.last_modified = built.modified
+        return response
+
+    encoding = choose_encoding(built)
+    if not built.weak_etag and is_not_modified(built, encoding):
+        response = Response(status=304)
+    else:
+        response = Response(built.get_body(encoding), mimetype='application/json')
+    set_encoding(response, encoding)
+    set_validators(response, built, encoding)
+    return response
+
+
+def compression_enabled() -> bool:
+    """
+    :returns: True if responses should be compressed for clients which accept it
+    """
+    return toolkit.asbool(toolkit.config.get('ckanext.iiif.compression.enabled', True))
+
+
+def choose_encoding(built: BuiltResource) -> Optional[str]:
+    """
+    Chooses the content encoding to compress the given built IIIF resource with based
+    on the current request's Accept-Encoding header. Resources smaller than the
+    configured minimum size aren't compressed as it isn't worth it.
+
+    :param built: the built IIIF resource
+    :returns: one of the content encodings in COMPRESSORS, or None to not compress
+    """
+    if not compression_enabled():
+        return None
+    accepted = get_accepted_encodings(COMPRESSORS)
+    if not accepted:
+        return None
+    min_size = toolkit.asint(
+        toolkit.config.get('ckanext.iiif.compression.min_size', 1024)
+    )
+    if len(built.body) < min_size:
+        return None
+    return accepted[0]
+
+
+def choose_stream_encoding() -> Optional[str]:
+    """
+    Chooses the content encoding to compress a streamed response with. Only gzip is
+    supported when streaming.
+
+    :returns: gzip or None to not compress
+    """
+    if compression_enabled() and get_accepted_encodings(['gzip']):
+        return 'gzip'
+    return None
+
+
+def set_encoding(response: Response, encoding: Optional[str]):
+    """
+    Sets the headers on the given response for the given content encoding. The response
+    varies by Accept-Encoding whether it's compressed or not.
+
+    :param response: the response
+    :param encoding: the content encoding or None if the response isn't compressed
+    """
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+
+
+def set_validators(
+    response: Response, built: BuiltResource, encoding: Optional[str] = None
+):
+    """
+    Sets the ETag and Last-Modified headers on the given response for the given built
+    IIIF resource.
+
+    :param response: the response
+    :param built: the built IIIF resource
+    :param encoding: the content encoding the resource is sent with
+    """
+    response.set_etag(built.get_etag(encoding), weak=built.weak_etag)
+    response.last_modified = built.modified
+
+
+def send_prebuilt(identifier: str) -> Optional[Response]:
+    """
+    Sends the prebuilt copy of the given IIIF resource from the store, if there is a
+    store and the resource is in it. A compressed copy is sent if the client accepts it
+    and there is one. The file is sent with send_file so conditional requests are
+    handled and the server can send the file directly if it supports it.
+
+    :param identifier: the IIIF resource identifier
+    :returns: the response, or None if there isn't a prebuilt copy of the resource
+    """
+    if store.STORE is None:
+        return None
+    start = time.perf_counter()
+    found = store.STORE.find(identifier, get_accepted_encodings(SUFFIXES))
+    if found is None:
+        return None
+    path, encoding = found
+    response = send_file(path, mimetype='application/json', conditional=True)
+    # the file name isn't meaningful to clients (and is wrong for compressed copies)
+    response.headers.pop('Content-Disposition', None)
+    set_encoding(response, encoding)
+    metrics.DISPATCH.observe(
+        time.perf_counter() - start, builder='', outcome='prebuilt'
+    )
+    return response
+
+
+def get_accepted_encodings(encodings: Iterable[str]) -> List[str]:
+    """
+    Returns the given content encodings which the client accepts according to the
+    current request's Accept-Encoding header, ordered by the client's preference (ties
+    keep the order they were given in).
+
+    :param encodings: the content encodings available
+    :returns: the accepted content encodings, best first
+    """
+    accepted = request.accept_encodings
+    qualities = {encoding: accepted.quality(encoding) for encoding in encodings}
+    return sorted(
+        (encoding for encoding, quality in qualities.items() if quality > 0),
+        key=lambda encoding: -qualities[encoding],
+    )
+
+
+def profile_resource(identifier: str) -> Response:
+    """
+    Builds the given IIIF resource under the profiler, skipping the cache, and responds
+    with the profile report instead of the resource. Only sysadmins can do this.
+
+    :param identifier: the IIIF resource identifier
+    :returns: a JSON response containing the profile report
+    """
+    try:
+        toolkit.check_access('profile_iiif_resource', {}, {'identifier': identifier})
+    except toolkit.NotAuthorized:
+        return toolkit.abort(status_code=403, detail='Not authorised to profile')
+    built, report = profiling.profile(
+        identifier, actions.get_iiif_resource, identifier, use_cache=False
+    )
+    if report is None:
+        return toolkit.abort(status_code=503, detail='A profile is already running')
+    profiling.log_report(report)
+    return jsonify({'found': built is not None, 'profile': report})
+
+
+@blueprint.route('/batch', methods=['POST'])
+def batch():
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'The request body must be a JSON object'}), 400
+    identifiers = data.get('identifiers', request.form.getlist('identifiers'))
+    try:
+        results = toolkit.get_action('build_iiif_resources')(
+            {}, {'identifiers': identifiers}
+        )
+    except toolkit.ValidationError as e:
+        return jsonify({'error': e.error_dict}), 400
+    return Response(dumps(results), mimetype='application/json')
+
+
+@blueprint.route('/_metrics')
+def metrics_view():
+    try:
+        toolkit.check_access('view_iiif_metrics', {})
+    except toolkit.NotAuthorized:
+        return toolkit.abort(status_code=403, detail='Not authorised to view metrics')
+    return Response(
+        metrics.REGISTRY.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
+
+
+def is_not_modified(built: BuiltResource, encoding: Optional[str] = None) -> bool:
+    """
+    Checks the conditional headers on the current request against the given built IIIF
+    resource to see whether the client already has an up-to-date copy of it. When the
+    resource is cached or its ETag is weak this check can be done without serialising
+    it.
+
+    :param built: the built IIIF resource
+    :param encoding: the content encoding the resource would be sent with
+    :returns: True if a 304 should be returned, False if not
+    """
+    # If-None-Match takes precedence over If-Modified-Since when both are sent
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(built.get_etag(encoding))
+    if request.if_modified_since:
+        if_modified_since = request.if_modified_since
+        # older versions of werkzeug return naive datetimes (which are in UTC)
+        if if_modified_since.tzinfo is None:
+            if_modified_since = if_modified_since.replace(tzinfo=timezone.utc)
+        return built.modified <= if_modified_since
+    return False
+
+
+def should_stream(built: BuiltResource) -> bool:
+    """
+    Checks whether the given built IIIF resource should be streamed to the client
+    rather than serialised in full before being sent. This is only worth doing for
+    resources with lots of items which haven't already been serialised and won't be
+    cached (as cached resources keep their serialised body for subsequent requests).
+
+    :param built: the built IIIF resource
+    :returns: True if the resource should be streamed, False if not
+    """
+    threshold = toolkit.asint(toolkit.config.get('ckanext.iiif.stream_threshold', 1000))
+    if not threshold or built.serialised or actions.CACHE.enabled:
+        return False
+    return built.item_count > threshold
@@ -0,0 +1,179 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+from ckan.plugins import toolkit
+
+from ckanext.iiif.builders.manifest import RecordManifestBuilder
+from ckanext.iiif.lib.cache import ManifestCache
+from ckanext.iiif.lib.serialisation import dumps
+
+IMAGE_COUNTS = [1, 10, 100, 1000]
+FIELD_COUNTS = [10, 100, 500]
+
+RESOURCE_ID = 'c5e8f1a2-3b4d-4e6f-8a9b-0c1d2e3f4a5b'
+
+
+def make_resource(**extras) -> dict:
+    """
+    Creates a synthetic resource dict with the extras the record manifest builder uses.
+
+    :param extras: any extras to add or override
+    :returns: a resource dict
+    """
+    resource = {
+        'id': RESOURCE_ID,
+        'name': 'Benchmark resource',
+        '_image_field': 'associatedMedia',
+        '_title_field': 'scientificName',
+        '_image_licence': 'cc-by',
+    }
+    resource.update(extras)
+    return resource
+
+
+def make_record(images: int, fields: int, image_format: str = 'dicts') -> dict:
+    """
+    Creates a synthetic record with the given number of images and fields. The fields
+    are a mix of the types of values found in real records.
+
+    :param images: the number of images
+    :param fields: the number of fields, not including the _id and image field
+    :param image_format: how the images are represented, one of dicts, strs or delimited
+    :returns: a record dict
+    """
+    urls = [
+        f'https://iiif.example.com/images/{i:06d}.jpg/info.json' for i in range(images)
+    ]
+    if image_format == 'dicts':
+        media = [
+            {'identifier': url, 'title': f'Image {i}'} for i, url in enumerate(urls)
+        ]
+    elif image_format == 'strs':
+        media = urls
+    else:
+        media = ';'.join(urls)
+
+    record = {'_id': 429, 'associatedMedia': media, 'scientificName': 'Bufo bufo'}
+    for i in range(fields):
+        kind = i % 4
+        if kind == 0:
+            value = f'value {i}'
+        elif kind == 1:
+            value = i * 7
+        elif kind == 2:
+            value = [f'item {j}' for j in range(3)]
+        else:
+            value = {'nested': i, 'label': f'nested {i}'}
+        record[f'field{i}'] = value
+    return record
+
+
+@pytest.fixture
+def stubbed_actions():
+    """
+    Stubs the CKAN actions the record manifest builder calls so that the benchmarks run
+    without a database or the versioned datastore.
+    """
+    resource = make_resource()
+    data = {}
+    original_get_action = toolkit.get_action
+
+    stubs = {
+        'resource_show': MagicMock(return_value=resource),
+        'vds_data_get': MagicMock(return_value={'data': data}),
+    }
+
+    def get_action(name):
+        return stubs[name] if name in stubs else original_get_action(name)
+
+    with patch('ckanext.iiif.builders.manifest.toolkit.get_action', get_action):
+        yield data
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'iiif')
+@pytest.mark.usefixtures('with_plugins', 'with_request_context')
+class TestManifestBenchmarks:
+    @pytest.mark.benchmark(group='build_record_manifest')
+    @pytest.mark.parametrize('fields', FIELD_COUNTS)
+    @pytest.mark.parametrize('images', IMAGE_COUNTS)
+    def test_build_record_manifest(self, benchmark, images, fields):
+        resource = make_resource()
+        record = make_record(images, fields)
+
+        manifest = benchmark(
+            RecordManifestBuilder.build_record_manifest, resource, record
+        )
+
+        assert len(manifest['items']) == images
+
+    @pytest.mark.benchmark(group='serialise_record_manifest')
+    @pytest.mark.parametrize('via', ['model', 'dict'])
+    @pytest.mark.parametrize('images', IMAGE_COUNTS)
+    def test_serialise_record_manifest(self, benchmark, images, via):
+        # building and serialising the manifest through the intermediate model versus
+        # through the dict view
+        resource = make_resource()
+        record = make_record(images, 10)
+
+        def run():
+            if via == 'model':
+                return RecordManifestBuilder.build_record_manifest_model(
+                    resource, record
+                ).to_json()
+            return dumps(RecordManifestBuilder.build_record_manifest(resource, record))
+
+        body = benchmark(run)
+
+        assert body
+
+    @pytest.mark.benchmark(group='_build_metadata')
+    @pytest.mark.parametrize('fields', FIELD_COUNTS)
+    def test_build_metadata(self, benchmark, fields):
+        record = make_record(1, fields)
+
+        metadata = benchmark(RecordManifestBuilder._build_metadata, record)
+
+        assert metadata
+
+    @pytest.mark.benchmark(group='_build_canvas')
+    @pytest.mark.parametrize('images', IMAGE_COUNTS)
+    def test_build_canvas(self, benchmark, images):
+        manifest_id = f'resource/{RESOURCE_ID}/record/429'
+        image_ids = RecordManifestBuilder._get_images(
+            make_resource(), make_record(images, 0)
+        )
+
+        def run():
+            return [
+                RecordManifestBuilder._build_canvas(manifest_id, i, image_id)
+                for i, image_id in enumerate(image_ids)
+            ]
+
+        canvases = benchmark(run)
+
+        assert len(canvases) == images
+
+    @pytest.mark.benchmark(group='_get_images')
+    @pytest.mark.parametrize('image_format', ['dicts', 'strs', 'delimited'])
+    @pytest.mark.parametrize('images', IMAGE_COUNTS)
+    def test_get_images(self, benchmark, images, image_format):
+        resource = make_resource(_image_delimiter=';')
+        record = make_record(images, 0, image_format)
+
+        image_ids = benchmark(RecordManifestBuilder._get_images, resource, record)
+
+        assert len(image_ids) == images
+
+    @pytest.mark.benchmark(group='build_iiif_resource')
+    @pytest.mark.parametrize('fields', FIELD_COUNTS)
+    @pytest.mark.parametrize('images', IMAGE_COUNTS)
+    def test_build_iiif_resource(self, benchmark, stubbed_actions, images, fields):
+        stubbed_actions.update(make_record(images, fields))
+        action = toolkit.get_action('build_iiif_resource')
+        data_dict = {'identifier': f'resource/{RESOURCE_ID}/record/429'}
+
+        # make sure the cache is disabled so that every round builds the manifest
+        with patch('ckanext.iiif.logic.actions.CACHE', ManifestCache()):
+            manifest = benchmark(action, {}, data_dict)
+
+        assert len(manifest['items']) == images
@@ -0,0 +1,39 @@
+import pytest
+from ckan.plugins import toolkit
+
+from ckanext.iiif.builders.utils import create_id_url
+
+# the number of canvas URLs created per round, roughly a record with lots of images
+CANVASES = 500
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'iiif')
+@pytest.mark.usefixtures('with_plugins', 'with_request_context')
+@pytest.mark.benchmark(group='create_id_url')
+class TestCreateIDURLBenchmark:
+    """
+    Compares creating canvas URLs with url_for directly against create_id_url's
+    templating.
+    """
+
+    def test_url_for(self, benchmark):
+        def run():
+            return [
+                toolkit.url_for(
+                    'iiif.resource',
+                    identifier=f'resource/1/record/2/canvas/{i}',
+                    _external=True,
+                )
+                for i in range(CANVASES)
+            ]
+
+        benchmark(run)
+
+    def test_create_id_url(self, benchmark):
+        def run():
+            return [
+                create_id_url(f'resource/1/record/2/canvas/{i}')
+                for i in range(CANVASES)
+            ]
+
+        benchmark(run)
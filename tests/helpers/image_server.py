@@ -0,0 +1,63 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+
+
+class StubImageServer:
+    """
+    A minimal local IIIF image server which only serves info.json responses, used to
+    test image dimension resolution without making any external requests.
+
+    Images are added to the images dict as path -> (width, height), requests for any
+    other path receive a 404. Paths in the slow set are delayed by the delay attribute
+    before responding.
+    """
+
+    def __init__(self):
+        self.images: Dict[str, Tuple[int, int]] = {}
+        self.slow = set()
+        self.delay = 1.0
+        self.requests = []
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests.append(self.path)
+                path = self.path[: -len('/info.json')]
+                if path in server.slow:
+                    time.sleep(server.delay)
+                if not self.path.endswith('/info.json') or path not in server.images:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                width, height = server.images[path]
+                body = json.dumps(
+                    {'id': f'{server.url}{path}', 'width': width, 'height': height}
+                ).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self._httpd.server_port}'
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    def image_id(self, path: str) -> str:
+        return f'{self.url}{path}'
+
+    def __enter__(self) -> 'StubImageServer':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,225 @@
+import re
+import socketserver
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+def pattern_to_regex(pattern: bytes) -> re.Pattern:
+    """
+    Converts a Redis glob style pattern into a regex.
+    """
+    regex = b''
+    index = 0
+    while index < len(pattern):
+        char = pattern[index : index + 1]
+        if char == b'\\' and index + 1 < len(pattern):
+            index += 1
+            regex += re.escape(pattern[index : index + 1])
+        elif char == b'*':
+            regex += b'.*'
+        elif char == b'?':
+            regex += b'.'
+        elif char == b'[':
+            end = pattern.index(b']', index)
+            regex += b'[' + pattern[index + 1 : end] + b']'
+            index = end
+        else:
+            regex += re.escape(char)
+        index += 1
+    return re.compile(regex + b'\\Z', re.DOTALL)
+
+
+class StubRedisServer:
+    """
+    A minimal local server speaking the Redis protocol, used to test the Redis cache
+    backend with a real Redis client without needing a Redis server.
+
+    Only the commands used by this extension (and the client when it connects) are
+    supported: HELLO, PING, CLIENT, SELECT, GET, SET (with EX, PX, NX and XX), DEL,
+    EXISTS, PTTL, SCAN (with MATCH and COUNT), DBSIZE and FLUSHDB. The data is held in
+    the data dict and each command received is added to the commands list.
+    """
+
+    def __init__(self):
+        self.data: Dict[bytes, bytes] = {}
+        self.expiries: Dict[bytes, float] = {}
+        self.commands: List[List[bytes]] = []
+        # scan cursor -> the last key returned by the scan
+        self.cursors: Dict[int, bytes] = {}
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                resp3 = False
+                while True:
+                    command = self.read_command()
+                    if command is None:
+                        return
+                    server.commands.append(command)
+                    if command[0].upper() == b'HELLO':
+                        resp3 = command[1:2] == [b'3']
+                    reply = server.execute(command)
+                    if resp3 and reply == b'$-1\r\n':
+                        # null is the only reply that differs in the RESP3 protocol
+                        reply = b'_\r\n'
+                    self.wfile.write(reply)
+
+            def read_command(self) -> Optional[List[bytes]]:
+                line = self.rfile.readline()
+                if not line:
+                    return None
+                if not line.startswith(b'*'):
+                    # an inline command
+                    return line.split()
+                args = []
+                for _ in range(int(line[1:])):
+                    length = int(self.rfile.readline()[1:])
+                    args.append(self.rfile.read(length + 2)[:-2])
+                return args
+
+        self._server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self.url = f'redis://127.0.0.1:{self._server.server_address[1]}/0'
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, args=(0.05,), daemon=True
+        )
+
+    def __enter__(self) -> 'StubRedisServer':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _expire(self, key: bytes):
+        expiry = self.expiries.get(key)
+        if expiry is not None and expiry <= time.monotonic():
+            self.data.pop(key, None)
+            self.expiries.pop(key, None)
+
+    def _keys(self) -> List[bytes]:
+        for key in list(self.data):
+            self._expire(key)
+        return sorted(self.data)
+
+    def execute(self, command: List[bytes]) -> bytes:
+        name = command[0].upper().decode()
+        handler = getattr(self, f'_{name.lower()}', None)
+        if handler is None:
+            return f"-ERR unknown command '{name}'\r\n".encode()
+        with self.lock:
+            return handler(*command[1:])
+
+    @staticmethod
+    def _integer(value: int) -> bytes:
+        return f':{value}\r\n'.encode()
+
+    @staticmethod
+    def _bulk(value: Optional[bytes]) -> bytes:
+        if value is None:
+            return b'$-1\r\n'
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+
+    def _array(self, values: List[bytes]) -> bytes:
+        return b'*%d\r\n' % len(values) + b''.join(self._bulk(v) for v in values)
+
+    def _ping(self, *args) -> bytes:
+        return b'+PONG\r\n'
+
+    def _hello(self, protocol: bytes = b'2', *args) -> bytes:
+        details = [
+            (b'server', self._bulk(b'redis')),
+            (b'version', self._bulk(b'7.0.0')),
+            (b'proto', self._integer(int(protocol))),
+        ]
+        if protocol == b'3':
+            start = b'%%%d\r\n' % len(details)
+        else:
+            start = b'*%d\r\n' % (len(details) * 2)
+        return start + b''.join(self._bulk(key) + value for key, value in details)
+
+    def _client(self, *args) -> bytes:
+        return b'+OK\r\n'
+
+    def _select(self, *args) -> bytes:
+        return b'+OK\r\n'
+
+    def _get(self, key: bytes) -> bytes:
+        self._expire(key)
+        return self._bulk(self.data.get(key))
+
+    def _set(self, key: bytes, value: bytes, *options: bytes) -> bytes:
+        self._expire(key)
+        options = [option.upper() for option in options]
+        if b'NX' in options and key in self.data:
+            return self._bulk(None)
+        if b'XX' in options and key not in self.data:
+            return self._bulk(None)
+        self.data[key] = value
+        self.expiries.pop(key, None)
+        for unit, scale in ((b'EX', 1), (b'PX', 1000)):
+            if unit in options:
+                amount = int(options[options.index(unit) + 1])
+                self.expiries[key] = time.monotonic() + amount / scale
+        return b'+OK\r\n'
+
+    def _del(self, *keys: bytes) -> bytes:
+        deleted = 0
+        for key in keys:
+            self._expire(key)
+            if self.data.pop(key, None) is not None:
+                deleted += 1
+            self.expiries.pop(key, None)
+        return self._integer(deleted)
+
+    def _exists(self, *keys: bytes) -> bytes:
+        for key in keys:
+            self._expire(key)
+        return self._integer(sum(key in self.data for key in keys))
+
+    def _pttl(self, key: bytes) -> bytes:
+        self._expire(key)
+        if key not in self.data:
+            return self._integer(-2)
+        expiry = self.expiries.get(key)
+        if expiry is None:
+            return self._integer(-1)
+        return self._integer(int((expiry - time.monotonic()) * 1000))
+
+    def _scan(self, cursor: bytes, *options: bytes) -> bytes:
+        match = None
+        count = 10
+        for option, value in zip(options[::2], options[1::2]):
+            if option.upper() == b'MATCH':
+                match = pattern_to_regex(value)
+            elif option.upper() == b'COUNT':
+                count = int(value)
+        # like a real cursor, keys which exist for the whole scan are returned even if
+        # other keys are deleted during it, so the cursor refers to the last key
+        # returned rather than a position
+        keys = self._keys()
+        if cursor != b'0':
+            last = self.cursors.pop(int(cursor))
+            keys = [key for key in keys if key > last]
+        page = keys[:count]
+        next_cursor = 0
+        if len(keys) > count:
+            next_cursor = len(self.cursors) + 1
+            while next_cursor in self.cursors:
+                next_cursor += 1
+            self.cursors[next_cursor] = page[-1]
+        if match is not None:
+            page = [key for key in page if match.match(key)]
+        return b'*2\r\n' + self._bulk(str(next_cursor).encode()) + self._array(page)
+
+    def _dbsize(self) -> bytes:
+        return self._integer(len(self._keys()))
+
+    def _flushdb(self, *args) -> bytes:
+        self.data.clear()
+        self.expiries.clear()
+        return b'+OK\r\n'
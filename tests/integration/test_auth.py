@@ -22,3 +22,48 @@ class TestBuildIIIFResource:
     def test_sysadmin(self):
         user = factories.Sysadmin()
         assert toolkit.check_access('build_iiif_resource', {'user': user['name']})
+
+
+@pytest.fixture
+def private_resource():
+    org = factories.Organization()
+    dataset = factories.Dataset(private=True, owner_org=org['id'])
+    resource = factories.Resource(package_id=dataset['id'])
+    return org, resource
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.ckan_config('ckan.plugins', 'iiif')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+class TestBuildIIIFResourcePrivate:
+    """
+    Tests that IIIF resources built from private CKAN resources can only be built by
+    users who can see the CKAN resource.
+    """
+
+    def test_no_user(self, private_resource):
+        _org, resource = private_resource
+        data_dict = {'identifier': f'resource/{resource["id"]}/record/1'}
+        with pytest.raises(toolkit.NotAuthorized):
+            toolkit.check_access('build_iiif_resource', {'user': ''}, data_dict)
+
+    def test_other_user(self, private_resource):
+        _org, resource = private_resource
+        user = factories.User()
+        data_dict = {'identifier': f'resource/{resource["id"]}/record/1'}
+        with pytest.raises(toolkit.NotAuthorized):
+            toolkit.check_access(
+                'build_iiif_resource', {'user': user['name']}, data_dict
+            )
+
+    def test_member(self, private_resource):
+        org, resource = private_resource
+        user = factories.User()
+        toolkit.get_action('organization_member_create')(
+            {'ignore_auth': True},
+            {'id': org['id'], 'username': user['name'], 'role': 'member'},
+        )
+        data_dict = {'identifier': f'resource/{resource["id"]}/record/1'}
+        assert toolkit.check_access(
+            'build_iiif_resource', {'user': user['name']}, data_dict
+        )
@@ -2,6 +2,11 @@ import json
 from unittest.mock import MagicMock, call, patch
 
 import pytest
+from ckan.tests import factories
+
+from ckanext.iiif.lib.cache import ManifestCache
+from ckanext.iiif.lib.resources import BuiltResource
+from ckanext.iiif.lib.store import ManifestStore
 
 
 @pytest.mark.ckan_config('ckan.plugins', 'iiif')
@@ -38,3 +43,188 @@ class TestIIIFRoute:
             response = app.get(f'/iiif/{identifier}')
 
         assert response.status_code == 404
+
+    def test_if_none_match(self, app):
+        identifier = 'resource/1/record/1'
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value={'beans': 3}))
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            response = app.get(f'/iiif/{identifier}')
+            etag = response.headers['ETag']
+            response = app.get(f'/iiif/{identifier}', headers={'If-None-Match': etag})
+
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+        assert not response.data
+
+    def test_if_none_match_cached_no_rebuild(self, app):
+        identifier = 'resource/1/record/1'
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value={'beans': 3}))
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            with patch('ckanext.iiif.logic.actions.CACHE', ManifestCache(10)):
+                response = app.get(f'/iiif/{identifier}')
+                etag = response.headers['ETag']
+                response = app.get(
+                    f'/iiif/{identifier}', headers={'If-None-Match': etag}
+                )
+
+        assert response.status_code == 304
+        mock_builder.match_and_build.assert_called_once_with(identifier)
+
+    def test_if_modified_since(self, app):
+        identifier = 'resource/1/record/1'
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value={'beans': 3}))
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            with patch('ckanext.iiif.logic.actions.CACHE', ManifestCache(10)):
+                response = app.get(f'/iiif/{identifier}')
+                last_modified = response.headers['Last-Modified']
+                response = app.get(
+                    f'/iiif/{identifier}',
+                    headers={'If-Modified-Since': last_modified},
+                )
+
+        assert response.status_code == 304
+
+    def test_batch(self, app):
+        mock_builder = MagicMock(
+            match_and_build=MagicMock(
+                side_effect=lambda identifier: (
+                    {'id': identifier} if identifier.startswith('resource') else None
+                )
+            )
+        )
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            response = app.post(
+                '/iiif/batch', json={'identifiers': ['resource/1/record/1', 'nope']}
+            )
+
+        assert response.status_code == 200
+        assert json.loads(response.data) == {
+            'resource/1/record/1': {'result': {'id': 'resource/1/record/1'}},
+            'nope': {'error': 'Unknown IIIF identifier'},
+        }
+
+    def test_batch_no_identifiers(self, app):
+        response = app.post('/iiif/batch', json={})
+        assert response.status_code == 400
+
+    @pytest.mark.parametrize('body', [['resource/1/record/1'], 'resource/1', 3])
+    def test_batch_not_an_object(self, app, body):
+        response = app.post('/iiif/batch', json=body)
+        assert response.status_code == 400
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.ckan_config('ckan.plugins', 'iiif')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+class TestPrivateResources:
+    """
+    IIIF resources built from private CKAN resources must not be served to users who
+    can't see the CKAN resource, even if they're cached or prebuilt.
+    """
+
+    @pytest.fixture
+    def identifier(self):
+        org = factories.Organization()
+        dataset = factories.Dataset(private=True, owner_org=org['id'])
+        resource = factories.Resource(package_id=dataset['id'])
+        return f'resource/{resource["id"]}/record/1'
+
+    def test_cached(self, app, identifier):
+        cache = ManifestCache(max_size=10)
+        cache.set(identifier, BuiltResource({'beans': 3}))
+
+        with patch('ckanext.iiif.logic.actions.CACHE', cache):
+            response = app.get(f'/iiif/{identifier}')
+
+        assert response.status_code == 403
+
+    def test_prebuilt(self, app, identifier, tmp_path):
+        manifest_store = ManifestStore(str(tmp_path))
+        manifest_store.write(identifier, b'{"beans":3}')
+
+        with patch('ckanext.iiif.lib.store.STORE', manifest_store):
+            response = app.get(f'/iiif/{identifier}')
+
+        assert response.status_code == 403
+
+    def test_batch_cached(self, app, identifier):
+        cache = ManifestCache(max_size=10)
+        cache.set(identifier, BuiltResource({'beans': 3}))
+
+        with patch('ckanext.iiif.logic.actions.CACHE', cache):
+            response = app.post('/iiif/batch', json={'identifiers': [identifier]})
+
+        assert response.status_code == 200
+        assert json.loads(response.data) == {
+            identifier: {'error': 'Not authorised to see this IIIF resource'}
+        }
+
+    def test_sysadmin(self, app, identifier):
+        user = factories.Sysadmin()
+        cache = ManifestCache(max_size=10)
+        cache.set(identifier, BuiltResource({'beans': 3}))
+
+        with patch('ckanext.iiif.logic.actions.CACHE', cache):
+            response = app.get(
+                f'/iiif/{identifier}', extra_environ={'REMOTE_USER': user['name']}
+            )
+
+        assert response.status_code == 200
+        assert json.loads(response.data) == {'beans': 3}
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.ckan_config('ckan.plugins', 'iiif')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+class TestMetricsRoute:
+    def test_anonymous(self, app):
+        response = app.get('/iiif/_metrics')
+        assert response.status_code == 403
+
+    def test_user(self, app):
+        user = factories.User()
+        response = app.get(
+            '/iiif/_metrics', extra_environ={'REMOTE_USER': user['name']}
+        )
+        assert response.status_code == 403
+
+    def test_sysadmin(self, app):
+        user = factories.Sysadmin()
+        response = app.get(
+            '/iiif/_metrics', extra_environ={'REMOTE_USER': user['name']}
+        )
+        assert response.status_code == 200
+        assert response.content_type.startswith('text/plain; version=0.0.4')
+        body = response.data.decode('utf-8')
+        assert '# TYPE ckanext_iiif_dispatch_seconds histogram' in body
+        assert 'ckanext_iiif_cache_hit_ratio{cache="resources"}' in body
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.ckan_config('ckan.plugins', 'iiif')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+class TestProfileRoute:
+    def test_anonymous(self, app):
+        response = app.get('/iiif/nope?iiif_profile')
+        assert response.status_code == 403
+
+    def test_user(self, app):
+        user = factories.User()
+        response = app.get(
+            '/iiif/nope?iiif_profile', extra_environ={'REMOTE_USER': user['name']}
+        )
+        assert response.status_code == 403
+
+    def test_sysadmin(self, app):
+        user = factories.Sysadmin()
+        response = app.get(
+            '/iiif/nope?iiif_profile', extra_environ={'REMOTE_USER': user['name']}
+        )
+        assert response.status_code == 200
+        assert response.json['found'] is False
+        assert response.json['profile']['label'] == 'nope'
+        assert 'stats' in response.json['profile']
@@ -0,0 +1,71 @@
+import asyncio
+from typing import Optional
+
+import pytest
+
+from ckanext.iiif.builders.abc import AsyncIIIFResourceBuilder, IIIFResourceBuilder
+from ckanext.iiif.builders.utils import IIIFBuildError
+
+
+class SyncBuilder(IIIFResourceBuilder):
+    def match_and_build(self, identifier: str) -> Optional[dict]:
+        if identifier == 'error':
+            raise IIIFBuildError(identifier, 'oh no!')
+        return {'id': identifier} if identifier.startswith('sync') else None
+
+    def build_identifier(self, **kwargs) -> str:
+        return 'sync'
+
+
+class AsyncBuilder(AsyncIIIFResourceBuilder):
+    async def match_and_build_async(self, identifier: str) -> Optional[dict]:
+        if identifier == 'error':
+            raise IIIFBuildError(identifier, 'oh no!')
+        if not identifier.startswith('async'):
+            return None
+        # do some things concurrently
+        parts = await asyncio.gather(
+            *(asyncio.sleep(0, result=part) for part in identifier.split('/'))
+        )
+        return {'id': identifier, 'parts': parts}
+
+    def build_identifier(self, **kwargs) -> str:
+        return 'async'
+
+
+class TestIIIFResourceBuilder:
+    def test_match_and_build_async(self):
+        builder = SyncBuilder()
+        assert asyncio.run(builder.match_and_build_async('sync/1')) == {'id': 'sync/1'}
+        assert asyncio.run(builder.match_and_build_async('async/1')) is None
+
+    def test_match_and_build_async_error(self):
+        with pytest.raises(IIIFBuildError):
+            asyncio.run(SyncBuilder().match_and_build_async('error'))
+
+
+class TestAsyncIIIFResourceBuilder:
+    def test_match_and_build(self):
+        builder = AsyncBuilder()
+        assert builder.match_and_build('async/1') == {
+            'id': 'async/1',
+            'parts': ['async', '1'],
+        }
+        assert builder.match_and_build('sync/1') is None
+
+    def test_match_and_build_error(self):
+        with pytest.raises(IIIFBuildError):
+            AsyncBuilder().match_and_build('error')
+
+    def test_match_and_build_many(self):
+        results = AsyncBuilder().match_and_build_many(['async/1', 'sync/1', 'error'])
+        assert results['async/1'] == {'id': 'async/1', 'parts': ['async', '1']}
+        assert 'sync/1' not in results
+        assert isinstance(results['error'], IIIFBuildError)
+
+    def test_match_and_build_in_running_loop(self):
+        async def call_sync():
+            # e.g. a sync action called from async code
+            return AsyncBuilder().match_and_build('async/1')
+
+        assert asyncio.run(call_sync())['id'] == 'async/1'
@@ -0,0 +1,280 @@
+import asyncio
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from ckanext.iiif.builders.canvas import RecordCanvasBuilder
+from ckanext.iiif.builders.manifest import RecordManifestBuilder
+from ckanext.iiif.builders.utils import IIIFBuildError
+
+RESOURCE = {'id': 'r1', '_image_field': 'images'}
+RECORD = {'_id': '1', 'images': ['https://image/a', 'https://image/b']}
+MODIFIED = datetime(2024, 5, 1, 12, tzinfo=timezone.utc)
+# 2024-04-01T09:00:00 UTC in milliseconds, before MODIFIED
+VERSION = 1711962000000
+
+
+def fake_create_id_url(identifier):
+    return f'https://iiif/{identifier}'
+
+
+@pytest.fixture
+def id_urls():
+    with patch('ckanext.iiif.builders.canvas.create_id_url', fake_create_id_url):
+        with patch('ckanext.iiif.builders.manifest.create_id_url', fake_create_id_url):
+            yield
+
+
+@pytest.fixture
+def get_action_mock():
+    actions = {
+        'resource_show': MagicMock(return_value=RESOURCE),
+        'vds_data_get': MagicMock(return_value={'data': RECORD}),
+    }
+    with patch(
+        'ckanext.iiif.builders.manifest.toolkit.get_action',
+        MagicMock(side_effect=actions.get),
+    ), patch('ckanext.iiif.lib.concurrency.toolkit.c', MagicMock(user='someone')):
+        yield actions
+
+
+class TestBuildIdentifier:
+    def test_canvas(self):
+        builder = RecordCanvasBuilder()
+        assert builder.build_identifier('r1', 1, 0) == 'resource/r1/record/1/canvas/0'
+
+    def test_annotation_page(self):
+        builder = RecordCanvasBuilder()
+        assert (
+            builder.build_identifier('r1', 1, 0, 0) == 'resource/r1/record/1/canvas/0/0'
+        )
+
+    def test_annotation(self):
+        builder = RecordCanvasBuilder()
+        assert (
+            builder.build_identifier('r1', 1, 0, 0, 0)
+            == 'resource/r1/record/1/canvas/0/0/0'
+        )
+
+
+@pytest.mark.usefixtures('id_urls')
+class TestBuildCanvas:
+    def test_same_as_manifest(self):
+        canvas = RecordCanvasBuilder.build_canvas(RESOURCE, RECORD, 1).to_dict()
+        expected = RecordManifestBuilder._build_canvas(
+            'resource/r1/record/1', 1, 'https://image/b'
+        ).to_dict()
+        assert canvas['@context'] == 'http://iiif.io/api/presentation/3/context.json'
+        assert canvas['partOf'] == [
+            {'id': 'https://iiif/resource/r1/record/1', 'type': 'Manifest'}
+        ]
+        assert {
+            key: value
+            for key, value in canvas.items()
+            if key not in ('@context', 'partOf')
+        } == expected
+
+    def test_only_resolves_one_image(self):
+        with patch(
+            'ckanext.iiif.builders.canvas.resolve_dimensions',
+            return_value={'https://image/b': (20, 40)},
+        ) as resolve_dimensions_mock:
+            canvas = RecordCanvasBuilder.build_canvas(RESOURCE, RECORD, 1).to_dict()
+
+        resolve_dimensions_mock.assert_called_once_with(['https://image/b'])
+        assert canvas['width'] == 20
+        assert canvas['height'] == 40
+
+    def test_modified(self):
+        resource = {**RESOURCE, 'metadata_modified': '2024-05-01T12:00:00'}
+        canvas = RecordCanvasBuilder.build_canvas(resource, RECORD, 1, VERSION)
+        assert canvas.modified == MODIFIED
+        assert RecordCanvasBuilder.build_canvas(RESOURCE, RECORD, 1).modified is None
+
+    def test_modified_needs_version(self):
+        resource = {**RESOURCE, 'metadata_modified': '2024-05-01T12:00:00'}
+        assert RecordCanvasBuilder.build_canvas(resource, RECORD, 1).modified is None
+
+    def test_no_image(self):
+        with pytest.raises(IIIFBuildError, match='Image 2 not found'):
+            RecordCanvasBuilder.build_canvas(RESOURCE, RECORD, 2)
+
+
+@pytest.mark.usefixtures('id_urls')
+class TestBuildAnnotationPage:
+    def test_same_as_manifest(self):
+        page = RecordCanvasBuilder.build_annotation_page(
+            RESOURCE, RECORD, 1, 0
+        ).to_dict()
+        canvas = RecordManifestBuilder._build_canvas(
+            'resource/r1/record/1', 1, 'https://image/b'
+        ).to_dict()
+        assert page == {
+            '@context': 'http://iiif.io/api/presentation/3/context.json',
+            **canvas['items'][0],
+        }
+        assert page['id'] == 'https://iiif/resource/r1/record/1/canvas/1/0'
+
+    def test_modified(self):
+        resource = {**RESOURCE, 'metadata_modified': '2024-05-01T12:00:00'}
+        page = RecordCanvasBuilder.build_annotation_page(
+            resource, RECORD, 1, 0, VERSION
+        )
+        assert page.modified == MODIFIED
+
+    def test_no_page(self):
+        with pytest.raises(IIIFBuildError, match='Annotation page 1 not found'):
+            RecordCanvasBuilder.build_annotation_page(RESOURCE, RECORD, 0, 1)
+
+    def test_no_image(self):
+        with pytest.raises(IIIFBuildError, match='Image 2 not found'):
+            RecordCanvasBuilder.build_annotation_page(RESOURCE, RECORD, 2, 0)
+
+
+@pytest.mark.usefixtures('id_urls')
+class TestBuildAnnotation:
+    def test_same_as_manifest(self):
+        annotation = RecordCanvasBuilder.build_annotation(
+            RESOURCE, RECORD, 1, 0, 0
+        ).to_dict()
+        canvas = RecordManifestBuilder._build_canvas(
+            'resource/r1/record/1', 1, 'https://image/b'
+        ).to_dict()
+        assert annotation == {
+            '@context': 'http://iiif.io/api/presentation/3/context.json',
+            **canvas['items'][0]['items'][0],
+        }
+        assert annotation['id'] == 'https://iiif/resource/r1/record/1/canvas/1/0/0'
+
+    def test_modified(self):
+        resource = {**RESOURCE, 'metadata_modified': '2024-05-01T12:00:00'}
+        annotation = RecordCanvasBuilder.build_annotation(
+            resource, RECORD, 1, 0, 0, VERSION
+        )
+        assert annotation.modified == MODIFIED
+
+    def test_no_annotation(self):
+        with pytest.raises(IIIFBuildError, match='Annotation 1 not found'):
+            RecordCanvasBuilder.build_annotation(RESOURCE, RECORD, 0, 0, 1)
+
+    def test_no_page(self):
+        with pytest.raises(IIIFBuildError, match='Annotation page 1 not found'):
+            RecordCanvasBuilder.build_annotation(RESOURCE, RECORD, 0, 1, 0)
+
+
+@pytest.mark.usefixtures('id_urls')
+class TestMatchAndBuild:
+    @pytest.mark.parametrize(
+        'identifier',
+        [
+            'test',
+            'resource/r1/record/1',
+            'resource/r1/record/1/canvas',
+            'resource/r1/record/1/canvas/a',
+            'resource/r1/record/1/canvas/0/0/0/0',
+            'resource/r1/record/1/canvas/0/0/a',
+            'resource/r1/collection',
+        ],
+    )
+    def test_no_matches(self, identifier):
+        assert RecordCanvasBuilder().match_and_build(identifier) is None
+
+    def test_canvas(self, get_action_mock):
+        canvas = RecordCanvasBuilder().match_and_build('resource/r1/record/1/canvas/1')
+        canvas = canvas.to_dict()
+
+        assert canvas['type'] == 'Canvas'
+        assert canvas['id'] == 'https://iiif/resource/r1/record/1/canvas/1'
+        get_action_mock['resource_show'].assert_called_once_with(
+            {'user': 'someone'}, {'id': 'r1'}
+        )
+        get_action_mock['vds_data_get'].assert_called_once_with(
+            {'user': 'someone'}, {'resource_id': 'r1', 'record_id': '1'}
+        )
+
+    def test_modified(self, get_action_mock):
+        get_action_mock['resource_show'].configure_mock(
+            return_value={**RESOURCE, 'metadata_modified': '2024-04-01T08:00:00'}
+        )
+        get_action_mock['vds_data_get'].configure_mock(
+            return_value={'data': RECORD, 'version': VERSION}
+        )
+        canvas = RecordCanvasBuilder().match_and_build('resource/r1/record/1/canvas/1')
+
+        # the record was updated after the resource so its version is used
+        assert canvas.modified == datetime(2024, 4, 1, 9, tzinfo=timezone.utc)
+
+    def test_annotation_page(self, get_action_mock):
+        page = RecordCanvasBuilder().match_and_build('resource/r1/record/1/canvas/1/0')
+        page = page.to_dict()
+
+        assert page['type'] == 'AnnotationPage'
+        assert page['id'] == 'https://iiif/resource/r1/record/1/canvas/1/0'
+
+    def test_annotation(self, get_action_mock):
+        annotation = RecordCanvasBuilder().match_and_build(
+            'resource/r1/record/1/canvas/1/0/0'
+        )
+        annotation = annotation.to_dict()
+
+        assert annotation['type'] == 'Annotation'
+        assert annotation['id'] == 'https://iiif/resource/r1/record/1/canvas/1/0/0'
+        assert annotation['target'] == 'https://iiif/resource/r1/record/1/canvas/1'
+
+    def test_async(self, get_action_mock):
+        canvas = asyncio.run(
+            RecordCanvasBuilder().match_and_build_async('resource/r1/record/1/canvas/0')
+        )
+        assert canvas.to_dict()['type'] == 'Canvas'
+
+    def test_doesnt_build_manifest(self, get_action_mock):
+        with patch(
+            'ckanext.iiif.builders.manifest.RecordManifestBuilder.build_record_manifest_model'
+        ) as build_record_manifest_mock:
+            RecordCanvasBuilder().match_and_build('resource/r1/record/1/canvas/0')
+
+        build_record_manifest_mock.assert_not_called()
+
+    def test_manifest_ids_resolve(self, get_action_mock):
+        # every canvas and annotation page ID in the manifest should be built by this
+        # builder as the same thing
+        with patch('ckanext.iiif.builders.manifest.get_template') as get_template_mock:
+            get_template_mock.return_value.get_images.return_value = RECORD['images']
+            manifest = RecordManifestBuilder.build_record_manifest(RESOURCE, RECORD)
+
+        builder = RecordCanvasBuilder()
+        prefix = 'https://iiif/'
+        for canvas in manifest['items']:
+            built = builder.match_and_build(canvas['id'][len(prefix) :]).to_dict()
+            assert built['items'] == canvas['items']
+            for page in canvas['items']:
+                built = builder.match_and_build(page['id'][len(prefix) :]).to_dict()
+                assert built['items'] == page['items']
+                for annotation in page['items']:
+                    built = builder.match_and_build(annotation['id'][len(prefix) :])
+                    built = built.to_dict()
+                    del built['@context']
+                    assert built == annotation
+
+    def test_referenced_pages_resolve(self, get_action_mock):
+        # when the manifest only references the annotation pages, they should be built
+        # by this builder in full
+        config = {'ckanext.iiif.manifest.page_threshold': '1'}
+        with patch.dict('ckanext.iiif.builders.manifest.toolkit.config', config):
+            with patch(
+                'ckanext.iiif.builders.manifest.get_template'
+            ) as get_template_mock:
+                get_template_mock.return_value.get_images.return_value = RECORD[
+                    'images'
+                ]
+                manifest = RecordManifestBuilder.build_record_manifest(RESOURCE, RECORD)
+
+        builder = RecordCanvasBuilder()
+        prefix = 'https://iiif/'
+        for canvas in manifest['items']:
+            page = canvas['items'][0]
+            assert set(page) == {'id', 'type'}
+            built = builder.match_and_build(page['id'][len(prefix) :]).to_dict()
+            assert built['id'] == page['id']
+            assert built['items'][0]['target'] == canvas['id']
@@ -0,0 +1,204 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from ckanext.iiif.builders.collection import (
+    MAX_PAGE_SIZE,
+    ResourceCollectionBuilder,
+    decode_after,
+    encode_after,
+)
+from ckanext.iiif.builders.utils import IIIFBuildError, wrap_language
+
+
+def create_id_url(identifier: str) -> str:
+    return f'http://localhost/iiif/{identifier}'
+
+
+class TestAfterEncoding:
+    @pytest.mark.parametrize(
+        'after', [[1], [4, 'beans'], ['a/b+c=?&'], [1.5, None, True], []]
+    )
+    def test_round_trip(self, after):
+        encoded = encode_after(after)
+        assert '/' not in encoded
+        assert '=' not in encoded
+        assert decode_after(encoded) == after
+
+    @pytest.mark.parametrize('encoded', ['!!!', 'bm90IGpzb24', encode_after([])[:-1]])
+    def test_invalid(self, encoded):
+        with pytest.raises(ValueError):
+            decode_after(encoded)
+
+    def test_not_a_list(self):
+        with pytest.raises(ValueError):
+            decode_after('eyJhIjogMX0')
+
+
+class TestBuildIdentifier:
+    def test_first_page(self):
+        builder = ResourceCollectionBuilder()
+        assert builder.build_identifier('beans') == 'resource/beans/collection'
+
+    def test_page(self):
+        builder = ResourceCollectionBuilder()
+        identifier = builder.build_identifier('beans', 'WzFd')
+        assert identifier == 'resource/beans/collection/WzFd'
+
+
+@patch('ckanext.iiif.builders.manifest.create_id_url', create_id_url)
+@patch('ckanext.iiif.builders.collection.create_id_url', create_id_url)
+class TestMatchAndBuild:
+    @pytest.fixture
+    def resource(self):
+        return {
+            'id': 'beans',
+            'name': 'Beans',
+            '_image_field': 'images',
+            '_title_field': 'name',
+        }
+
+    def build(self, identifier, resource, result):
+        multi_query_mock = MagicMock(return_value=result)
+        with patch(
+            'ckanext.iiif.builders.collection.toolkit.get_action',
+            MagicMock(return_value=MagicMock(return_value=resource)),
+        ), patch('ckanext.iiif.builders.collection.multi_query', multi_query_mock):
+            collection = ResourceCollectionBuilder().match_and_build(identifier)
+        return collection, multi_query_mock
+
+    @pytest.mark.parametrize(
+        'identifier',
+        [
+            'test',
+            'resource/beans',
+            'resource/beans/collection/',
+            'resource/beans/record/4',
+            'resource/beans/collection/a/b',
+        ],
+    )
+    def test_no_matches(self, identifier):
+        builder = ResourceCollectionBuilder()
+        assert builder.match_and_build(identifier) is None
+
+    def test_no_resource(self):
+        builder = ResourceCollectionBuilder()
+        with pytest.raises(IIIFBuildError, match='Resource beans not found'):
+            builder.match_and_build('resource/beans/collection')
+
+    def test_no_image_field(self, resource):
+        del resource['_image_field']
+        with pytest.raises(IIIFBuildError, match='no image field'):
+            self.build('resource/beans/collection', resource, {})
+
+    def test_invalid_page(self, resource):
+        with pytest.raises(IIIFBuildError, match='Invalid page'):
+            self.build('resource/beans/collection/!!!', resource, {})
+
+    def test_first_page(self, resource):
+        result = {
+            'records': [
+                {'data': {'_id': 1, 'name': 'one', 'images': ['a']}},
+                {'data': {'_id': 2, 'name': 'two', 'images': ['b', 'c']}},
+            ],
+            'after': [2],
+        }
+
+        collection, multi_query_mock = self.build(
+            'resource/beans/collection', resource, result
+        )
+
+        multi_query_mock.assert_called_once_with(
+            'beans',
+            {'filters': {'and': [{'exists': {'fields': ['images']}}]}},
+            100,
+            None,
+        )
+        next_id = f'resource/beans/collection/{encode_after([2])}'
+        assert collection == {
+            '@context': 'http://iiif.io/api/presentation/3/context.json',
+            'id': create_id_url('resource/beans/collection'),
+            'type': 'Collection',
+            'label': wrap_language('Beans'),
+            'items': [
+                {
+                    'id': create_id_url('resource/beans/record/1'),
+                    'type': 'Manifest',
+                    'label': wrap_language('one'),
+                },
+                {
+                    'id': create_id_url('resource/beans/record/2'),
+                    'type': 'Manifest',
+                    'label': wrap_language('two'),
+                },
+                {
+                    'id': create_id_url(next_id),
+                    'type': 'Collection',
+                    'label': wrap_language('Next page'),
+                },
+            ],
+        }
+
+    def test_later_page(self, resource):
+        result = {
+            'records': [{'data': {'_id': 3, 'name': 'three', 'images': ['a']}}],
+            'after': None,
+        }
+        encoded = encode_after([2])
+
+        collection, multi_query_mock = self.build(
+            f'resource/beans/collection/{encoded}', resource, result
+        )
+
+        assert multi_query_mock.call_args.args[3] == [2]
+        assert collection['id'] == create_id_url(f'resource/beans/collection/{encoded}')
+        assert collection['partOf'] == [
+            {'id': create_id_url('resource/beans/collection'), 'type': 'Collection'}
+        ]
+        # no next page
+        assert [item['type'] for item in collection['items']] == ['Manifest']
+
+    def test_no_next_page_when_empty(self, resource):
+        result = {'records': [], 'after': [5]}
+        collection, _ = self.build('resource/beans/collection', resource, result)
+        assert collection['items'] == []
+
+    def test_records_without_images_skipped(self, resource):
+        result = {
+            'records': [
+                {'data': {'_id': 1, 'name': 'one', 'images': []}},
+                {'data': {'_id': 2, 'name': 'two', 'images': ['b']}},
+            ],
+            'after': None,
+        }
+        collection, _ = self.build('resource/beans/collection', resource, result)
+        assert [item['label'] for item in collection['items']] == [wrap_language('two')]
+
+    def test_default_page_size(self, resource):
+        _, multi_query_mock = self.build(
+            'resource/beans/collection', resource, {'records': [], 'after': None}
+        )
+        assert multi_query_mock.call_args.args[2] == 100
+
+    @pytest.mark.ckan_config('ckanext.iiif.collection.page_size', '10')
+    def test_page_size(self, resource):
+        _, multi_query_mock = self.build(
+            'resource/beans/collection', resource, {'records': [], 'after': None}
+        )
+        assert multi_query_mock.call_args.args[2] == 10
+
+    @pytest.mark.ckan_config('ckanext.iiif.collection.page_size', '0')
+    def test_page_size_minimum(self, resource):
+        _, multi_query_mock = self.build(
+            'resource/beans/collection', resource, {'records': [], 'after': None}
+        )
+        assert multi_query_mock.call_args.args[2] == 1
+
+    @pytest.mark.ckan_config(
+        'ckanext.iiif.collection.page_size', str(MAX_PAGE_SIZE * 10)
+    )
+    def test_page_size_maximum(self, resource):
+        _, multi_query_mock = self.build(
+            'resource/beans/collection', resource, {'records': [], 'after': None}
+        )
+        assert multi_query_mock.call_args.args[2] == MAX_PAGE_SIZE
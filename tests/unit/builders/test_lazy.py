@@ -0,0 +1,77 @@
+import asyncio
+import threading
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from ckanext.iiif.builders.lazy import LazyBuilder
+from ckanext.iiif.logic.actions import BUILDERS
+
+PATH = 'ckanext.iiif.builders.canvas:RecordCanvasBuilder'
+
+
+@pytest.fixture
+def builder_mock():
+    builder = MagicMock()
+    with patch(PATH.replace(':', '.'), MagicMock(return_value=builder)) as cls_mock:
+        yield cls_mock, builder
+
+
+class TestLazyBuilder:
+    def test_not_loaded_until_used(self, builder_mock):
+        cls_mock, builder = builder_mock
+        lazy = LazyBuilder('canvas', PATH, ('resource',))
+        assert not lazy.loaded
+        cls_mock.assert_not_called()
+
+        lazy.match_and_build('resource/1')
+        assert lazy.loaded
+        assert lazy.builder is builder
+
+    def test_loaded_once(self, builder_mock):
+        cls_mock, builder = builder_mock
+        lazy = LazyBuilder('canvas', PATH)
+        barrier = threading.Barrier(4, timeout=5)
+
+        def load():
+            barrier.wait()
+            return lazy.builder
+
+        threads = [threading.Thread(target=load) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        cls_mock.assert_called_once()
+
+    def test_delegates(self, builder_mock):
+        _cls_mock, builder = builder_mock
+        builder.match_and_build.return_value = 'built'
+        builder.match_and_build_many.return_value = {'a': 'built'}
+        builder.build_identifier.return_value = 'identifier'
+        lazy = LazyBuilder('canvas', PATH)
+
+        assert lazy.match_and_build('a') == 'built'
+        assert lazy.match_and_build_many(['a']) == {'a': 'built'}
+        assert lazy.build_identifier(beans=3) == 'identifier'
+        builder.build_identifier.assert_called_once_with(beans=3)
+
+    def test_async(self):
+        lazy = LazyBuilder('canvas', PATH)
+        assert asyncio.run(lazy.match_and_build_async('test')) is None
+
+    def test_builder_id(self):
+        lazy = LazyBuilder('canvas', PATH, ('resource',))
+        assert lazy.BUILDER_ID == 'canvas'
+        assert lazy.prefixes == ('resource',)
+
+
+@pytest.mark.parametrize('builder_id', list(BUILDERS))
+def test_default_builders_match(builder_id):
+    # the default builders are registered lazily with their IDs and prefixes copied from
+    # the builder classes, so check they haven't drifted apart
+    lazy = BUILDERS[builder_id]
+    assert isinstance(lazy, LazyBuilder)
+    assert lazy.BUILDER_ID == builder_id == lazy.builder.BUILDER_ID
+    assert lazy.prefixes == lazy.builder.prefixes
@@ -1,4 +1,6 @@
-from unittest.mock import MagicMock, patch
+import asyncio
+import threading
+from unittest.mock import MagicMock, PropertyMock, call, patch
 
 import pytest
 from ckan.logic import NotFound
@@ -6,7 +8,7 @@ from ckan.plugins import toolkit
 from ckan.tests import factories
 
 from ckanext.iiif.builders.manifest import RecordManifestBuilder
-from ckanext.iiif.builders.utils import IIIFBuildError, wrap_language
+from ckanext.iiif.builders.utils import IIIFBuildError, get_modified, wrap_language
 
 
 class TestBuildManifestID:
@@ -57,6 +59,10 @@ class TestBuildRights:
         licence_url = RecordManifestBuilder._build_rights({})
         assert licence_url == 'http://www.opendefinition.org/licenses/cc-by'
 
+    def test_unknown_image_licence(self):
+        licence_url = RecordManifestBuilder._build_rights({'_image_licence': 'beans'})
+        assert licence_url is None
+
 
 class TestBuildMetadata:
     def test_int(self):
@@ -97,11 +103,10 @@ class TestBuildMetadata:
             'dict': {'a': 1, 'b': 2},
         }
         metadata = RecordManifestBuilder._build_metadata(record)
-        assert len(metadata) == 1
-        assert metadata[0] == {
-            'label': wrap_language('dict'),
-            'value': wrap_language(str({'a': 1, 'b': 2})),
-        }
+        assert metadata == [
+            {'label': wrap_language('dict.a'), 'value': wrap_language('1')},
+            {'label': wrap_language('dict.b'), 'value': wrap_language('2')},
+        ]
 
     def test_mix(self):
         record = {
@@ -111,23 +116,19 @@ class TestBuildMetadata:
             'dict': {'a': 1, 'b': 2},
         }
         metadata = RecordManifestBuilder._build_metadata(record)
-        assert len(metadata) == 4
-        assert metadata[0] == {
-            'label': wrap_language('int'),
-            'value': wrap_language('40'),
-        }
-        assert metadata[1] == {
-            'label': wrap_language('str'),
-            'value': wrap_language('beans'),
-        }
-        assert metadata[2] == {
-            'label': wrap_language('list'),
-            'value': wrap_language(['a', 'b', 'c']),
-        }
-        assert metadata[3] == {
-            'label': wrap_language('dict'),
-            'value': wrap_language(str({'a': 1, 'b': 2})),
-        }
+        assert metadata == [
+            {'label': wrap_language('int'), 'value': wrap_language('40')},
+            {'label': wrap_language('str'), 'value': wrap_language('beans')},
+            {'label': wrap_language('list'), 'value': wrap_language(['a', 'b', 'c'])},
+            {'label': wrap_language('dict.a'), 'value': wrap_language('1')},
+            {'label': wrap_language('dict.b'), 'value': wrap_language('2')},
+        ]
+
+    def test_template(self):
+        template = MagicMock()
+        metadata = RecordManifestBuilder._build_metadata({'a': 1}, template)
+        template.build_metadata.assert_called_once_with({'a': 1})
+        assert metadata == template.build_metadata.return_value
 
 
 class TestBuildCanvas:
@@ -140,7 +141,7 @@ class TestBuildCanvas:
 
         canvas = RecordManifestBuilder._build_canvas(
             manifest_id, image_number, image_id
-        )
+        ).to_dict()
 
         assert canvas['id'] == toolkit.url_for(
             'iiif.resource',
@@ -164,6 +165,34 @@ class TestBuildCanvas:
             ],
         }
 
+    @pytest.mark.ckan_config('ckan.plugins', 'iiif')
+    @pytest.mark.usefixtures('with_plugins', 'with_request_context')
+    def test_default_dimensions(self):
+        canvas = RecordManifestBuilder._build_canvas('beans/1', 0, 'image').to_dict()
+        assert canvas['width'] == 1000
+        assert canvas['height'] == 1000
+
+    @pytest.mark.ckan_config('ckan.plugins', 'iiif')
+    @pytest.mark.usefixtures('with_plugins', 'with_request_context')
+    def test_dimensions(self):
+        canvas = RecordManifestBuilder._build_canvas(
+            'beans/1', 0, 'image', (20, 40)
+        ).to_dict()
+        assert canvas['width'] == 20
+        assert canvas['height'] == 40
+
+    @pytest.mark.ckan_config('ckan.plugins', 'iiif')
+    @pytest.mark.usefixtures('with_plugins', 'with_request_context')
+    def test_reference_pages(self):
+        embedded = RecordManifestBuilder._build_canvas('beans/1', 0, 'image').to_dict()
+        referenced = RecordManifestBuilder._build_canvas(
+            'beans/1', 0, 'image', reference_pages=True
+        ).to_dict()
+        assert referenced['items'] == [
+            {'id': embedded['items'][0]['id'], 'type': 'AnnotationPage'}
+        ]
+        assert {**referenced, 'items': None} == {**embedded, 'items': None}
+
 
 class TestGetImages:
     def test_no_image_field(self):
@@ -248,11 +277,14 @@ class TestBuildRecordManifest:
     @patch(
         'ckanext.iiif.builders.manifest.RecordManifestBuilder._build_record_manifest_id'
     )
-    @patch('ckanext.iiif.builders.manifest.RecordManifestBuilder._get_images')
+    @patch('ckanext.iiif.builders.template.ManifestTemplate.get_images')
     @patch('ckanext.iiif.builders.manifest.create_id_url')
-    @patch('ckanext.iiif.builders.manifest.RecordManifestBuilder._build_label')
+    @patch('ckanext.iiif.builders.template.ManifestTemplate.build_label')
     @patch('ckanext.iiif.builders.manifest.RecordManifestBuilder._build_metadata')
-    @patch('ckanext.iiif.builders.manifest.RecordManifestBuilder._build_rights')
+    @patch(
+        'ckanext.iiif.builders.template.ManifestTemplate.rights',
+        new_callable=PropertyMock,
+    )
     @patch('ckanext.iiif.builders.manifest.RecordManifestBuilder._build_canvas')
     def test_manifest_props(
         self,
@@ -271,7 +303,12 @@ class TestBuildRecordManifest:
 
         images = [MagicMock(), MagicMock()]
         images_mock.configure_mock(return_value=images)
-        canvas_mock.configure_mock(side_effect=['first', 'second'])
+        canvas_mock.configure_mock(
+            side_effect=[
+                MagicMock(to_dict=MagicMock(return_value='first')),
+                MagicMock(to_dict=MagicMock(return_value='second')),
+            ]
+        )
 
         mani = RecordManifestBuilder.build_record_manifest(resource, record_data)
 
@@ -286,7 +323,81 @@ class TestBuildRecordManifest:
         assert mani['items'] == ['first', 'second']
         assert 'logo' in mani
 
-    @patch('ckanext.iiif.builders.manifest.RecordManifestBuilder._get_images')
+    @patch('ckanext.iiif.builders.manifest.resolve_dimensions')
+    @patch('ckanext.iiif.builders.template.ManifestTemplate.get_images')
+    @patch('ckanext.iiif.builders.manifest.RecordManifestBuilder._build_canvas')
+    def test_dimensions(self, canvas_mock, images_mock, resolve_dimensions_mock):
+        resource = factories.Resource()
+        record_data = {
+            '_id': 5,
+        }
+
+        images_mock.configure_mock(return_value=['a', 'b'])
+        resolve_dimensions_mock.configure_mock(return_value={'a': (10, 20)})
+
+        RecordManifestBuilder.build_record_manifest(resource, record_data)
+
+        resolve_dimensions_mock.assert_called_once_with(['a', 'b'])
+        assert canvas_mock.call_args_list == [
+            call(f'resource/{resource["id"]}/record/5', 0, 'a', (10, 20), False),
+            call(f'resource/{resource["id"]}/record/5', 1, 'b', None, False),
+        ]
+
+    @pytest.mark.parametrize(
+        'threshold,referenced',
+        [(None, False), ('3', False), ('2', True), ('1', True), ('0', False)],
+    )
+    @patch('ckanext.iiif.builders.template.ManifestTemplate.get_images')
+    @patch('ckanext.iiif.builders.manifest.RecordManifestBuilder._build_canvas')
+    def test_page_threshold(self, canvas_mock, images_mock, threshold, referenced):
+        resource = factories.Resource()
+        images_mock.configure_mock(return_value=['a', 'b', 'c'])
+        config = {}
+        if threshold is not None:
+            config['ckanext.iiif.manifest.page_threshold'] = threshold
+
+        with patch.dict('ckanext.iiif.builders.manifest.toolkit.config', config):
+            RecordManifestBuilder.build_record_manifest(resource, {'_id': 5})
+
+        assert [c.args[4] for c in canvas_mock.call_args_list] == [referenced] * 3
+
+    @patch('ckanext.iiif.builders.template.ManifestTemplate.get_images')
+    @patch('ckanext.iiif.builders.manifest.RecordManifestBuilder._build_canvas')
+    def test_modified(self, canvas_mock, images_mock):
+        resource = factories.Resource()
+        images_mock.configure_mock(return_value=['a'])
+
+        manifest = RecordManifestBuilder.build_record_manifest_model(
+            resource, {'_id': 5}, 1711962000000
+        )
+
+        assert manifest.modified is not None
+        assert manifest.modified == get_modified(resource, 1711962000000)
+
+    @patch('ckanext.iiif.builders.template.ManifestTemplate.get_images')
+    @patch('ckanext.iiif.builders.manifest.RecordManifestBuilder._build_canvas')
+    def test_modified_needs_version(self, canvas_mock, images_mock):
+        resource = factories.Resource()
+        images_mock.configure_mock(return_value=['a'])
+
+        manifest = RecordManifestBuilder.build_record_manifest_model(
+            resource, {'_id': 5}
+        )
+
+        # a record update doesn't change the resource's metadata_modified
+        assert manifest.modified is None
+
+    @patch('ckanext.iiif.builders.template.ManifestTemplate.get_images')
+    @patch('ckanext.iiif.builders.manifest.RecordManifestBuilder._build_canvas')
+    def test_page_threshold_off_by_default(self, canvas_mock, images_mock):
+        resource = factories.Resource()
+        images_mock.configure_mock(return_value=[str(i) for i in range(1000)])
+
+        RecordManifestBuilder.build_record_manifest(resource, {'_id': 5})
+
+        assert not any(c.args[4] for c in canvas_mock.call_args_list)
+
+    @patch('ckanext.iiif.builders.template.ManifestTemplate.get_images')
     @patch('ckanext.iiif.builders.manifest.RecordManifestBuilder._build_canvas')
     def test_no_images(self, canvas_mock, images_mock):
         resource = factories.Resource()
@@ -300,11 +411,55 @@ class TestBuildRecordManifest:
         with pytest.raises(IIIFBuildError, match='No images found'):
             RecordManifestBuilder.build_record_manifest(resource, record_data)
 
+    @patch('ckanext.iiif.builders.template.ManifestTemplate.get_images')
+    def test_unknown_licence(self, images_mock):
+        resource = factories.Resource(_image_licence='beans')
+        images_mock.configure_mock(return_value=['a'])
+
+        with pytest.raises(IIIFBuildError, match='Unknown licence beans'):
+            RecordManifestBuilder.build_record_manifest(resource, {'_id': 5})
+
+
+class TestBuildRecordManifestReference:
+    @patch('ckanext.iiif.builders.manifest.create_id_url')
+    def test_reference(self, create_id_url_mock):
+        resource = {'id': 'r1', '_image_field': 'images', '_title_field': 'name'}
+        record = {'_id': 5, 'name': 'Bob', 'images': ['a', 'b', 'c']}
+
+        reference = RecordManifestBuilder.build_record_manifest_reference(
+            resource, record
+        )
+
+        create_id_url_mock.assert_called_once_with('resource/r1/record/5')
+        assert reference == {
+            'id': create_id_url_mock.return_value,
+            'type': 'Manifest',
+            'label': wrap_language('Bob'),
+            'canvas_count': 3,
+        }
+
+    def test_no_images(self):
+        with pytest.raises(IIIFBuildError, match='No images found'):
+            RecordManifestBuilder.build_record_manifest_reference(
+                {'id': 'r1'}, {'_id': 5}
+            )
+
 
 class TestMatchAndBuildRecordManifest:
     @pytest.mark.parametrize(
         'identifier',
-        ['test', 'resource/beans', 'resource/beans/record', 'resource/beans/record/'],
+        [
+            'test',
+            'resource/beans',
+            'resource/beans/record',
+            'resource/beans/record/',
+            # the ids of the canvases, annotation pages and annotations in the manifest
+            # are built by the canvas builder
+            'resource/beans/record/4/canvas/0',
+            'resource/beans/record/4/canvas/0/0',
+            'resource/beans/record/4/canvas/0/0/0',
+            'resource/beans/record/4/beans',
+        ],
     )
     def test_no_matches(self, identifier):
         builder = RecordManifestBuilder()
@@ -335,30 +490,182 @@ class TestMatchAndBuildRecordManifest:
 
         get_action_mock = MagicMock(side_effect=get_action)
 
+        # an anonymous request
+        request = MagicMock(user='')
+
         with patch(
             'ckanext.iiif.builders.manifest.toolkit.get_action', get_action_mock
-        ):
+        ), patch('ckanext.iiif.lib.concurrency.toolkit.c', request):
             with pytest.raises(IIIFBuildError, match='Record 4 not found'):
                 RecordManifestBuilder().match_and_build(
                     f'resource/{resource["id"]}/record/4'
                 )
         vds_data_get_mock.assert_called_once_with(
-            {}, {'resource_id': resource['id'], 'record_id': '4'}
+            {'user': ''}, {'resource_id': resource['id'], 'record_id': '4'}
         )
 
     @patch('ckanext.iiif.builders.manifest.toolkit.get_action')
-    @patch('ckanext.iiif.builders.manifest.RecordManifestBuilder.build_record_manifest')
+    @patch(
+        'ckanext.iiif.builders.manifest.RecordManifestBuilder.build_record_manifest_model'
+    )
     def test_success(self, build_record_manifest_mock, get_action_mock):
         resource = MagicMock()
         record_data = MagicMock()
         record = {'data': record_data}
 
-        action_mock = MagicMock(side_effect=[resource, record])
-        get_action_mock.configure_mock(return_value=action_mock)
+        # the actions are called concurrently so they're mocked by name, not by order
+        actions = {
+            'resource_show': MagicMock(return_value=resource),
+            'vds_data_get': MagicMock(return_value=record),
+        }
+        get_action_mock.configure_mock(side_effect=actions.get)
+        request = MagicMock(user='someone')
+
+        with patch('ckanext.iiif.lib.concurrency.toolkit.c', request):
+            RecordManifestBuilder().match_and_build('resource/beans/record/1')
 
-        RecordManifestBuilder().match_and_build('resource/beans/record/1')
+        build_record_manifest_mock.assert_called_once_with(resource, record_data, None)
+        # the actions are called in other threads, so they're passed the user
+        actions['resource_show'].assert_called_once_with(
+            {'user': 'someone'}, {'id': 'beans'}
+        )
+        actions['vds_data_get'].assert_called_once_with(
+            {'user': 'someone'}, {'resource_id': 'beans', 'record_id': '1'}
+        )
+
+    @patch('ckanext.iiif.builders.manifest.toolkit.get_action')
+    @patch(
+        'ckanext.iiif.builders.manifest.RecordManifestBuilder.build_record_manifest_model'
+    )
+    def test_version(self, build_record_manifest_mock, get_action_mock):
+        resource = MagicMock()
+        record_data = MagicMock()
+        actions = {
+            'resource_show': MagicMock(return_value=resource),
+            'vds_data_get': MagicMock(
+                return_value={'data': record_data, 'version': 1711962000000}
+            ),
+        }
+        get_action_mock.configure_mock(side_effect=actions.get)
+
+        with patch('ckanext.iiif.lib.concurrency.toolkit.c', MagicMock(user='someone')):
+            RecordManifestBuilder().match_and_build('resource/beans/record/1')
+
+        build_record_manifest_mock.assert_called_once_with(
+            resource, record_data, 1711962000000
+        )
+
+    @patch('ckanext.iiif.builders.manifest.toolkit.get_action')
+    def test_concurrent(self, get_action_mock):
+        # each action waits for the other to start, which would time out if they were
+        # called one after the other
+        barrier = threading.Barrier(2, timeout=5)
+
+        def action(context, data_dict):
+            barrier.wait()
+            return {'data': {'_id': 1}}
+
+        get_action_mock.configure_mock(return_value=MagicMock(side_effect=action))
+
+        with patch(
+            'ckanext.iiif.builders.manifest.RecordManifestBuilder.build_record_manifest_model'
+        ) as build_record_manifest_mock:
+            RecordManifestBuilder().match_and_build('resource/beans/record/1')
+
+        build_record_manifest_mock.assert_called_once()
+
+    @patch('ckanext.iiif.builders.manifest.toolkit.get_action')
+    def test_resource_error_takes_priority(self, get_action_mock):
+        get_action_mock.configure_mock(
+            return_value=MagicMock(side_effect=NotFound('oh no!'))
+        )
+        with pytest.raises(IIIFBuildError, match='Resource beans not found'):
+            RecordManifestBuilder().match_and_build('resource/beans/record/1')
+
+    @patch('ckanext.iiif.builders.manifest.toolkit.get_action')
+    def test_async(self, get_action_mock):
+        actions = {
+            'resource_show': MagicMock(return_value={'id': 'beans'}),
+            'vds_data_get': MagicMock(return_value={'data': {'_id': 1}}),
+        }
+        get_action_mock.configure_mock(side_effect=actions.get)
+
+        with patch(
+            'ckanext.iiif.builders.manifest.RecordManifestBuilder.build_record_manifest_model',
+            return_value={'id': 'manifest'},
+        ):
+            manifest = asyncio.run(
+                RecordManifestBuilder().match_and_build_async('resource/beans/record/1')
+            )
+
+        assert manifest == {'id': 'manifest'}
+
+
+class TestMatchAndBuildMany:
+    def test_no_matches(self):
+        builder = RecordManifestBuilder()
+        assert builder.match_and_build_many(['test', 'resource/beans']) == {}
+
+    @patch('ckanext.iiif.builders.manifest.get_records')
+    @patch('ckanext.iiif.builders.manifest.toolkit.get_action')
+    @patch(
+        'ckanext.iiif.builders.manifest.RecordManifestBuilder.build_record_manifest_model'
+    )
+    def test_grouped(self, build_record_manifest_mock, get_action_mock, records_mock):
+        resources = {'r1': {'id': 'r1'}, 'r2': {'id': 'r2'}}
+        resource_show_mock = MagicMock(
+            side_effect=lambda context, data_dict: resources[data_dict['id']]
+        )
+        get_action_mock.configure_mock(return_value=resource_show_mock)
+        records_mock.configure_mock(
+            side_effect=lambda resource_id, record_ids: {
+                record_id: {'_id': record_id} for record_id in record_ids
+            }
+        )
+        build_record_manifest_mock.configure_mock(
+            side_effect=lambda resource, record: (resource['id'], record['_id'])
+        )
+
+        results = RecordManifestBuilder().match_and_build_many(
+            ['resource/r1/record/1', 'resource/r2/record/1', 'resource/r1/record/2']
+        )
+
+        assert results == {
+            'resource/r1/record/1': ('r1', '1'),
+            'resource/r2/record/1': ('r2', '1'),
+            'resource/r1/record/2': ('r1', '2'),
+        }
+        # each resource is only retrieved once and its records are retrieved together
+        assert resource_show_mock.call_count == 2
+        assert records_mock.call_count == 2
+        assert list(records_mock.call_args_list[0][0][1]) == ['1', '2']
+
+    @patch('ckanext.iiif.builders.manifest.get_records')
+    @patch('ckanext.iiif.builders.manifest.toolkit.get_action')
+    def test_errors(self, get_action_mock, records_mock):
+        def resource_show(context, data_dict):
+            if data_dict['id'] == 'missing':
+                raise NotFound()
+            # no image field so building the manifest will fail
+            return {'id': data_dict['id']}
+
+        get_action_mock.configure_mock(
+            return_value=MagicMock(side_effect=resource_show)
+        )
+        records_mock.configure_mock(return_value={'1': {'_id': 1}})
+
+        results = RecordManifestBuilder().match_and_build_many(
+            [
+                'resource/missing/record/1',
+                'resource/r1/record/1',
+                'resource/r1/record/2',
+            ]
+        )
 
-        build_record_manifest_mock.assert_called_once_with(resource, record_data)
+        assert all(isinstance(error, IIIFBuildError) for error in results.values())
+        assert 'Resource missing not found' in str(results['resource/missing/record/1'])
+        assert 'No images found' in str(results['resource/r1/record/1'])
+        assert 'Record 2 not found' in str(results['resource/r1/record/2'])
 
 
 class TestBuildIdentifier:
@@ -0,0 +1,174 @@
+import json
+from unittest.mock import patch
+
+import pytest
+
+from ckanext.iiif.builders.model import (
+    CONTEXT,
+    Annotation,
+    AnnotationPage,
+    Canvas,
+    IIIFResource,
+    Manifest,
+)
+from ckanext.iiif.lib.serialisation import dumps
+
+
+def make_canvas(number, reference=False, **kwargs):
+    canvas_id = f'https://iiif/manifest/canvas/{number}'
+    image_id = f'https://images/{number}'
+    if reference:
+        page = AnnotationPage(f'{canvas_id}/0')
+    else:
+        page = AnnotationPage(
+            f'{canvas_id}/0', (Annotation(f'{canvas_id}/0/0', image_id, canvas_id),)
+        )
+    return Canvas(canvas_id, 1000, 800, image_id, (page,), **kwargs)
+
+
+def make_manifest(canvases=3, **kwargs):
+    return Manifest(
+        id='https://iiif/manifest',
+        label={'none': ['Bufo bufo ☃']},
+        metadata=[{'label': {'none': ['a']}, 'value': {'none': ['ünïcode']}}],
+        rights='https://creativecommons.org/licenses/by/4.0/',
+        items=[make_canvas(i, **kwargs) for i in range(canvases)],
+        logo=[{'id': 'https://logo', 'type': 'Image'}],
+    )
+
+
+RESOURCES = {
+    'annotation': lambda: Annotation('https://a', 'https://image', 'https://canvas'),
+    'standalone_annotation': lambda: Annotation(
+        'https://a', 'https://image', 'https://canvas', context=True
+    ),
+    'annotation_page': lambda: make_canvas(0).items[0],
+    'annotation_page_reference': lambda: make_canvas(0, reference=True).items[0],
+    'standalone_annotation_page': lambda: AnnotationPage('https://p', (), True),
+    'canvas': lambda: make_canvas(0),
+    'standalone_canvas': lambda: make_canvas(
+        0, part_of='https://iiif/manifest', context=True
+    ),
+    'manifest': make_manifest,
+    'manifest_with_references': lambda: make_manifest(reference=True),
+    'empty_manifest': lambda: make_manifest(0),
+}
+
+
+class TestSerialisation:
+    @pytest.mark.parametrize('name', RESOURCES)
+    def test_same_as_dict(self, name):
+        resource = RESOURCES[name]()
+        assert resource.to_json() == dumps(resource.to_dict())
+
+    @pytest.mark.parametrize('name', RESOURCES)
+    def test_same_as_dict_without_orjson(self, name):
+        with patch('ckanext.iiif.lib.serialisation.orjson', None):
+            resource = RESOURCES[name]()
+            assert resource.to_json() == dumps(resource.to_dict())
+
+    @pytest.mark.parametrize('name', RESOURCES)
+    def test_valid_json(self, name):
+        resource = RESOURCES[name]()
+        assert json.loads(resource.to_json()) == resource.to_dict()
+
+
+class TestManifest:
+    def test_dict(self):
+        manifest = make_manifest(2).to_dict()
+        assert list(manifest) == [
+            '@context',
+            'id',
+            'type',
+            'label',
+            'metadata',
+            'rights',
+            'items',
+            'logo',
+        ]
+        assert manifest['@context'] == CONTEXT
+        assert manifest['type'] == 'Manifest'
+        assert len(manifest['items']) == 2
+
+    @pytest.mark.parametrize('chunk_size', [1, 2, 3, 50])
+    def test_iter_json(self, chunk_size):
+        manifest = make_manifest(7)
+        chunks = list(manifest.iter_json(chunk_size))
+        assert b''.join(chunks) == manifest.to_json()
+        # the first chunk, a chunk for each group of canvases and the last chunk
+        assert len(chunks) == 2 + -(-7 // chunk_size)
+
+    def test_item_count(self):
+        assert make_manifest(4).item_count == 4
+
+
+class TestCanvas:
+    def test_dict(self):
+        canvas = make_canvas(3).to_dict()
+        assert canvas == {
+            'id': 'https://iiif/manifest/canvas/3',
+            'type': 'Canvas',
+            'width': 1000,
+            'height': 800,
+            'label': {'none': ['https://images/3']},
+            'items': [
+                {
+                    'id': 'https://iiif/manifest/canvas/3/0',
+                    'type': 'AnnotationPage',
+                    'items': [
+                        {
+                            'id': 'https://iiif/manifest/canvas/3/0/0',
+                            'type': 'Annotation',
+                            'motivation': 'painting',
+                            'body': {
+                                'id': 'https://images/3',
+                                'type': 'Image',
+                                'service': [
+                                    {
+                                        'id': 'https://images/3',
+                                        'type': 'ImageService3',
+                                        'profile': 'level2',
+                                    },
+                                ],
+                            },
+                            'target': 'https://iiif/manifest/canvas/3',
+                        }
+                    ],
+                }
+            ],
+        }
+
+    def test_standalone(self):
+        canvas = make_canvas(0, part_of='https://iiif/manifest', context=True)
+        canvas = canvas.to_dict()
+        assert list(canvas)[0] == '@context'
+        assert canvas['partOf'] == [{'id': 'https://iiif/manifest', 'type': 'Manifest'}]
+
+    def test_reference(self):
+        canvas = make_canvas(0, reference=True).to_dict()
+        assert canvas['items'] == [
+            {'id': 'https://iiif/manifest/canvas/0/0', 'type': 'AnnotationPage'}
+        ]
+
+
+def test_slots():
+    # the whole point of these classes is that they are compact, so none of them should
+    # have a __dict__
+    for name, make in RESOURCES.items():
+        assert not hasattr(make(), '__dict__'), name
+
+
+def test_default_serialisation():
+    class Custom(IIIFResource):
+        __slots__ = ()
+
+        def to_dict(self):
+            return {'beans': 3}
+
+    assert Custom().to_json() == b'{"beans":3}'
+    assert Custom().item_count == 0
+
+
+def test_to_dict_is_abstract():
+    with pytest.raises(TypeError):
+        IIIFResource()
@@ -0,0 +1,201 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from ckanext.iiif.builders.template import (
+    ManifestTemplate,
+    flatten,
+    get_template,
+    parse_fields,
+)
+from ckanext.iiif.builders.utils import wrap_language
+from ckanext.iiif.lib.cache import ManifestCache
+
+
+@pytest.fixture
+def templates():
+    templates = ManifestCache(max_size=10)
+    with patch('ckanext.iiif.builders.template.TEMPLATES', templates):
+        yield templates
+
+
+class TestGetTemplate:
+    def test_cached(self, templates):
+        resource = {'id': 'r1', 'metadata_modified': '2024-01-01T00:00:00'}
+        template = get_template(resource)
+        assert get_template(dict(resource)) is template
+        assert len(templates) == 1
+
+    def test_modified(self, templates):
+        resource = {
+            'id': 'r1',
+            'metadata_modified': '2024-01-01T00:00:00',
+            '_title_field': 'a',
+        }
+        template = get_template(resource)
+
+        modified = {
+            'id': 'r1',
+            'metadata_modified': '2024-01-02T00:00:00',
+            '_title_field': 'b',
+        }
+        new_template = get_template(modified)
+
+        assert new_template is not template
+        assert new_template.title_field == 'b'
+
+    @pytest.mark.parametrize(
+        'resource', [{}, {'id': 'r1'}, {'metadata_modified': '2024-01-01T00:00:00'}]
+    )
+    def test_not_cached(self, templates, resource):
+        assert get_template(resource) is not get_template(resource)
+        assert len(templates) == 0
+
+    def test_invalidate(self, templates):
+        resource = {'id': 'r1', 'metadata_modified': '2024-01-01T00:00:00'}
+        template = get_template(resource)
+        templates.invalidate('resource/r1/')
+        assert get_template(resource) is not template
+
+
+class TestManifestTemplate:
+    def test_rights(self):
+        template = ManifestTemplate({'_image_licence': 'cc-zero'})
+        with patch(
+            'ckanext.iiif.builders.template.get_licence_url',
+            return_value='http://licence',
+        ) as get_licence_url_mock:
+            assert template.rights == 'http://licence'
+        get_licence_url_mock.assert_called_once_with('cc-zero')
+
+    def test_default_rights(self):
+        template = ManifestTemplate({'_image_licence': ''})
+        assert template.licence_id == 'cc-by'
+
+    def test_logo_resolved_once(self):
+        template = ManifestTemplate({})
+        with patch(
+            'ckan.lib.helpers.url_for_static_or_external',
+            return_value='http://logo',
+        ) as url_mock:
+            logo = template.logo
+            assert template.logo is logo
+        url_mock.assert_called_once()
+        assert logo[0]['id'] == 'http://logo'
+
+    def test_build_label(self):
+        template = ManifestTemplate({'_title_field': 'name'})
+        assert template.build_label({'_id': 1, 'name': 'Bob'}) == wrap_language('Bob')
+        assert template.build_label({'_id': 1}) == wrap_language('1')
+
+    def test_get_images_empty_list(self):
+        template = ManifestTemplate({'_image_field': 'images'})
+        assert template.get_images({'images': []}) == []
+
+
+class TestParseFields:
+    @pytest.mark.parametrize(
+        ('value', 'expected'),
+        [
+            (None, []),
+            ('', []),
+            ('a', ['a']),
+            ('a, b ,c,', ['a', 'b', 'c']),
+            (['a', ' b'], ['a', 'b']),
+        ],
+    )
+    def test_parse(self, value, expected):
+        assert parse_fields(value) == expected
+
+
+class TestFlatten:
+    def test_scalar(self):
+        assert list(flatten('a', 1)) == [('a', 1)]
+
+    def test_none(self):
+        assert list(flatten('a', None)) == []
+
+    def test_nested(self):
+        value = {'b': {'c': 1, 'd': [2, 3]}, 'e': [{'f': 4}, {'f': 5, 'g': None}]}
+        assert list(flatten('a', value)) == [
+            ('a.b.c', 1),
+            ('a.b.d', 2),
+            ('a.b.d', 3),
+            ('a.e.f', 4),
+            ('a.e.f', 5),
+        ]
+
+
+class TestBuildMetadata:
+    def test_all_fields(self):
+        template = ManifestTemplate({})
+        metadata = template.build_metadata({'a': 1, 'b': 'x'})
+        assert metadata == [
+            {'label': wrap_language('a'), 'value': wrap_language('1')},
+            {'label': wrap_language('b'), 'value': wrap_language('x')},
+        ]
+
+    def test_nested_lists_combined(self):
+        template = ManifestTemplate({})
+        record = {'media': [{'title': 'one', 'id': 1}, {'title': 'two'}]}
+        assert template.build_metadata(record) == [
+            {
+                'label': wrap_language('media.title'),
+                'value': wrap_language(['one', 'two']),
+            },
+            {'label': wrap_language('media.id'), 'value': wrap_language('1')},
+        ]
+
+    def test_allowlist(self):
+        template = ManifestTemplate({'_metadata_fields': 'c,a,missing'})
+        metadata = template.build_metadata({'a': 1, 'b': 2, 'c': 3})
+        assert [entry['label'] for entry in metadata] == [
+            wrap_language('c'),
+            wrap_language('a'),
+        ]
+
+    def test_denylist(self):
+        template = ManifestTemplate({'_metadata_exclude': ['b', 'c.x']})
+        metadata = template.build_metadata({'a': 1, 'b': 2, 'c': {'x': 1, 'y': 2}})
+        assert [entry['label'] for entry in metadata] == [
+            wrap_language('a'),
+            wrap_language('c.y'),
+        ]
+
+    def test_excluded_values_not_stringified(self):
+        value = MagicMock()
+        template = ManifestTemplate({'_metadata_exclude': 'b'})
+        template.build_metadata({'a': 1, 'b': value})
+        value.__str__.assert_not_called()
+
+    @pytest.mark.ckan_config('ckanext.iiif.metadata.max_value_length', '5')
+    def test_max_value_length(self):
+        template = ManifestTemplate({})
+        metadata = template.build_metadata({'a': 'abcdefgh', 'b': 'abc'})
+        assert metadata == [
+            {'label': wrap_language('a'), 'value': wrap_language('abcde…')},
+            {'label': wrap_language('b'), 'value': wrap_language('abc')},
+        ]
+
+    @pytest.mark.ckan_config('ckanext.iiif.metadata.max_length', '5')
+    def test_max_length(self):
+        value = MagicMock()
+        template = ManifestTemplate({})
+        metadata = template.build_metadata({'a': 'abc', 'b': 'abc', 'c': value})
+        assert metadata == [
+            {'label': wrap_language('a'), 'value': wrap_language('abc')},
+        ]
+        value.__str__.assert_not_called()
+
+    def test_no_caps_by_default(self):
+        template = ManifestTemplate({})
+        assert template.max_value_length == 0
+        assert template.max_metadata_length == 0
+
+    @pytest.mark.ckan_config('ckanext.iiif.metadata.max_value_length', '0')
+    @pytest.mark.ckan_config('ckanext.iiif.metadata.max_length', '0')
+    def test_no_caps(self):
+        template = ManifestTemplate({})
+        value = 'a' * 100000
+        metadata = template.build_metadata({'a': value})
+        assert metadata[0]['value'] == wrap_language(value)
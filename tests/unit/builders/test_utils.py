@@ -1,6 +1,11 @@
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+import pytest
+from ckan.plugins import toolkit
 from mock import MagicMock
 
-from ckanext.iiif.builders.utils import wrap_language
+from ckanext.iiif.builders.utils import create_id_url, get_modified, wrap_language
 
 
 def test_wrap_language():
@@ -11,3 +16,65 @@ def test_wrap_language():
     assert wrap_language(test_value) == {'none': [test_value]}
     assert wrap_language([test_value]) == {'none': [test_value]}
     assert wrap_language(test_value, language='beans') == {'beans': [test_value]}
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'iiif')
+@pytest.mark.usefixtures('with_plugins', 'with_request_context')
+class TestCreateIDURL:
+    @pytest.mark.parametrize(
+        'identifier',
+        [
+            'resource/1/record/2',
+            'resource/1/record/2/canvas/3',
+            'with spaces/and?query#fragment%percent',
+            'ünïcødé/record/ø',
+            'punctuation/!$&\'()*+,;=@:~[]{}"<>|^`',
+        ],
+    )
+    def test_matches_url_for(self, identifier):
+        assert create_id_url(identifier) == toolkit.url_for(
+            'iiif.resource', identifier=identifier, _external=True
+        )
+
+    def test_url_for_called_once(self):
+        with patch(
+            'ckanext.iiif.builders.utils.toolkit.url_for', wraps=toolkit.url_for
+        ) as url_for_mock:
+            for i in range(10):
+                create_id_url(f'resource/1/record/{i}')
+        assert url_for_mock.call_count == 1
+
+
+# 2024-05-01T12:00:00 UTC in milliseconds
+VERSION = 1714564800000
+
+
+@pytest.mark.parametrize(
+    'resource,version,expected',
+    [
+        (
+            {'metadata_modified': '2024-05-01T12:30:15.123456'},
+            VERSION,
+            datetime(2024, 5, 1, 12, 30, 15, 123456, timezone.utc),
+        ),
+        (
+            {'metadata_modified': '2024-05-01T12:30:15+00:00'},
+            VERSION,
+            datetime(2024, 5, 1, 12, 30, 15, tzinfo=timezone.utc),
+        ),
+        # the record was updated after the resource
+        (
+            {'metadata_modified': '2024-04-01T09:00:00'},
+            VERSION + 1500,
+            datetime(2024, 5, 1, 12, 0, 1, 500000, timezone.utc),
+        ),
+        # updating a record doesn't change the resource's metadata_modified so without
+        # the record's version the modification time isn't known
+        ({'metadata_modified': '2024-05-01T12:30:15'}, None, None),
+        ({'metadata_modified': 'beans'}, VERSION, None),
+        ({'metadata_modified': None}, VERSION, None),
+        ({}, VERSION, None),
+    ],
+)
+def test_get_modified(resource, version, expected):
+    assert get_modified(resource, version) == expected
@@ -0,0 +1,364 @@
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+import redis
+
+from ckanext.iiif.lib.cache import (
+    ManifestCache,
+    RedisCache,
+    SQLiteCache,
+    connect_to_redis_url,
+    escape_pattern,
+    resource_prefix,
+)
+from ckanext.iiif.lib.resources import BuiltResource
+from tests.helpers.redis_server import StubRedisServer
+
+
+@pytest.fixture
+def redis_server():
+    with StubRedisServer() as server:
+        yield server
+
+
+def make_sqlite_cache(tmp_path, **kwargs):
+    return SQLiteCache(
+        str(tmp_path / 'cache.db'), dump=str.encode, load=bytes.decode, **kwargs
+    )
+
+
+def make_redis_cache(server, **kwargs):
+    return RedisCache(
+        lambda: redis.Redis.from_url(server.url),
+        dump=str.encode,
+        load=bytes.decode,
+        **kwargs,
+    )
+
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def make_shared_cache(request, tmp_path):
+    """
+    Returns a function creating a cache with one of the shared backends. Each cache
+    created by the function shares its storage with the others, like the caches in
+    separate processes would.
+    """
+    if request.param == 'sqlite':
+        yield lambda **kwargs: make_sqlite_cache(tmp_path, **kwargs)
+    else:
+        with StubRedisServer() as server:
+            yield lambda **kwargs: make_redis_cache(server, **kwargs)
+
+
+class TestManifestCache:
+    def test_disabled(self):
+        cache = ManifestCache(max_size=0)
+        cache.set('test', {'beans': 3})
+        assert not cache.enabled
+        assert cache.get('test') is None
+        assert len(cache) == 0
+
+    def test_get_and_set(self):
+        cache = ManifestCache(max_size=10)
+        value = {'beans': 3}
+        cache.set('test', value)
+        assert cache.get('test') is value
+        assert cache.get('missing') is None
+
+    def test_hits_and_misses(self):
+        cache = ManifestCache(max_size=10)
+        cache.set('test', 1)
+        cache.get('test')
+        cache.get('test')
+        cache.get('missing')
+        assert cache.hits == 2
+        assert cache.misses == 1
+
+    def test_lru_eviction(self):
+        cache = ManifestCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # access a so that b becomes the least recently used entry
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        assert len(cache) == 2
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+        assert cache.get('c') == 3
+
+    def test_ttl(self):
+        cache = ManifestCache(max_size=10, ttl=60)
+        with patch('ckanext.iiif.lib.cache.time.monotonic', return_value=1000):
+            cache.set('test', 1)
+        with patch('ckanext.iiif.lib.cache.time.monotonic', return_value=1059):
+            assert cache.get('test') == 1
+        with patch('ckanext.iiif.lib.cache.time.monotonic', return_value=1060):
+            assert cache.get('test') is None
+        assert len(cache) == 0
+
+    def test_entry_ttl(self):
+        cache = ManifestCache(max_size=10, ttl=60)
+        with patch('ckanext.iiif.lib.cache.time.monotonic', return_value=1000):
+            cache.set('short', 1, ttl=10)
+            cache.set('forever', 2, ttl=0)
+        with patch('ckanext.iiif.lib.cache.time.monotonic', return_value=1010):
+            assert cache.get('short') is None
+            assert cache.get('forever') == 2
+
+    def test_no_ttl(self):
+        cache = ManifestCache(max_size=10, ttl=0)
+        with patch('ckanext.iiif.lib.cache.time.monotonic', return_value=1000):
+            cache.set('test', 1)
+        with patch('ckanext.iiif.lib.cache.time.monotonic', return_value=10**9):
+            assert cache.get('test') == 1
+
+    def test_invalidate(self):
+        cache = ManifestCache(max_size=10)
+        cache.set('resource/1/record/1', 1)
+        cache.set('resource/1/record/2', 2)
+        cache.set('resource/10/record/1', 3)
+        assert cache.invalidate(resource_prefix('1')) == 2
+        assert cache.get('resource/1/record/1') is None
+        assert cache.get('resource/1/record/2') is None
+        assert cache.get('resource/10/record/1') == 3
+
+    def test_clear(self):
+        cache = ManifestCache(max_size=10)
+        cache.set('a', 1)
+        cache.clear()
+        assert len(cache) == 0
+
+
+class TestSharedCaches:
+    def test_get_and_set(self, make_shared_cache):
+        cache = make_shared_cache()
+        assert cache.enabled
+        cache.set('test', 'beans')
+        assert cache.get('test') == 'beans'
+        assert cache.get('missing') is None
+        assert cache.hits == 1
+        assert cache.misses == 1
+
+    def test_shared(self, make_shared_cache):
+        make_shared_cache().set('test', 'beans')
+        assert make_shared_cache().get('test') == 'beans'
+
+    def test_replace(self, make_shared_cache):
+        cache = make_shared_cache()
+        cache.set('test', 'beans')
+        cache.set('test', 'arms')
+        assert cache.get('test') == 'arms'
+        assert len(cache) == 1
+
+    def test_ttl(self, make_shared_cache):
+        cache = make_shared_cache(ttl=0.05)
+        cache.set('test', 'beans')
+        cache.set('forever', 'arms', ttl=0)
+        assert cache.get('test') == 'beans'
+        time.sleep(0.1)
+        assert cache.get('test') is None
+        assert cache.get('forever') == 'arms'
+        assert len(cache) == 1
+
+    def test_entry_ttl(self, make_shared_cache):
+        cache = make_shared_cache(ttl=60)
+        cache.set('test', 'beans', ttl=0.05)
+        time.sleep(0.1)
+        assert cache.get('test') is None
+
+    def test_invalidate(self, make_shared_cache):
+        cache = make_shared_cache()
+        cache.set('resource/1/record/1', '1')
+        cache.set('resource/1/record/2', '2')
+        cache.set('resource/10/record/1', '3')
+        assert make_shared_cache().invalidate(resource_prefix('1')) == 2
+        assert cache.get('resource/1/record/1') is None
+        assert cache.get('resource/1/record/2') is None
+        assert cache.get('resource/10/record/1') == '3'
+
+    def test_invalidate_special_characters(self, make_shared_cache):
+        cache = make_shared_cache()
+        cache.set('resource/*/record/1', '1')
+        cache.set('resource/a/record/1', '2')
+        assert cache.invalidate('resource/*/') == 1
+        assert cache.get('resource/a/record/1') == '2'
+
+    def test_clear(self, make_shared_cache):
+        cache = make_shared_cache()
+        cache.set('a', '1')
+        cache.set('b', '2')
+        cache.clear()
+        assert len(cache) == 0
+
+    def test_threads(self, make_shared_cache):
+        cache = make_shared_cache()
+        errors = []
+
+        def work(number):
+            try:
+                for i in range(20):
+                    cache.set(f'{number}/{i}', str(i))
+                    assert cache.get(f'{number}/{i}') == str(i)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        assert not errors
+        assert len(cache) == 80
+
+    def test_stats_threads(self, make_shared_cache):
+        cache = make_shared_cache()
+        cache.set('a', '1')
+
+        def work():
+            for _ in range(50):
+                cache.get('a')
+                cache.get('b')
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        assert cache.hits == 200
+        assert cache.misses == 200
+
+    def test_built_resources(self, make_shared_cache):
+        cache = make_shared_cache()
+        cache.dump = BuiltResource.dump
+        cache.load = BuiltResource.load
+        built = BuiltResource({'id': 'beans', 'items': [1, 2]})
+        cache.set('test', built)
+
+        cached = cache.get('test')
+        assert cached is not built
+        assert cached.body == built.body
+        assert cached.etag == built.etag
+        assert cached.data == built.data
+
+
+class TestSQLiteCache:
+    def test_max_size(self, tmp_path):
+        cache = make_sqlite_cache(tmp_path, max_size=2)
+        cache.set('a', '1')
+        cache.set('b', '2')
+        # setting a again makes b the least recently set entry
+        cache.set('a', '1')
+        cache.set('c', '3')
+        assert len(cache) == 2
+        assert cache.get('a') == '1'
+        assert cache.get('b') is None
+        assert cache.get('c') == '3'
+
+    def test_max_size_without_counting(self, tmp_path):
+        cache = make_sqlite_cache(tmp_path, max_size=2)
+        statements = []
+        cache.connection.set_trace_callback(statements.append)
+        for identifier in 'abcd':
+            cache.set(identifier, '1')
+        assert not any('count(' in statement for statement in statements)
+        assert len(cache) == 2
+        assert cache.get('c') == '1'
+        assert cache.get('d') == '1'
+
+    def test_size(self, tmp_path):
+        cache = make_sqlite_cache(tmp_path)
+        cache.set('a', '1')
+        assert cache.size == 1
+
+    def test_expired_removed(self, tmp_path):
+        cache = make_sqlite_cache(tmp_path, ttl=60)
+        with patch('ckanext.iiif.lib.cache.time.time', return_value=1000):
+            cache.set('a', '1')
+        with patch('ckanext.iiif.lib.cache.time.time', return_value=1060):
+            cache.set('b', '2')
+        rows = cache.connection.execute('select identifier from entries').fetchall()
+        assert rows == [('b',)]
+
+    def test_errors_are_misses(self, tmp_path):
+        cache = make_sqlite_cache(tmp_path, ttl=60)
+        cache.set('a', '1')
+        cache.load = MagicMock(side_effect=ValueError())
+        assert cache.get('a') is None
+        assert cache.misses == 1
+
+    def test_clear_errors_logged(self, tmp_path):
+        cache = make_sqlite_cache(tmp_path)
+        cache.connection.execute('drop table entries')
+        cache.clear()
+
+    def test_unwritable(self, tmp_path):
+        cache = make_sqlite_cache(tmp_path)
+        cache.dump = MagicMock(side_effect=ValueError())
+        cache.set('a', '1')
+        assert cache.get('a') is None
+
+
+class TestRedisCache:
+    def test_ttl_set_on_key(self, redis_server):
+        cache = make_redis_cache(redis_server, ttl=60)
+        cache.set('test', 'beans')
+        cache.set('forever', 'beans', ttl=0)
+        client = redis.Redis.from_url(redis_server.url)
+        assert 59000 < client.pttl('ckanext-iiif:cache:test') <= 60000
+        assert client.pttl('ckanext-iiif:cache:forever') == -1
+
+    def test_prefix(self, redis_server):
+        cache = make_redis_cache(redis_server, prefix='beans:')
+        cache.set('test', 'beans')
+        assert redis_server.data == {b'beans:test': b'beans'}
+
+    def test_other_keys_untouched(self, redis_server):
+        redis_server.data[b'someone-else'] = b'theirs'
+        cache = make_redis_cache(redis_server)
+        cache.set('test', 'beans')
+        assert len(cache) == 1
+        cache.clear()
+        assert redis_server.data == {b'someone-else': b'theirs'}
+
+    def test_size_not_counted(self, redis_server):
+        cache = make_redis_cache(redis_server)
+        cache.set('test', 'beans')
+        assert cache.size is None
+        assert not any(
+            command[0].upper() == b'SCAN' for command in redis_server.commands
+        )
+
+    def test_invalidate_many(self, redis_server):
+        cache = make_redis_cache(redis_server)
+        for i in range(2500):
+            cache.set(f'resource/1/record/{i}', 'beans')
+        assert cache.invalidate(resource_prefix('1')) == 2500
+        assert not redis_server.data
+
+    def test_redis_unavailable(self):
+        cache = RedisCache(
+            MagicMock(side_effect=ConnectionError()), str.encode, bytes.decode
+        )
+        cache.set('test', 'beans')
+        assert cache.get('test') is None
+        assert cache.invalidate('test') == 0
+        cache.clear()
+        assert cache.misses == 1
+
+    def test_connects_lazily(self, redis_server):
+        connect = MagicMock(return_value=redis.Redis.from_url(redis_server.url))
+        cache = RedisCache(connect, str.encode, bytes.decode)
+        connect.assert_not_called()
+        cache.set('a', 'beans')
+        cache.get('a')
+        connect.assert_called_once()
+
+    def test_connect_to_url(self, redis_server):
+        client = connect_to_redis_url(redis_server.url)
+        assert client.ping()
+
+
+def test_escape_pattern():
+    assert escape_pattern('a*b?c[d]e\\f') == 'a\\*b\\?c\\[d\\]e\\\\f'
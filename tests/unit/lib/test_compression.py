@@ -0,0 +1,27 @@
+import gzip
+
+from ckanext.iiif.lib.compression import COMPRESSORS, SUFFIXES, iter_gzip
+
+
+class TestCompressors:
+    def test_gzip(self):
+        body = b'{"beans":3}' * 100
+        compressed = COMPRESSORS['gzip'](body)
+        assert len(compressed) < len(body)
+        assert gzip.decompress(compressed) == body
+
+    def test_gzip_is_stable(self):
+        body = b'{"beans":3}'
+        assert COMPRESSORS['gzip'](body) == COMPRESSORS['gzip'](body)
+
+    def test_suffixes(self):
+        assert all(encoding in SUFFIXES for encoding in COMPRESSORS)
+
+
+class TestIterGzip:
+    def test_chunks(self):
+        chunks = [b'{"items":[', b'1,' * 1000, b'2]}']
+        assert gzip.decompress(b''.join(iter_gzip(chunks))) == b''.join(chunks)
+
+    def test_empty(self):
+        assert gzip.decompress(b''.join(iter_gzip([]))) == b''
@@ -0,0 +1,158 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from ckanext.iiif.lib.concurrency import (
+    action_context,
+    current_user,
+    run_async,
+    run_in_thread,
+)
+
+variable = contextvars.ContextVar('test_variable', default=None)
+
+
+class ThreadLocalRequest:
+    """
+    Stands in for CKAN's c on older versions of Flask, where the request is only
+    available in the thread handling it.
+    """
+
+    def __init__(self, user):
+        self._user = user
+        self._thread = threading.get_ident()
+
+    @property
+    def user(self):
+        if threading.get_ident() != self._thread:
+            raise RuntimeError('Working outside of request context')
+        return self._user
+
+
+@pytest.fixture
+def request_user():
+    def set_user(user):
+        return patch('ckanext.iiif.lib.concurrency.toolkit.c', ThreadLocalRequest(user))
+
+    return set_user
+
+
+class TestRunAsync:
+    def test_result(self):
+        async def add(a, b):
+            await asyncio.sleep(0)
+            return a + b
+
+        assert run_async(add(1, 2)) == 3
+
+    def test_error(self):
+        async def error():
+            raise ValueError('oh no!')
+
+        with pytest.raises(ValueError, match='oh no!'):
+            run_async(error())
+
+    def test_loop_reused(self):
+        async def get_loop():
+            return asyncio.get_running_loop()
+
+        assert run_async(get_loop()) is run_async(get_loop())
+
+    def test_in_running_loop(self):
+        async def inner():
+            return variable.get()
+
+        async def outer():
+            variable.set('beans')
+            return run_async(inner())
+
+        assert asyncio.run(outer()) == 'beans'
+
+
+class TestRunInThread:
+    def test_result(self):
+        async def call():
+            return await run_in_thread(lambda a, b=0: a + b, 1, b=2)
+
+        with patch('ckan.model.Session'):
+            assert run_async(call()) == 3
+
+    def test_other_thread(self):
+        async def call():
+            return await run_in_thread(threading.get_ident)
+
+        with patch('ckan.model.Session'):
+            assert run_async(call()) != threading.get_ident()
+
+    def test_context(self):
+        async def call():
+            variable.set('beans')
+            return await run_in_thread(variable.get)
+
+        with patch('ckan.model.Session'):
+            assert run_async(call()) == 'beans'
+
+    def test_concurrent(self):
+        barrier = threading.Barrier(3, timeout=5)
+
+        async def call():
+            return await asyncio.gather(
+                *(run_in_thread(barrier.wait) for _ in range(3))
+            )
+
+        with patch('ckan.model.Session'):
+            assert sorted(run_async(call())) == [0, 1, 2]
+
+    def test_session_removed(self):
+        model = MagicMock()
+
+        async def call():
+            await run_in_thread(MagicMock(side_effect=ValueError()))
+
+        with patch('ckan.model.Session', model.Session):
+            with pytest.raises(ValueError):
+                run_async(call())
+
+        model.Session.remove.assert_called_once()
+
+
+class TestCurrentUser:
+    def test_no_request(self, request_user):
+        with request_user('beans'):
+            # a thread that isn't handling a request
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                assert executor.submit(current_user).result() is None
+                assert executor.submit(action_context).result() == {}
+
+    def test_user(self, request_user):
+        with request_user('beans'):
+            assert current_user() == 'beans'
+            assert action_context() == {'user': 'beans'}
+
+    @pytest.mark.parametrize('user', [None, ''])
+    def test_anonymous(self, request_user, user):
+        with request_user(user):
+            assert current_user() == ''
+            assert action_context() == {'user': ''}
+
+    def test_carried_into_thread(self, request_user):
+        async def call():
+            return await run_in_thread(action_context)
+
+        with request_user('beans'), patch('ckan.model.Session'):
+            assert run_async(call()) == {'user': 'beans'}
+
+    def test_carried_into_running_loop(self, request_user):
+        async def inner():
+            return current_user()
+
+        async def outer():
+            # this runs run_async in a new thread as this one is already running a loop
+            return run_async(inner())
+
+        with request_user('beans'):
+            assert asyncio.run(outer()) == 'beans'
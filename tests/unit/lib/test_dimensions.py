@@ -0,0 +1,118 @@
+import time
+from unittest.mock import patch
+
+import pytest
+
+from ckanext.iiif.lib import dimensions
+from ckanext.iiif.lib.dimensions import (
+    DimensionResolver,
+    DimensionStore,
+    resolve_dimensions,
+)
+from tests.helpers.image_server import StubImageServer
+
+
+@pytest.fixture
+def server():
+    with StubImageServer() as server:
+        yield server
+
+
+class TestDimensionStore:
+    def test_memory(self):
+        store = DimensionStore()
+        store.set_many({'a': (1, 2), 'b': (3, 4)})
+        assert store.get_many(['a', 'c']) == {'a': (1, 2)}
+
+    def test_sqlite(self, tmp_path):
+        path = str(tmp_path / 'dimensions.db')
+        DimensionStore(path).set_many({'a': (1, 2), 'b': (3, 4)})
+        # a new store with the same path should see the stored dimensions
+        assert DimensionStore(path).get_many(['a', 'b', 'c']) == {
+            'a': (1, 2),
+            'b': (3, 4),
+        }
+
+    def test_sqlite_many(self, tmp_path):
+        store = DimensionStore(str(tmp_path / 'dimensions.db'))
+        store.set_many({str(i): (i, i) for i in range(1200)})
+        assert len(store.get_many(map(str, range(1500)))) == 1200
+
+
+class TestDimensionResolver:
+    def test_resolve(self, server):
+        server.images['/a'] = (100, 200)
+        server.images['/b'] = (300, 400)
+        resolver = DimensionResolver(DimensionStore())
+
+        resolved = resolver.resolve(
+            [server.image_id('/a'), server.image_id('/b'), server.image_id('/c')]
+        )
+
+        assert resolved == {
+            server.image_id('/a'): (100, 200),
+            server.image_id('/b'): (300, 400),
+        }
+
+    def test_only_fetched_once(self, server):
+        server.images['/a'] = (100, 200)
+        resolver = DimensionResolver(DimensionStore())
+
+        resolver.resolve([server.image_id('/a')])
+        resolver.resolve([server.image_id('/a'), server.image_id('/a')])
+
+        assert server.requests == ['/a/info.json']
+
+    def test_failures_not_stored(self, server):
+        store = DimensionStore()
+        resolver = DimensionResolver(store)
+        resolver.resolve([server.image_id('/missing')])
+        assert store.get_many([server.image_id('/missing')]) == {}
+
+    def test_concurrent(self, server):
+        server.delay = 0.5
+        for i in range(8):
+            server.images[f'/{i}'] = (i, i)
+            server.slow.add(f'/{i}')
+        resolver = DimensionResolver(DimensionStore(), timeout=5, workers=8)
+
+        start = time.monotonic()
+        resolved = resolver.resolve([server.image_id(f'/{i}') for i in range(8)])
+
+        assert len(resolved) == 8
+        # done one after the other this would take 4 seconds
+        assert time.monotonic() - start < 2
+
+    def test_timeout(self, server):
+        server.delay = 2
+        server.images['/fast'] = (1, 2)
+        server.images['/slow'] = (3, 4)
+        server.slow.add('/slow')
+        resolver = DimensionResolver(DimensionStore(), timeout=0.5)
+
+        start = time.monotonic()
+        resolved = resolver.resolve(
+            [server.image_id('/fast'), server.image_id('/slow')]
+        )
+
+        assert resolved == {server.image_id('/fast'): (1, 2)}
+        assert time.monotonic() - start < 1.5
+
+    def test_invalid_info(self):
+        resolver = DimensionResolver(DimensionStore())
+        with patch.object(resolver, 'fetch', return_value=None):
+            assert resolver.resolve(['a']) == {}
+
+
+class TestResolveDimensions:
+    def test_disabled(self):
+        with patch.object(dimensions, 'RESOLVER', None):
+            assert resolve_dimensions(['a']) == {}
+
+    def test_enabled(self, server):
+        server.images['/a'] = (1, 2)
+        resolver = DimensionResolver(DimensionStore())
+        with patch.object(dimensions, 'RESOLVER', resolver):
+            assert resolve_dimensions([server.image_id('/a')]) == {
+                server.image_id('/a'): (1, 2)
+            }
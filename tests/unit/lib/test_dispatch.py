@@ -0,0 +1,138 @@
+from collections import OrderedDict
+from typing import Optional
+from unittest.mock import MagicMock
+
+from ckanext.iiif.builders.abc import IIIFResourceBuilder
+from ckanext.iiif.lib.dispatch import (
+    BuilderIndex,
+    get_prefixes,
+    get_resource_id,
+    iter_candidates,
+)
+
+
+class MockBuilder(IIIFResourceBuilder):
+    def __init__(self, *prefixes: str):
+        self.prefixes = prefixes
+
+    def match_and_build(self, identifier: str) -> Optional[dict]:
+        return None
+
+    def build_identifier(self, **kwargs) -> str:
+        return ''
+
+
+def test_get_resource_id():
+    assert get_resource_id('resource/1/record/2') == '1'
+    assert get_resource_id('resource/1/record/2/canvas/0') == '1'
+    assert get_resource_id('resource/1') == '1'
+    assert get_resource_id('resource') is None
+    assert get_resource_id('resource/') is None
+    assert get_resource_id('other/1') is None
+    assert get_resource_id('') is None
+
+
+def test_get_prefixes():
+    assert get_prefixes(MockBuilder('a', 'b')) == ('a', 'b')
+    assert get_prefixes(MockBuilder()) == ()
+    # builders which don't subclass the base class can't declare prefixes
+    assert get_prefixes(MagicMock()) == ()
+
+
+class TestBuilderIndex:
+    def test_candidates(self):
+        resource_builder = MockBuilder('resource')
+        other_builder = MockBuilder('other', 'resource')
+        index = BuilderIndex(
+            OrderedDict(resource=resource_builder, other=other_builder)
+        )
+        assert index.candidates('resource/1/record/2') == [
+            resource_builder,
+            other_builder,
+        ]
+        assert index.candidates('other/1') == [other_builder]
+        assert index.candidates('unknown/1') == []
+
+    def test_multi_segment_prefixes(self):
+        record_builder = MockBuilder('resource/*/record')
+        canvas_builder = MockBuilder('resource/*/record/*/canvas')
+        collection_builder = MockBuilder('resource/*/collection')
+        index = BuilderIndex(
+            OrderedDict(
+                canvas=canvas_builder,
+                record=record_builder,
+                collection=collection_builder,
+            )
+        )
+        assert index.candidates('resource/1/record/2') == [record_builder]
+        assert index.candidates('resource/1/record/2/canvas/0') == [
+            canvas_builder,
+            record_builder,
+        ]
+        assert index.candidates('resource/1/collection') == [collection_builder]
+        assert index.candidates('resource/1/collection/10') == [collection_builder]
+        assert index.candidates('resource/1') == []
+        assert index.candidates('resource') == []
+        assert index.candidates('other/1/record/2') == []
+
+    def test_literal_and_wildcard_segments(self):
+        literal_builder = MockBuilder('resource/special')
+        wildcard_builder = MockBuilder('resource/*')
+        index = BuilderIndex(
+            OrderedDict(wildcard=wildcard_builder, literal=literal_builder)
+        )
+        assert index.candidates('resource/special/1') == [
+            wildcard_builder,
+            literal_builder,
+        ]
+        assert index.candidates('resource/1') == [wildcard_builder]
+
+    def test_unprefixed_builders_always_included_in_order(self):
+        unprefixed_1 = MockBuilder()
+        resource_builder = MockBuilder('resource')
+        unprefixed_2 = MagicMock()
+        index = BuilderIndex(
+            OrderedDict(
+                unprefixed_1=unprefixed_1,
+                resource=resource_builder,
+                unprefixed_2=unprefixed_2,
+            )
+        )
+        assert index.candidates('resource/1') == [
+            unprefixed_1,
+            resource_builder,
+            unprefixed_2,
+        ]
+        assert index.candidates('unknown/1') == [unprefixed_1, unprefixed_2]
+
+    def test_is_current(self):
+        builders = OrderedDict(resource=MockBuilder('resource'))
+        index = BuilderIndex(builders)
+        assert index.is_current(builders)
+        assert not index.is_current(OrderedDict(builders))
+        builders['other'] = MockBuilder('other')
+        assert not index.is_current(builders)
+
+
+class TestIterCandidates:
+    def test_no_index(self):
+        builders = OrderedDict(resource=MockBuilder('resource'))
+        assert list(iter_candidates(None, builders, 'other/1')) == [
+            builders['resource']
+        ]
+
+    def test_stale_index(self):
+        builders = OrderedDict(resource=MockBuilder('resource'))
+        index = BuilderIndex(builders)
+        new_builders = OrderedDict(other=MockBuilder('other'))
+        assert list(iter_candidates(index, new_builders, 'resource/1')) == [
+            new_builders['other']
+        ]
+
+    def test_current_index(self):
+        builders = OrderedDict(resource=MockBuilder('resource'))
+        index = BuilderIndex(builders)
+        assert list(iter_candidates(index, builders, 'other/1')) == []
+        assert list(iter_candidates(index, builders, 'resource/1')) == [
+            builders['resource']
+        ]
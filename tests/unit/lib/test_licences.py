@@ -0,0 +1,62 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from ckanext.iiif.lib.licences import LicenceIndex
+
+
+def make_register(**urls):
+    return {licence_id: MagicMock(url=url) for licence_id, url in urls.items()}
+
+
+@pytest.fixture
+def register_mock():
+    with patch(
+        'ckan.model.Package.get_license_register',
+        return_value=make_register(a='http://a', b='http://b'),
+    ) as register_mock:
+        yield register_mock
+
+
+class TestLicenceIndex:
+    def test_get_url(self, register_mock):
+        index = LicenceIndex()
+        assert index.get_url('a') == 'http://a'
+        assert index.get_url('b') == 'http://b'
+        register_mock.assert_called_once()
+
+    def test_unknown(self, register_mock):
+        assert LicenceIndex().get_url('c') is None
+
+    def test_never_refreshed(self, register_mock):
+        index = LicenceIndex(refresh_interval=0)
+        index.get_url('a')
+        with patch('ckanext.iiif.lib.licences.time.monotonic', return_value=10**9):
+            index.get_url('a')
+        register_mock.assert_called_once()
+
+    def test_refreshed(self, register_mock):
+        index = LicenceIndex(refresh_interval=10)
+        with patch('ckanext.iiif.lib.licences.time.monotonic', return_value=100):
+            index.get_url('a')
+        register_mock.configure_mock(return_value=make_register(a='http://new'))
+        with patch('ckanext.iiif.lib.licences.time.monotonic', return_value=105):
+            assert index.get_url('a') == 'http://a'
+        with patch('ckanext.iiif.lib.licences.time.monotonic', return_value=110):
+            assert index.get_url('a') == 'http://new'
+        assert register_mock.call_count == 2
+
+    def test_failed_refresh_keeps_index(self, register_mock):
+        index = LicenceIndex(refresh_interval=10)
+        with patch('ckanext.iiif.lib.licences.time.monotonic', return_value=100):
+            index.get_url('a')
+        register_mock.configure_mock(side_effect=Exception('oh no'))
+        with patch('ckanext.iiif.lib.licences.time.monotonic', return_value=200):
+            assert index.get_url('a') == 'http://a'
+            # the failed refresh still counts as a refresh so it isn't retried at once
+            assert not index.stale
+
+    def test_failed_first_build(self, register_mock):
+        register_mock.configure_mock(side_effect=Exception('oh no'))
+        with pytest.raises(Exception, match='oh no'):
+            LicenceIndex().get_url('a')
@@ -0,0 +1,108 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from ckanext.iiif.lib.cache import ManifestCache
+from ckanext.iiif.lib.metrics import (
+    Gauge,
+    Histogram,
+    Metric,
+    MetricsRegistry,
+    _collect_caches,
+    _hit_ratio,
+)
+
+
+class TestHistogram:
+    def test_observe(self):
+        histogram = Histogram('test_seconds', 'A test.', ('outcome',), (0.1, 1))
+        histogram.observe(0.05, outcome='ok')
+        histogram.observe(0.5, outcome='ok')
+        histogram.observe(5, outcome='ok')
+        histogram.observe(0.1, outcome='error')
+
+        assert list(histogram.render()) == [
+            '# HELP test_seconds A test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{outcome="ok",le="0.1"} 1',
+            'test_seconds_bucket{outcome="ok",le="1"} 2',
+            'test_seconds_bucket{outcome="ok",le="+Inf"} 3',
+            'test_seconds_sum{outcome="ok"} 5.55',
+            'test_seconds_count{outcome="ok"} 3',
+            'test_seconds_bucket{outcome="error",le="0.1"} 1',
+            'test_seconds_bucket{outcome="error",le="1"} 1',
+            'test_seconds_bucket{outcome="error",le="+Inf"} 1',
+            'test_seconds_sum{outcome="error"} 0.1',
+            'test_seconds_count{outcome="error"} 1',
+        ]
+
+    def test_time(self):
+        histogram = Histogram('test_seconds', 'A test.', ('outcome',))
+        with histogram.time() as labels:
+            labels['outcome'] = 'ok'
+        assert histogram.get_count(outcome='ok') == 1
+
+    def test_time_error(self):
+        histogram = Histogram('test_seconds', 'A test.', ('outcome',))
+        with pytest.raises(ValueError):
+            with histogram.time():
+                raise ValueError('oh no!')
+        assert histogram.get_count(outcome='error') == 1
+
+    def test_escaped_labels(self):
+        histogram = Histogram('test_seconds', 'A test.', ('builder',), (1,))
+        histogram.observe(0.5, builder='a"b\\c')
+        assert 'test_seconds_count{builder="a\\"b\\\\c"} 1' in histogram.render()
+
+    def test_no_labels(self):
+        histogram = Histogram('test_seconds', 'A test.', (), (1,))
+        histogram.observe(0.5)
+        assert 'test_seconds_count 1' in histogram.render()
+
+
+class TestGauge:
+    def test_collect(self):
+        gauge = Gauge('test', 'A test.', ('cache',), lambda: {('a',): 1, ('b',): 0.5})
+        assert list(gauge.render()) == [
+            '# HELP test A test.',
+            '# TYPE test gauge',
+            'test{cache="a"} 1',
+            'test{cache="b"} 0.5',
+        ]
+
+
+class TestMetricsRegistry:
+    def test_render(self):
+        registry = MetricsRegistry()
+        registry.register(Gauge('a', 'A.', (), lambda: {(): 1}))
+        registry.register(Gauge('b', 'B.', (), lambda: {(): 2}))
+        assert registry.render() == (
+            '# HELP a A.\n# TYPE a gauge\na 1\n# HELP b B.\n# TYPE b gauge\nb 2\n'
+        )
+
+
+class TestHitRatio:
+    def test_no_lookups(self):
+        assert _hit_ratio(ManifestCache(max_size=10)) == 0
+
+    def test_ratio(self):
+        cache = ManifestCache(max_size=10)
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('b')
+        assert _hit_ratio(cache) == 0.5
+
+
+def test_cache_entries_skips_uncounted(monkeypatch):
+    counted = ManifestCache(max_size=10)
+    counted.set('a', 1)
+    monkeypatch.setattr(
+        'ckanext.iiif.lib.metrics.CACHES',
+        {'counted': lambda: counted, 'uncounted': lambda: MagicMock(size=None)},
+    )
+    assert _collect_caches(lambda cache: cache.size)() == {('counted',): 1}
+
+
+def test_metric_samples_is_abstract():
+    with pytest.raises(TypeError):
+        Metric('test', 'A test metric')
@@ -0,0 +1,304 @@
+import gzip
+import json
+from unittest.mock import MagicMock, patch
+
+import pytest
+from ckan.logic import NotAuthorized, NotFound
+
+from ckanext.iiif.builders.model import IIIFResource
+from ckanext.iiif.builders.utils import IIIFBuildError
+from ckanext.iiif.lib.prebuild import (
+    PrebuildStats,
+    build_chunk,
+    iter_pages,
+    prebuild_resource,
+)
+from ckanext.iiif.lib.store import ManifestStore
+
+RESOURCE = {
+    'id': 'abc',
+    '_image_field': 'images',
+    'metadata_modified': '2024-05-01T12:00:00',
+}
+
+
+class FakeManifest(IIIFResource):
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def to_dict(self):
+        return self.data
+
+
+def build_record_manifest_model(resource, record):
+    if record.get('bad'):
+        raise IIIFBuildError(f'resource/{resource["id"]}/record/{record["_id"]}', 'bad')
+    return FakeManifest({'id': record['_id']})
+
+
+def make_pages(*pages):
+    """
+    Creates the multi_query results for the given pages of record IDs.
+    """
+    results = []
+    for number, record_ids in enumerate(pages):
+        after = [number] if number < len(pages) - 1 else None
+        records = [{'data': {'_id': record_id}} for record_id in record_ids]
+        results.append({'records': records, 'after': after})
+    return results
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ManifestStore(str(tmp_path))
+
+
+@pytest.fixture
+def mocks():
+    resource_show = MagicMock(return_value=RESOURCE)
+    with patch(
+        'ckanext.iiif.lib.prebuild.toolkit.get_action',
+        MagicMock(return_value=resource_show),
+    ):
+        with patch(
+            'ckanext.iiif.lib.prebuild.get_template',
+            MagicMock(return_value=MagicMock(rights='https://rights')),
+        ):
+            with patch(
+                'ckanext.iiif.lib.prebuild.RecordManifestBuilder.build_record_manifest_model',
+                side_effect=build_record_manifest_model,
+            ):
+                with patch('ckanext.iiif.lib.prebuild.multi_query') as multi_query:
+                    yield multi_query
+
+
+class TestIterPages:
+    def test_pages(self):
+        results = make_pages([1, 2], [3])
+        with patch(
+            'ckanext.iiif.lib.prebuild.multi_query', side_effect=results
+        ) as multi_query:
+            pages = list(iter_pages(RESOURCE, 2))
+
+        assert pages == [([{'_id': 1}, {'_id': 2}], [0]), ([{'_id': 3}], None)]
+        query = {'filters': {'and': [{'exists': {'fields': ['images']}}]}}
+        context = {'ignore_auth': True}
+        multi_query.assert_any_call('abc', query, 2, None, context=context)
+        multi_query.assert_any_call('abc', query, 2, [0], context=context)
+
+    def test_not_authorised(self):
+        with patch(
+            'ckanext.iiif.lib.prebuild.multi_query', side_effect=NotAuthorized()
+        ):
+            with pytest.raises(IIIFBuildError, match='Not authorised'):
+                list(iter_pages(RESOURCE, 2))
+
+    def test_empty_page_stops(self):
+        results = [{'records': [], 'after': [1]}]
+        with patch('ckanext.iiif.lib.prebuild.multi_query', side_effect=results):
+            assert list(iter_pages(RESOURCE, 2)) == [([], None)]
+
+
+class TestBuildChunk:
+    def test_build(self, store):
+        records = [{'_id': 1}, {'_id': 2, 'bad': True}]
+        with patch(
+            'ckanext.iiif.lib.prebuild.RecordManifestBuilder.build_record_manifest_model',
+            side_effect=build_record_manifest_model,
+        ):
+            built, failures = build_chunk(store.root, RESOURCE, records)
+
+        assert built == 1
+        assert failures == [
+            (
+                'resource/abc/record/2',
+                'Failed to build resource/abc/record/2 due to bad',
+            )
+        ]
+        with open(store.get_path('resource/abc/record/1')) as f:
+            assert json.load(f) == {'id': 1}
+        with gzip.open(store.get_path('resource/abc/record/1', '.json.gz')) as f:
+            assert json.load(f) == {'id': 1}
+        assert not store.exists('resource/abc/record/2')
+
+    def test_no_compress(self, store):
+        with patch(
+            'ckanext.iiif.lib.prebuild.RecordManifestBuilder.build_record_manifest_model',
+            side_effect=build_record_manifest_model,
+        ):
+            build_chunk(store.root, RESOURCE, [{'_id': 1}], compress=False)
+
+        assert store.find('resource/abc/record/1', ['gzip'])[1] is None
+
+
+class TestPrebuildResource:
+    def test_build(self, store, mocks):
+        mocks.side_effect = make_pages([1, 2, 3], [4, 5])
+        progress = []
+        failures = []
+
+        stats = prebuild_resource(
+            'abc',
+            store,
+            page_size=3,
+            chunk_size=2,
+            on_progress=lambda s: progress.append((s.total, s.built)),
+            on_failure=failures.append,
+        )
+
+        assert stats.built == 5
+        assert stats.failed == 0
+        assert stats.total == 5
+        assert not stats.resumed
+        assert progress == [(3, 3), (5, 5)]
+        assert not failures
+        for record_id in range(1, 6):
+            assert store.exists(f'resource/abc/record/{record_id}')
+        checkpoint = store.read_checkpoint('abc')
+        assert checkpoint['complete']
+        assert checkpoint['built'] == 5
+
+    def test_workers(self, store, mocks):
+        mocks.side_effect = make_pages(list(range(1, 11)))
+
+        stats = prebuild_resource('abc', store, workers=2, chunk_size=3)
+
+        assert stats.built == 10
+        for record_id in range(1, 11):
+            assert store.exists(f'resource/abc/record/{record_id}')
+
+    def test_failures(self, store, mocks):
+        mocks.return_value = {
+            'records': [{'data': {'_id': 1}}, {'data': {'_id': 2, 'bad': True}}],
+            'after': None,
+        }
+        failures = []
+
+        stats = prebuild_resource('abc', store, on_failure=failures.append)
+
+        assert stats.built == 1
+        assert stats.failed == 1
+        assert [identifier for identifier, _ in failures] == ['resource/abc/record/2']
+
+    def test_resume(self, store, mocks):
+        store.write_checkpoint(
+            'abc',
+            {
+                'metadata_modified': RESOURCE['metadata_modified'],
+                'after': [0],
+                'complete': False,
+                'built': 3,
+                'failed': 0,
+                'total': 3,
+            },
+        )
+        mocks.side_effect = make_pages([4, 5])
+
+        stats = prebuild_resource('abc', store)
+
+        assert stats.resumed
+        assert stats.built == 5
+        assert stats.run_built == 2
+        assert mocks.call_args.args[3] == [0]
+        assert not store.exists('resource/abc/record/1')
+
+    def test_resume_complete(self, store, mocks):
+        store.write_checkpoint(
+            'abc',
+            {
+                'metadata_modified': RESOURCE['metadata_modified'],
+                'after': None,
+                'complete': True,
+                'built': 3,
+                'failed': 1,
+                'total': 4,
+            },
+        )
+
+        stats = prebuild_resource('abc', store)
+
+        assert stats.already_complete
+        assert stats.built == 3
+        mocks.assert_not_called()
+
+    @pytest.mark.parametrize(
+        'checkpoint_modified,restart',
+        [('2020-01-01T00:00:00', False), (RESOURCE['metadata_modified'], True)],
+    )
+    def test_restart(self, store, mocks, checkpoint_modified, restart):
+        store.write_checkpoint(
+            'abc',
+            {
+                'metadata_modified': checkpoint_modified,
+                'after': [0],
+                'complete': False,
+                'built': 3,
+                'failed': 0,
+                'total': 3,
+            },
+        )
+        mocks.side_effect = make_pages([1, 2])
+
+        stats = prebuild_resource('abc', store, restart=restart)
+
+        assert not stats.resumed
+        assert stats.built == 2
+        assert mocks.call_args.args[3] is None
+
+    def test_resource_not_found(self, store):
+        resource_show = MagicMock(side_effect=NotFound())
+        with patch(
+            'ckanext.iiif.lib.prebuild.toolkit.get_action',
+            MagicMock(return_value=resource_show),
+        ):
+            with pytest.raises(IIIFBuildError):
+                prebuild_resource('abc', store)
+
+    def test_resource_not_authorised(self, store):
+        resource_show = MagicMock(side_effect=NotAuthorized())
+        with patch(
+            'ckanext.iiif.lib.prebuild.toolkit.get_action',
+            MagicMock(return_value=resource_show),
+        ):
+            with pytest.raises(IIIFBuildError, match='Not authorised'):
+                prebuild_resource('abc', store)
+
+    def test_ignores_auth(self, store, mocks):
+        # prebuilding is run without a user so private resources need auth skipped
+        mocks.side_effect = make_pages([1])
+        resource_show = MagicMock(return_value=RESOURCE)
+        with patch(
+            'ckanext.iiif.lib.prebuild.toolkit.get_action',
+            MagicMock(return_value=resource_show),
+        ):
+            prebuild_resource('abc', store)
+        assert resource_show.call_args.args[0] == {'ignore_auth': True}
+        assert mocks.call_args.kwargs['context'] == {'ignore_auth': True}
+
+    def test_no_image_field(self, store):
+        resource_show = MagicMock(return_value={'id': 'abc'})
+        with patch(
+            'ckanext.iiif.lib.prebuild.toolkit.get_action',
+            MagicMock(return_value=resource_show),
+        ):
+            with pytest.raises(IIIFBuildError):
+                prebuild_resource('abc', store)
+
+    def test_unknown_licence(self, store, mocks):
+        with patch(
+            'ckanext.iiif.lib.prebuild.get_template',
+            MagicMock(return_value=MagicMock(rights=None)),
+        ):
+            with pytest.raises(IIIFBuildError):
+                prebuild_resource('abc', store)
+
+
+class TestPrebuildStats:
+    def test_throughput(self):
+        stats = PrebuildStats('abc')
+        assert stats.throughput == 0
+        stats.run_built = 10
+        stats.elapsed = 2
+        assert stats.throughput == 5
@@ -0,0 +1,100 @@
+import json
+import pstats
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from ckanext.iiif.lib import profiling
+
+
+class TestSampled:
+    def test_disabled(self):
+        with patch('ckanext.iiif.lib.profiling.SAMPLE_RATE', 0):
+            assert not any(profiling.sampled() for _ in range(100))
+
+    def test_always(self):
+        with patch('ckanext.iiif.lib.profiling.SAMPLE_RATE', 1):
+            assert all(profiling.sampled() for _ in range(100))
+
+    def test_rate(self):
+        with patch('ckanext.iiif.lib.profiling.SAMPLE_RATE', 0.5):
+            with patch('ckanext.iiif.lib.profiling.random.random', return_value=0.4):
+                assert profiling.sampled()
+            with patch('ckanext.iiif.lib.profiling.random.random', return_value=0.6):
+                assert not profiling.sampled()
+
+
+def allocate(size: int) -> list:
+    return [object() for _ in range(size)]
+
+
+class TestProfile:
+    def test_inline(self):
+        with patch('ckanext.iiif.lib.profiling.OUTPUT_DIR', None):
+            result, report = profiling.profile('test', allocate, 1000)
+
+        assert len(result) == 1000
+        assert report['label'] == 'test'
+        assert report['duration'] > 0
+        assert report['peak_memory'] > 0
+        # the list is still referenced so the memory is still allocated
+        assert report['net_memory'] > 0
+        assert 'allocate' in report['stats']
+        assert 'file' not in report
+
+    def test_kwargs(self):
+        function = MagicMock(return_value=4)
+        result, _ = profiling.profile('test', function, 1, 2, three=3)
+        assert result == 4
+        function.assert_called_once_with(1, 2, three=3)
+
+    def test_write(self, tmp_path):
+        with patch('ckanext.iiif.lib.profiling.OUTPUT_DIR', str(tmp_path / 'profiles')):
+            _, report = profiling.profile('resource/1/record/2', allocate, 10)
+
+        assert 'stats' not in report
+        path = report['file']
+        assert path.startswith(str(tmp_path / 'profiles'))
+        assert path.endswith('-resource_1_record_2.prof')
+        # check the stats can be loaded
+        assert pstats.Stats(path).total_calls > 0
+        with open(f'{path}.json') as f:
+            assert json.load(f) == report
+
+    def test_error(self):
+        function = MagicMock(side_effect=ValueError('oh no!'))
+        with pytest.raises(ValueError):
+            profiling.profile('test', function)
+        # the lock is released and tracing stopped even when the function errors
+        assert not profiling._lock.locked()
+        assert not profiling.tracemalloc.is_tracing()
+
+    def test_already_profiling(self):
+        function = MagicMock(return_value=4)
+        with profiling._lock:
+            result, report = profiling.profile('test', function)
+
+        assert result == 4
+        assert report is None
+        function.assert_called_once_with()
+
+
+class TestLogReport:
+    def test_none(self):
+        with patch('ckanext.iiif.lib.profiling.log') as log:
+            profiling.log_report(None)
+        log.info.assert_not_called()
+
+    def test_report(self):
+        report = {
+            'label': 'test',
+            'duration': 0.5,
+            'peak_memory': 100,
+            'net_memory': 10,
+            'file': '/tmp/test.prof',
+        }
+        with patch('ckanext.iiif.lib.profiling.log') as log:
+            profiling.log_report(report)
+        message = log.info.call_args.args[0]
+        assert 'test' in message
+        assert '/tmp/test.prof' in message
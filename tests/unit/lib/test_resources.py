@@ -0,0 +1,213 @@
+import gzip
+import json
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+from ckanext.iiif.builders.model import Canvas, Manifest
+from ckanext.iiif.lib.resources import BuiltResource
+from ckanext.iiif.lib.serialisation import dumps
+
+
+class TestBuiltResource:
+    def test_body(self):
+        data = {'beans': 3, 'id': 'test'}
+        built = BuiltResource(data)
+        assert json.loads(built.body) == data
+        # the body should be computed once and then reused
+        assert built.body is built.body
+
+    def test_etag_is_stable(self):
+        assert BuiltResource({'beans': 3}).etag == BuiltResource({'beans': 3}).etag
+
+    def test_etag_changes_with_content(self):
+        assert BuiltResource({'beans': 3}).etag != BuiltResource({'beans': 4}).etag
+
+    def test_built_defaults_to_now(self):
+        before = datetime.now(timezone.utc).replace(microsecond=0)
+        built = BuiltResource({})
+        assert before <= built.built <= datetime.now(timezone.utc)
+
+    def test_built_drops_microseconds(self):
+        built = BuiltResource({}, datetime(2024, 1, 2, 3, 4, 5, 6789, timezone.utc))
+        assert built.built == datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+
+    def test_modified_defaults_to_built(self):
+        built = BuiltResource({}, datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc))
+        assert built.modified == built.built
+
+    def test_modified(self):
+        built = BuiltResource(
+            {}, modified=datetime(2024, 1, 2, 3, 4, 5, 6789, timezone.utc)
+        )
+        assert built.modified == datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+
+    def test_iter_body(self):
+        data = {'id': 'test', 'items': [{'id': i} for i in range(200)]}
+        built = BuiltResource(data)
+        assert b''.join(built.iter_body()) == built.body
+        assert json.loads(b''.join(built.iter_body())) == data
+
+    def test_iter_body_not_kept(self):
+        built = BuiltResource({'items': [1, 2, 3]})
+        assert not built.serialised
+        b''.join(built.iter_body())
+        assert not built.serialised
+
+    def test_iter_body_serialised(self):
+        built = BuiltResource({'items': [1, 2, 3]})
+        assert list(built.iter_body()) != [built.body]
+        assert built.serialised
+        assert list(built.iter_body()) == [built.body]
+
+    def test_get_body(self):
+        built = BuiltResource({'beans': 3})
+        assert built.get_body() is built.body
+        compressed = built.get_body('gzip')
+        assert gzip.decompress(compressed) == built.body
+        # the compressed body should be computed once and then reused
+        assert built.get_body('gzip') is compressed
+
+    def test_get_etag(self):
+        built = BuiltResource({'beans': 3})
+        assert built.get_etag() == built.etag
+        assert built.get_etag('gzip') == f'{built.etag}-gzip'
+        assert built.get_etag('br') != built.get_etag('gzip')
+
+    def test_dump_and_load(self):
+        built = BuiltResource(
+            {'beans': 3}, datetime(2024, 5, 1, 12, 30, 15, tzinfo=timezone.utc)
+        )
+        loaded = BuiltResource.load(built.dump())
+        assert loaded.data == built.data
+        assert loaded.built == built.built
+        assert loaded.modified == built.modified
+        assert loaded.serialised
+        assert not loaded.weak_etag
+        assert loaded.etag == built.etag
+
+    def test_dump_and_load_modified(self):
+        built = BuiltResource(
+            {'beans': 3},
+            datetime(2024, 5, 1, 12, 30, 15, tzinfo=timezone.utc),
+            datetime(2024, 4, 1, 9, tzinfo=timezone.utc),
+        )
+        loaded = BuiltResource.load(built.dump())
+        assert loaded.built == built.built
+        assert loaded.modified == datetime(2024, 4, 1, 9, tzinfo=timezone.utc)
+        assert loaded.weak_etag
+        assert loaded.etag == built.etag
+
+    def test_dump_and_load_compressed(self):
+        built = BuiltResource({'beans': 3})
+        payload = built.dump(encodings=['gzip'])
+
+        with patch.dict('ckanext.iiif.lib.resources.COMPRESSORS', clear=True):
+            loaded = BuiltResource.load(payload)
+            assert gzip.decompress(loaded.get_body('gzip')) == built.body
+        assert loaded.body == built.body
+        assert loaded.data == built.data
+
+    def test_dump_keeps_compressed(self):
+        built = BuiltResource({'beans': 3})
+        built.get_body('gzip')
+        loaded = BuiltResource.load(built.dump())
+        assert loaded.get_body('gzip') == built.get_body('gzip')
+        assert loaded.body == built.body
+
+    def test_dump_too_small_to_compress(self):
+        built = BuiltResource({'beans': 3})
+        payload = built.dump(encodings=['gzip'], min_size=1024)
+        assert b'gzip=' not in payload
+        assert BuiltResource.load(payload).body == built.body
+
+    def test_dump_and_load_model(self):
+        built = BuiltResource(make_manifest(2))
+        loaded = BuiltResource.load(built.dump())
+        assert loaded.data == built.data
+        assert loaded.etag == built.etag
+
+    def test_load_doesnt_parse(self):
+        payload = BuiltResource(make_manifest(2)).dump()
+        with patch('ckanext.iiif.lib.resources.loads') as loads_mock:
+            loaded = BuiltResource.load(payload)
+            loaded.get_body('gzip')
+            assert loaded.etag
+        loads_mock.assert_not_called()
+        # the body is parsed when the data is needed
+        assert loaded.item_count == 2
+
+
+def make_manifest(canvases=0, modified=None):
+    return Manifest(
+        id='https://iiif/manifest',
+        label={'none': ['beans']},
+        metadata=[],
+        rights='https://rights',
+        items=[
+            Canvas(f'https://canvas/{i}', 1, 1, 'beans', ()) for i in range(canvases)
+        ],
+        logo=None,
+        modified=modified,
+    )
+
+
+class TestBuiltResourceModel:
+    def test_body(self):
+        manifest = make_manifest()
+        built = BuiltResource(manifest)
+        assert built.resource is manifest
+        assert built.body == manifest.to_json()
+        assert built.body == dumps(manifest.to_dict())
+
+    def test_data(self):
+        manifest = make_manifest()
+        built = BuiltResource(manifest)
+        assert built.data == manifest.to_dict()
+        # the dict view isn't kept
+        assert built.data is not built.data
+
+    def test_iter_body(self):
+        manifest = make_manifest(3)
+        built = BuiltResource(manifest)
+        assert b''.join(built.iter_body()) == manifest.to_json()
+        assert not built.serialised
+
+    def test_item_count(self):
+        assert BuiltResource(make_manifest(3)).item_count == 3
+        assert BuiltResource({'items': [1, 2]}).item_count == 2
+        assert BuiltResource({'beans': [1, 2]}).item_count == 0
+
+    def test_modified(self):
+        modified = datetime(2024, 4, 1, 9, 30, 15, 6789, timezone.utc)
+        built = BuiltResource(make_manifest(modified=modified))
+        assert built.modified == datetime(2024, 4, 1, 9, 30, 15, tzinfo=timezone.utc)
+        assert built.built > built.modified
+
+    def test_modified_unknown(self):
+        built = BuiltResource(make_manifest())
+        assert built.modified == built.built
+
+    def test_weak_etag(self):
+        modified = datetime(2024, 4, 1, 9, tzinfo=timezone.utc)
+        built = BuiltResource(make_manifest(2, modified))
+        assert built.weak_etag
+        assert built.etag == BuiltResource(make_manifest(3, modified)).etag
+        # the ETag doesn't need the body
+        assert not built.serialised
+        # the encodings all share the weak ETag
+        assert built.get_etag('gzip') == built.get_etag() == built.etag
+
+    def test_weak_etag_changes_with_modified(self):
+        built = BuiltResource(
+            make_manifest(modified=datetime(2024, 4, 1, 9, tzinfo=timezone.utc))
+        )
+        other = BuiltResource(
+            make_manifest(modified=datetime(2024, 4, 1, 10, tzinfo=timezone.utc))
+        )
+        assert built.etag != other.etag
+
+    def test_strong_etag_when_modified_unknown(self):
+        built = BuiltResource(make_manifest(2))
+        assert not built.weak_etag
+        assert built.etag == BuiltResource(make_manifest(2)).etag
+        assert built.serialised
@@ -0,0 +1,110 @@
+from unittest.mock import MagicMock, call, patch
+
+import pytest
+from ckan.logic import NotFound
+
+from ckanext.iiif.lib.search import (
+    SEARCH_MODE_FULL,
+    SEARCH_MODE_REFERENCE,
+    get_records,
+    get_search_mode,
+    internal_query,
+    is_internal_query,
+    multi_query,
+)
+
+
+def test_internal_query():
+    assert not is_internal_query()
+    with internal_query():
+        assert is_internal_query()
+    assert not is_internal_query()
+
+
+class TestGetSearchMode:
+    def test_default(self):
+        assert get_search_mode() == SEARCH_MODE_FULL
+
+    @pytest.mark.ckan_config('ckanext.iiif.search_mode', 'reference')
+    def test_config(self):
+        assert get_search_mode() == SEARCH_MODE_REFERENCE
+
+    @pytest.mark.ckan_config('ckanext.iiif.search_mode', 'beans')
+    def test_invalid_config(self):
+        assert get_search_mode() == SEARCH_MODE_FULL
+
+    @pytest.mark.ckan_config('ckanext.iiif.search_mode', 'reference')
+    def test_request_override(self, test_request_context):
+        with test_request_context('/?iiif_mode=full'):
+            assert get_search_mode() == SEARCH_MODE_FULL
+
+    def test_request_opt_in(self, test_request_context):
+        with test_request_context('/?iiif_mode=reference'):
+            assert get_search_mode() == SEARCH_MODE_REFERENCE
+
+    @pytest.mark.ckan_config('ckanext.iiif.search_mode', 'reference')
+    def test_invalid_request_override(self, test_request_context):
+        with test_request_context('/?iiif_mode=beans'):
+            assert get_search_mode() == SEARCH_MODE_REFERENCE
+
+
+class TestMultiQuery:
+    def test_is_internal(self):
+        def vds_multi_query(context, data_dict):
+            assert is_internal_query()
+            return {'records': []}
+
+        with patch(
+            'ckanext.iiif.lib.search.toolkit.get_action',
+            return_value=MagicMock(side_effect=vds_multi_query),
+        ) as get_action_mock:
+            assert multi_query('res', {}, 10, after=['x']) == {'records': []}
+
+        get_action_mock.return_value.assert_called_once_with(
+            {}, {'resource_ids': ['res'], 'query': {}, 'size': 10, 'after': ['x']}
+        )
+
+
+class TestGetRecords:
+    def test_bulk(self):
+        result = {'records': [{'data': {'_id': 1}}, {'data': {'_id': 3}}]}
+        with patch(
+            'ckanext.iiif.lib.search.multi_query', return_value=result
+        ) as multi_query_mock:
+            records = get_records('res', ['1', '2', 3])
+
+        assert records == {'1': {'_id': 1}, '3': {'_id': 3}}
+        multi_query_mock.assert_called_once()
+        query = multi_query_mock.call_args[0][1]
+        assert query['filters']['or'] == [
+            {'number_equals': {'fields': ['_id'], 'value': 1}},
+            {'number_equals': {'fields': ['_id'], 'value': 2}},
+            {'number_equals': {'fields': ['_id'], 'value': 3}},
+        ]
+
+    def test_bulk_chunks(self):
+        with patch(
+            'ckanext.iiif.lib.search.multi_query', return_value={'records': []}
+        ) as multi_query_mock:
+            get_records('res', map(str, range(5)), chunk_size=2)
+
+        assert multi_query_mock.call_count == 3
+        assert [c[0][2] for c in multi_query_mock.call_args_list] == [2, 2, 1]
+
+    def test_individually(self):
+        def vds_data_get(context, data_dict):
+            if data_dict['record_id'] == 'b':
+                raise NotFound()
+            return {'data': {'_id': data_dict['record_id']}}
+
+        vds_data_get_mock = MagicMock(side_effect=vds_data_get)
+        with patch(
+            'ckanext.iiif.lib.search.toolkit.get_action', return_value=vds_data_get_mock
+        ):
+            records = get_records('res', ['a', 'b'])
+
+        assert records == {'a': {'_id': 'a'}}
+        assert vds_data_get_mock.call_args_list == [
+            call({}, {'resource_id': 'res', 'record_id': 'a'}),
+            call({}, {'resource_id': 'res', 'record_id': 'b'}),
+        ]
@@ -0,0 +1,63 @@
+import json
+from unittest.mock import patch
+
+import pytest
+
+from ckanext.iiif.lib import serialisation
+from ckanext.iiif.lib.serialisation import dumps, iter_dumps, loads
+
+MANIFEST = {
+    '@context': 'http://iiif.io/api/presentation/3/context.json',
+    'id': 'https://example.com/iiif/resource/1/record/1',
+    'type': 'Manifest',
+    'label': {'none': ['ünïcødé']},
+    'items': [{'id': f'canvas/{i}', 'type': 'Canvas'} for i in range(123)],
+    'logo': [{'id': 'logo.png'}],
+}
+
+
+@pytest.fixture(params=[True, False], ids=['orjson', 'json'])
+def encoder(request):
+    if request.param:
+        pytest.importorskip('orjson')
+        yield
+    else:
+        with patch.object(serialisation, 'orjson', None):
+            yield
+
+
+@pytest.mark.usefixtures('encoder')
+class TestDumps:
+    def test_compact(self):
+        assert dumps({'a': [1, 2], 'b': 'c'}) == b'{"a":[1,2],"b":"c"}'
+
+    def test_round_trip(self):
+        assert json.loads(dumps(MANIFEST)) == MANIFEST
+
+
+def test_loads():
+    assert loads(dumps(MANIFEST)) == MANIFEST
+
+
+def test_dumps_fallback():
+    pytest.importorskip('orjson')
+    # orjson can't serialise dicts with int keys by default, json can
+    assert json.loads(dumps({1: 'a'})) == {'1': 'a'}
+
+
+@pytest.mark.usefixtures('encoder')
+class TestIterDumps:
+    def test_same_as_dumps(self):
+        assert b''.join(iter_dumps(MANIFEST)) == dumps(MANIFEST)
+
+    def test_chunks(self):
+        chunks = list(iter_dumps(MANIFEST, chunk_size=50))
+        # the start, 3 chunks of items, and the end
+        assert len(chunks) == 5
+
+    @pytest.mark.parametrize(
+        'data',
+        [{}, {'items': []}, {'items': [1]}, {'a': 1}, {'items': 'not a list'}],
+    )
+    def test_edge_cases(self, data):
+        assert b''.join(iter_dumps(data)) == dumps(data)
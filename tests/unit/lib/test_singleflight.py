@@ -0,0 +1,242 @@
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+from ckanext.iiif.lib.singleflight import (
+    CALLED,
+    PROCESS,
+    THREAD,
+    SharedFlight,
+    SingleFlight,
+)
+
+
+class FakeRedis:
+    """
+    An in-memory stand-in for the parts of the Redis client used by SharedFlight. It's
+    shared between SharedFlight instances to simulate multiple processes.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.expiries = {}
+        self.lock = threading.Lock()
+
+    def _expire(self, key):
+        expiry = self.expiries.get(key)
+        if expiry is not None and expiry <= time.monotonic():
+            self.data.pop(key, None)
+            self.expiries.pop(key, None)
+
+    def get(self, key):
+        with self.lock:
+            self._expire(key)
+            return self.data.get(key)
+
+    def set(self, key, value, nx=False, px=None):
+        with self.lock:
+            self._expire(key)
+            if nx and key in self.data:
+                return None
+            self.data[key] = value.encode() if isinstance(value, str) else value
+            if px is not None:
+                self.expiries[key] = time.monotonic() + px / 1000
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self.expiries.pop(key, None)
+            return int(self.data.pop(key, None) is not None)
+
+    def eval(self, script, numkeys, key, token):
+        # only the release script is used
+        with self.lock:
+            if self.data.get(key) == token.encode():
+                del self.data[key]
+                return 1
+            return 0
+
+
+def make_shared(redis, **kwargs):
+    kwargs.setdefault('poll_interval', 0.01)
+    return SharedFlight(lambda: redis, dump=str.encode, load=bytes.decode, **kwargs)
+
+
+def call_concurrently(flights, function, count=4):
+    """
+    Calls the function through each of the given flights (or the same flight if only
+    one is given) from count threads at once, starting the first and waiting for it to
+    call the function before starting the others.
+    """
+    if not isinstance(flights, list):
+        flights = [flights] * count
+    started = threading.Event()
+    release = threading.Event()
+    results = []
+    errors = []
+
+    def blocking():
+        started.set()
+        release.wait(5)
+        return function()
+
+    def call(flight):
+        try:
+            results.append(flight.do('key', blocking))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call, args=(flight,)) for flight in flights]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    return results, errors
+
+
+class TestSingleFlight:
+    def test_single_call(self):
+        flight = SingleFlight()
+        assert flight.do('key', lambda: 'beans') == ('beans', CALLED)
+        assert len(flight) == 0
+
+    def test_concurrent_calls_coalesced(self):
+        function = MagicMock(return_value='beans')
+        results, errors = call_concurrently(SingleFlight(), function)
+
+        assert not errors
+        function.assert_called_once()
+        assert sorted(results) == [('beans', CALLED)] + [('beans', THREAD)] * 3
+
+    def test_different_keys_not_coalesced(self):
+        flight = SingleFlight()
+        function = MagicMock(return_value='beans')
+        flight.do('a', function)
+        flight.do('b', function)
+        assert function.call_count == 2
+
+    def test_sequential_calls_not_coalesced(self):
+        flight = SingleFlight()
+        function = MagicMock(return_value='beans')
+        flight.do('key', function)
+        flight.do('key', function)
+        assert function.call_count == 2
+
+    def test_error_shared(self):
+        function = MagicMock(side_effect=ValueError('oh no!'))
+        results, errors = call_concurrently(SingleFlight(), function)
+
+        function.assert_called_once()
+        assert not results
+        assert len(errors) == 4
+        assert all(isinstance(error, ValueError) for error in errors)
+
+    def test_error_not_kept(self):
+        flight = SingleFlight()
+        with pytest.raises(ValueError):
+            flight.do('key', MagicMock(side_effect=ValueError()))
+        assert len(flight) == 0
+        assert flight.do('key', lambda: 'beans') == ('beans', CALLED)
+
+    def test_timeout(self):
+        # the first call takes longer than the others are willing to wait, so they
+        # call the function themselves
+        function = MagicMock(return_value='beans')
+        results, errors = call_concurrently(SingleFlight(timeout=0.01), function)
+
+        assert not errors
+        assert function.call_count == 4
+        assert results == [('beans', CALLED)] * 4
+
+    def test_shared(self):
+        redis = FakeRedis()
+        flight = SingleFlight(make_shared(redis))
+        assert flight.do('key', lambda: 'beans') == ('beans', CALLED)
+        # the lock is released once the call is done
+        assert redis.get('ckanext-iiif:flight:lock:key') is None
+
+    def test_shared_from_another_process(self):
+        redis = FakeRedis()
+        # another process holds the lock and has published its result
+        redis.set('ckanext-iiif:flight:lock:key', 'someone-else')
+        redis.set('ckanext-iiif:flight:result:key', 'beans')
+        flight = SingleFlight(make_shared(redis))
+        function = MagicMock()
+        assert flight.do('key', function) == ('beans', PROCESS)
+        function.assert_not_called()
+
+
+class TestSharedFlight:
+    def test_across_processes(self):
+        redis = FakeRedis()
+        # a separate SharedFlight for each simulated process
+        flights = [make_shared(redis) for _ in range(4)]
+        function = MagicMock(return_value='beans')
+
+        results, errors = call_concurrently(flights, function)
+
+        assert not errors
+        function.assert_called_once()
+        assert sorted(results) == [('beans', CALLED)] + [('beans', PROCESS)] * 3
+
+    def test_none_not_published(self):
+        redis = FakeRedis()
+        flights = [make_shared(redis) for _ in range(2)]
+        function = MagicMock(return_value=None)
+
+        results, errors = call_concurrently(flights, function, count=2)
+
+        assert not errors
+        # the waiting process takes the lock once it's released and calls the function
+        # itself
+        assert function.call_count == 2
+        assert results == [(None, CALLED), (None, CALLED)]
+
+    def test_timeout(self):
+        redis = FakeRedis()
+        redis.set('ckanext-iiif:flight:lock:key', 'someone-else')
+        flight = make_shared(redis, timeout=0.05)
+        assert flight.do('key', lambda: 'beans') == ('beans', CALLED)
+        # the lock held by someone else isn't released
+        assert redis.get('ckanext-iiif:flight:lock:key') == b'someone-else'
+
+    def test_result_expires(self):
+        redis = FakeRedis()
+        flight = make_shared(redis, timeout=0.05)
+        flight.do('key', lambda: 'beans')
+        assert redis.get('ckanext-iiif:flight:result:key') == b'beans'
+        time.sleep(0.1)
+        assert redis.get('ckanext-iiif:flight:result:key') is None
+
+    def test_stale_result_ignored(self):
+        redis = FakeRedis()
+        redis.set('ckanext-iiif:flight:result:key', b'old')
+        flight = make_shared(redis)
+        assert flight.do('key', lambda: 'new') == ('new', CALLED)
+
+    def test_redis_unavailable(self):
+        flight = SharedFlight(
+            MagicMock(side_effect=ConnectionError()), str.encode, bytes.decode
+        )
+        assert flight.do('key', lambda: 'beans') == ('beans', CALLED)
+
+    def test_redis_fails_while_leading(self):
+        redis = FakeRedis()
+        redis.delete = MagicMock(side_effect=ConnectionError())
+        redis.eval = MagicMock(side_effect=ConnectionError())
+        flight = make_shared(redis)
+        assert flight.do('key', lambda: 'beans') == ('beans', CALLED)
+
+    def test_connects_lazily(self):
+        connect = MagicMock(return_value=FakeRedis())
+        flight = SharedFlight(connect, str.encode, bytes.decode)
+        connect.assert_not_called()
+        flight.do('a', lambda: 'beans')
+        flight.do('b', lambda: 'beans')
+        connect.assert_called_once()
@@ -0,0 +1,130 @@
+import gzip
+import os
+import stat
+import time
+from unittest.mock import patch
+
+import pytest
+
+from ckanext.iiif.lib.store import CHECKPOINT_NAME, ManifestStore, write_atomic
+
+
+class TestManifestStore:
+    def test_get_path(self, tmp_path):
+        store = ManifestStore(str(tmp_path))
+        assert store.get_path('resource/abc/record/1') == str(
+            tmp_path / 'resource' / 'abc' / 'record' / '1.json'
+        )
+        assert store.get_path('resource/abc/record/1', '.json.gz') == str(
+            tmp_path / 'resource' / 'abc' / 'record' / '1.json.gz'
+        )
+
+    @pytest.mark.parametrize(
+        'identifier',
+        ['', 'resource//record/1', 'resource/../record/1', 'resource/.', '.prebuild'],
+    )
+    def test_get_path_invalid(self, tmp_path, identifier):
+        store = ManifestStore(str(tmp_path))
+        with pytest.raises(ValueError):
+            store.get_path(identifier)
+
+    def test_get_resource_dir(self, tmp_path):
+        store = ManifestStore(str(tmp_path))
+        assert store.get_resource_dir('abc') == str(tmp_path / 'resource' / 'abc')
+
+    def test_write_and_exists(self, tmp_path):
+        store = ManifestStore(str(tmp_path))
+        assert not store.exists('resource/abc/record/1')
+        store.write('resource/abc/record/1', b'{"beans":3}')
+        assert store.exists('resource/abc/record/1')
+        with open(store.get_path('resource/abc/record/1'), 'rb') as f:
+            assert f.read() == b'{"beans":3}'
+
+    def test_exists_invalid(self, tmp_path):
+        store = ManifestStore(str(tmp_path))
+        assert not store.exists('resource/../record/1')
+
+    def test_write_compressed(self, tmp_path):
+        store = ManifestStore(str(tmp_path))
+        with patch.dict(
+            'ckanext.iiif.lib.store.COMPRESSORS',
+            {'gzip': gzip.compress},
+            clear=True,
+        ):
+            store.write_compressed('resource/abc/record/1', b'{"beans":3}')
+        path = store.get_path('resource/abc/record/1')
+        with open(path, 'rb') as f:
+            assert f.read() == b'{"beans":3}'
+        with open(f'{path}.gz', 'rb') as f:
+            assert gzip.decompress(f.read()) == b'{"beans":3}'
+
+    def test_find(self, tmp_path):
+        store = ManifestStore(str(tmp_path))
+        path = store.get_path('resource/abc/record/1')
+        assert store.find('resource/abc/record/1') is None
+
+        store.write('resource/abc/record/1', b'1')
+        assert store.find('resource/abc/record/1') == (path, None)
+        assert store.find('resource/abc/record/1', ['br', 'gzip']) == (path, None)
+
+        store.write('resource/abc/record/1', b'1', '.json.gz')
+        store.write('resource/abc/record/1', b'1', '.json.br')
+        assert store.find('resource/abc/record/1') == (path, None)
+        assert store.find('resource/abc/record/1', ['gzip']) == (f'{path}.gz', 'gzip')
+        assert store.find('resource/abc/record/1', ['br', 'gzip']) == (
+            f'{path}.br',
+            'br',
+        )
+        assert store.find('resource/abc/record/1', ['deflate']) == (path, None)
+
+    def test_find_invalid(self, tmp_path):
+        store = ManifestStore(str(tmp_path))
+        assert store.find('resource/../record/1') is None
+
+    def test_invalidate(self, tmp_path):
+        store = ManifestStore(str(tmp_path))
+        store.write('resource/abc/record/1', b'1')
+        store.write('resource/def/record/1', b'1')
+
+        assert store.invalidate('abc')
+        assert not store.exists('resource/abc/record/1')
+        assert store.exists('resource/def/record/1')
+        # the stale directory is removed in the background
+        for _ in range(100):
+            if os.listdir(tmp_path) == ['resource']:
+                break
+            time.sleep(0.01)
+        assert os.listdir(tmp_path) == ['resource']
+
+    def test_invalidate_missing(self, tmp_path):
+        store = ManifestStore(str(tmp_path))
+        assert not store.invalidate('abc')
+
+    def test_checkpoint(self, tmp_path):
+        store = ManifestStore(str(tmp_path))
+        assert store.read_checkpoint('abc') is None
+        store.write_checkpoint('abc', {'after': [1, 'a'], 'built': 4})
+        assert store.read_checkpoint('abc') == {'after': [1, 'a'], 'built': 4}
+        assert (tmp_path / 'resource' / 'abc' / CHECKPOINT_NAME).is_file()
+
+    def test_checkpoint_unreadable(self, tmp_path):
+        store = ManifestStore(str(tmp_path))
+        os.makedirs(store.get_resource_dir('abc'))
+        (tmp_path / 'resource' / 'abc' / CHECKPOINT_NAME).write_text('{nope')
+        assert store.read_checkpoint('abc') is None
+
+
+class TestWriteAtomic:
+    def test_write(self, tmp_path):
+        path = str(tmp_path / 'a' / 'b.json')
+        write_atomic(path, b'1')
+        write_atomic(path, b'2')
+        with open(path, 'rb') as f:
+            assert f.read() == b'2'
+        # no temporary files are left behind
+        assert os.listdir(tmp_path / 'a') == ['b.json']
+
+    def test_readable(self, tmp_path):
+        path = str(tmp_path / 'b.json')
+        write_atomic(path, b'1')
+        assert os.stat(path).st_mode & stat.S_IROTH
@@ -1,10 +1,32 @@
+import threading
 from unittest.mock import MagicMock, patch
 
 import pytest
+from ckan.plugins import toolkit
 
 from ckanext.iiif.builders.manifest import RecordManifestBuilder
 from ckanext.iiif.builders.utils import IIIFBuildError
-from ckanext.iiif.logic.actions import build_iiif_identifier, build_iiif_resource
+from ckanext.iiif.lib.cache import ManifestCache
+from ckanext.iiif.lib.dispatch import BuilderIndex
+from ckanext.iiif.lib.metrics import Histogram
+from ckanext.iiif.lib.resources import BuiltResource
+from ckanext.iiif.lib.singleflight import PROCESS, THREAD, SingleFlight
+from ckanext.iiif.logic.actions import (
+    BUILDERS,
+    build_iiif_identifier,
+    build_iiif_resource,
+    build_iiif_resources,
+    get_builder_id,
+    get_iiif_resource,
+    get_iiif_resources,
+)
+
+
+def test_canvas_builder_before_record_builder():
+    # the record manifest builder also matches canvas identifiers so the canvas builder
+    # must be asked first
+    builder_ids = list(BUILDERS)
+    assert builder_ids.index('canvas') < builder_ids.index('record')
 
 
 class TestBuildIIIFResource:
@@ -93,6 +115,414 @@ class TestBuildIIIFResource:
             # considered
             assert build_iiif_resource('test') is None
 
+    def test_cache_hit(self):
+        mock_manifest = {'beans': 3}
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value=mock_manifest))
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            with patch('ckanext.iiif.logic.actions.CACHE', ManifestCache(max_size=10)):
+                assert build_iiif_resource('test') is mock_manifest
+                assert build_iiif_resource('test') is mock_manifest
+
+        mock_builder.match_and_build.assert_called_once_with('test')
+
+    def test_cache_no_match_not_cached(self):
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value=None))
+        cache = ManifestCache(max_size=10)
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            with patch('ckanext.iiif.logic.actions.CACHE', cache):
+                assert build_iiif_resource('test') is None
+                assert build_iiif_resource('test') is None
+
+        assert mock_builder.match_and_build.call_count == 2
+        assert len(cache) == 0
+
+    def test_cache_error_not_cached(self):
+        mock_builder = MagicMock(
+            match_and_build=MagicMock(side_effect=IIIFBuildError('test', 'oh no!'))
+        )
+        cache = ManifestCache(max_size=10)
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            with patch('ckanext.iiif.logic.actions.CACHE', cache):
+                assert build_iiif_resource('test') is None
+
+        assert len(cache) == 0
+
+    def test_index(self):
+        resource_builder = MagicMock(
+            spec=RecordManifestBuilder,
+            prefixes=('resource',),
+            match_and_build=MagicMock(return_value={'beans': 3}),
+        )
+        other_builder = MagicMock(
+            spec=RecordManifestBuilder,
+            prefixes=('other',),
+            match_and_build=MagicMock(return_value={'arms': 5}),
+        )
+        builders = {'other': other_builder, 'resource': resource_builder}
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', builders):
+            with patch('ckanext.iiif.logic.actions.INDEX', BuilderIndex(builders)):
+                assert build_iiif_resource('resource/1/record/1') == {'beans': 3}
+                assert build_iiif_resource('unknown/1') is None
+
+        # the other builder is registered first but is never asked to match as its
+        # prefix doesn't match the identifiers
+        other_builder.match_and_build.assert_not_called()
+        resource_builder.match_and_build.assert_called_once_with('resource/1/record/1')
+
+    def test_default_index(self):
+        index = BuilderIndex(BUILDERS)
+        # a record identifier only reaches the record builder
+        assert index.candidates('resource/1/record/2') == [BUILDERS['record']]
+        assert index.candidates('resource/1/collection') == [BUILDERS['collection']]
+        # the record builder doesn't match canvas identifiers so it doesn't matter that
+        # it's a candidate after the canvas builder
+        assert index.candidates('resource/1/record/2/canvas/0') == [
+            BUILDERS['canvas'],
+            BUILDERS['record'],
+        ]
+        assert index.candidates('unknown/1') == []
+
+
+class TestBuildIIIFResources:
+    def test_no_builders(self):
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {}):
+            assert build_iiif_resources(['a', 'b']) == {
+                'a': {'error': 'Unknown IIIF identifier'},
+                'b': {'error': 'Unknown IIIF identifier'},
+            }
+
+    def test_mixed_results(self):
+        def match_and_build(identifier):
+            if identifier == 'error':
+                raise IIIFBuildError(identifier, 'oh no!')
+            if identifier == 'match':
+                return {'beans': 3}
+            return None
+
+        mock_builder = MagicMock(match_and_build=MagicMock(side_effect=match_and_build))
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            results = build_iiif_resources(['match', 'error', 'nope'])
+
+        assert list(results) == ['match', 'error', 'nope']
+        assert results['match'] == {'result': {'beans': 3}}
+        assert results['error'] == {
+            'error': str(IIIFBuildError('error', 'oh no!')),
+        }
+        assert results['nope'] == {'error': 'Unknown IIIF identifier'}
+
+    def test_not_authorised(self):
+        mock_builder = MagicMock(
+            match_and_build=MagicMock(side_effect=lambda identifier: {'id': identifier})
+        )
+        check_access = MagicMock(side_effect=toolkit.NotAuthorized())
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            with patch('ckanext.iiif.logic.auth.toolkit.check_access', check_access):
+                results = build_iiif_resources(['resource/1/record/1', 'other'])
+
+        assert results == {
+            'resource/1/record/1': {
+                'error': 'Not authorised to see this IIIF resource'
+            },
+            'other': {'result': {'id': 'other'}},
+        }
+        mock_builder.match_and_build.assert_called_once_with('other')
+
+    def test_access_checked_once_per_resource(self):
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value={'beans': 3}))
+        check_access = MagicMock()
+        identifiers = [
+            'resource/1/record/1',
+            'resource/1/record/2',
+            'resource/2/record/1',
+            'resource/1/record/3',
+        ]
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            with patch('ckanext.iiif.logic.auth.toolkit.check_access', check_access):
+                results = build_iiif_resources(identifiers)
+
+        assert all('result' in result for result in results.values())
+        assert [c.args[2] for c in check_access.call_args_list] == [
+            {'id': '1'},
+            {'id': '2'},
+        ]
+
+    @pytest.mark.ckan_config('ckanext.iiif.batch.max_size', '2')
+    def test_too_many(self):
+        with pytest.raises(toolkit.ValidationError):
+            build_iiif_resources(['a', 'b', 'c'])
+
+
+class TestGetIIIFResources:
+    def test_builders_get_all_unmatched_identifiers_at_once(self):
+        builder_1 = MagicMock(
+            spec=RecordManifestBuilder,
+            prefixes=(),
+            match_and_build_many=MagicMock(return_value={'a': {'beans': 3}}),
+        )
+        builder_2 = MagicMock(
+            spec=RecordManifestBuilder,
+            prefixes=(),
+            match_and_build_many=MagicMock(return_value={'b': {'arms': 5}}),
+        )
+        builders = {'mock1': builder_1, 'mock2': builder_2}
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', builders):
+            results = get_iiif_resources(['a', 'b', 'c'])
+
+        builder_1.match_and_build_many.assert_called_once_with(['a', 'b', 'c'])
+        builder_2.match_and_build_many.assert_called_once_with(['b', 'c'])
+        assert results['a'].data == {'beans': 3}
+        assert results['b'].data == {'arms': 5}
+        assert results['c'] is None
+
+    def test_error_stops_matching(self):
+        error = IIIFBuildError('a', 'oh no!')
+        builder_1 = MagicMock(
+            spec=RecordManifestBuilder,
+            prefixes=(),
+            match_and_build_many=MagicMock(return_value={'a': error}),
+        )
+        builder_2 = MagicMock(
+            spec=RecordManifestBuilder,
+            prefixes=(),
+            match_and_build_many=MagicMock(return_value={}),
+        )
+        builders = {'mock1': builder_1, 'mock2': builder_2}
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', builders):
+            results = get_iiif_resources(['a', 'b'])
+
+        builder_2.match_and_build_many.assert_called_once_with(['b'])
+        assert results == {'a': error, 'b': None}
+
+    def test_duplicates(self):
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value={'beans': 3}))
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            results = get_iiif_resources(['a', 'a'])
+
+        mock_builder.match_and_build.assert_called_once_with('a')
+        assert list(results) == ['a']
+
+    def test_cache(self):
+        cache = ManifestCache(max_size=10)
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value={'beans': 3}))
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            with patch('ckanext.iiif.logic.actions.CACHE', cache):
+                build_iiif_resource('a')
+                results = get_iiif_resources(['a', 'b'])
+
+        assert mock_builder.match_and_build.call_count == 2
+        assert results['a'] is cache.get('a')
+        assert results['b'] is cache.get('b')
+
+
+class TestGetIIIFResourceMetrics:
+    @pytest.fixture
+    def dispatch(self):
+        dispatch = Histogram('dispatch', 'test', ('builder', 'outcome'))
+        with patch('ckanext.iiif.logic.actions.metrics.DISPATCH', dispatch):
+            yield dispatch
+
+    @pytest.fixture
+    def builder_metric(self):
+        builder_metric = Histogram('builder', 'test', ('builder', 'outcome'))
+        with patch('ckanext.iiif.logic.actions.metrics.BUILDER', builder_metric):
+            yield builder_metric
+
+    def test_miss_and_hit(self, dispatch, builder_metric):
+        mock_builder = MagicMock(
+            BUILDER_ID='mock', match_and_build=MagicMock(return_value={'beans': 3})
+        )
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            with patch('ckanext.iiif.logic.actions.CACHE', ManifestCache(max_size=10)):
+                get_iiif_resource('test')
+                get_iiif_resource('test')
+
+        assert dispatch.get_count(builder='mock', outcome='miss') == 1
+        assert dispatch.get_count(builder='', outcome='hit') == 1
+        assert builder_metric.get_count(builder='mock', outcome='built') == 1
+
+    def test_404(self, dispatch, builder_metric):
+        mock_builder = MagicMock(
+            BUILDER_ID='mock', match_and_build=MagicMock(return_value=None)
+        )
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            get_iiif_resource('test')
+
+        assert dispatch.get_count(builder='', outcome='404') == 1
+        assert builder_metric.get_count(builder='mock', outcome='no_match') == 1
+
+    def test_error(self, dispatch, builder_metric):
+        mock_builder = MagicMock(
+            BUILDER_ID='mock',
+            match_and_build=MagicMock(side_effect=IIIFBuildError('test', 'oh no!')),
+        )
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            get_iiif_resource('test')
+
+        assert dispatch.get_count(builder='mock', outcome='error') == 1
+        assert builder_metric.get_count(builder='mock', outcome='error') == 1
+
+
+class TestGetIIIFResourceCoalescing:
+    @pytest.fixture
+    def dispatch(self):
+        dispatch = Histogram('dispatch', 'test', ('builder', 'outcome'))
+        with patch('ckanext.iiif.logic.actions.metrics.DISPATCH', dispatch):
+            yield dispatch
+
+    @pytest.fixture
+    def slow_builder(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def match_and_build(identifier):
+            started.set()
+            release.wait(5)
+            return {'beans': 3}
+
+        mock_builder = MagicMock(
+            BUILDER_ID='mock', match_and_build=MagicMock(side_effect=match_and_build)
+        )
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            yield mock_builder, started, release
+
+    def run_concurrently(self, started, release, count=4):
+        results = []
+
+        def get():
+            results.append(get_iiif_resource('test'))
+
+        threads = [threading.Thread(target=get) for _ in range(count)]
+        threads[0].start()
+        assert started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        # give the other threads a chance to join the in-flight build
+        threading.Event().wait(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_coalesced(self, dispatch, slow_builder):
+        mock_builder, started, release = slow_builder
+        with patch('ckanext.iiif.logic.actions.FLIGHTS', SingleFlight()):
+            results = self.run_concurrently(started, release)
+
+        assert mock_builder.match_and_build.call_count == 1
+        assert len(results) == 4
+        assert all(result is results[0] for result in results)
+        assert results[0].data == {'beans': 3}
+        assert dispatch.get_count(builder='mock', outcome='miss') == 1
+        assert dispatch.get_count(builder='', outcome='shared') == 3
+
+    def test_disabled(self, slow_builder):
+        mock_builder, started, release = slow_builder
+        with patch('ckanext.iiif.logic.actions.FLIGHTS', None):
+            results = self.run_concurrently(started, release)
+
+        assert mock_builder.match_and_build.call_count == 4
+        assert len(results) == 4
+
+    def test_shared_result_cached(self):
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value={'beans': 3}))
+        built = BuiltResource({'beans': 3})
+        flights = MagicMock(do=MagicMock(return_value=(built, PROCESS)))
+        cache = ManifestCache(max_size=10)
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            with patch('ckanext.iiif.logic.actions.FLIGHTS', flights):
+                with patch('ckanext.iiif.logic.actions.CACHE', cache):
+                    assert get_iiif_resource('test') is built
+
+        mock_builder.match_and_build.assert_not_called()
+        assert cache.get('test') is built
+
+    def test_thread_result_not_cached_again(self):
+        # the thread which built the result has already cached it, so writing it again
+        # would just be redundant work for the shared cache backends
+        built = BuiltResource({'beans': 3})
+        flights = MagicMock(do=MagicMock(return_value=(built, THREAD)))
+        cache = MagicMock(get=MagicMock(return_value=None))
+        with patch('ckanext.iiif.logic.actions.FLIGHTS', flights):
+            with patch('ckanext.iiif.logic.actions.CACHE', cache):
+                assert get_iiif_resource('test') is built
+
+        cache.set.assert_not_called()
+
+    def test_skip_cache_not_coalesced(self):
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value={'beans': 3}))
+        flights = MagicMock()
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            with patch('ckanext.iiif.logic.actions.FLIGHTS', flights):
+                assert get_iiif_resource('test', use_cache=False).data == {'beans': 3}
+
+        flights.do.assert_not_called()
+
+
+class TestGetBuilderID:
+    def test_builder_id(self):
+        assert get_builder_id(RecordManifestBuilder()) == 'record'
+
+    def test_no_builder_id(self):
+        class MyBuilder:
+            pass
+
+        assert get_builder_id(MyBuilder()) == 'MyBuilder'
+        assert get_builder_id(MagicMock()) == 'MagicMock'
+
+
+class TestBuildIIIFResourceProfiling:
+    @pytest.fixture
+    def mock_builder(self):
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value={'beans': 3}))
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            yield mock_builder
+
+    def test_profile(self, mock_builder):
+        with patch('ckanext.iiif.logic.actions.toolkit.check_access') as check_access:
+            result = build_iiif_resource('test', profile=True)
+
+        check_access.assert_called_once_with(
+            'profile_iiif_resource', {}, {'identifier': 'test'}
+        )
+        assert result['result'] == {'beans': 3}
+        assert result['profile']['label'] == 'test'
+        assert 'stats' in result['profile']
+
+    def test_profile_not_authorised(self, mock_builder):
+        check_access = MagicMock(side_effect=toolkit.NotAuthorized())
+        with patch('ckanext.iiif.logic.actions.toolkit.check_access', check_access):
+            with pytest.raises(toolkit.NotAuthorized):
+                build_iiif_resource('test', profile=True)
+
+        mock_builder.match_and_build.assert_not_called()
+
+    def test_profile_skips_cache(self, mock_builder):
+        with patch('ckanext.iiif.logic.actions.CACHE', ManifestCache(max_size=10)):
+            with patch('ckanext.iiif.logic.actions.toolkit.check_access'):
+                build_iiif_resource('test')
+                build_iiif_resource('test', profile=True)
+
+        assert mock_builder.match_and_build.call_count == 2
+
+    def test_sampled(self, mock_builder):
+        with patch('ckanext.iiif.logic.actions.profiling.SAMPLE_RATE', 1):
+            with patch('ckanext.iiif.logic.actions.profiling.log_report') as log_report:
+                assert build_iiif_resource('test') == {'beans': 3}
+
+        log_report.assert_called_once()
+        assert log_report.call_args.args[0]['label'] == 'test'
+
 
 class TestBuildIIIFIdentifier:
     def test_no_builders(self):
@@ -1,13 +1,79 @@
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
-from ckanext.iiif.logic.auth import build_iiif_identifier, build_iiif_resource
+import pytest
+from ckan.plugins import toolkit
+
+from ckanext.iiif.logic.auth import (
+    build_iiif_identifier,
+    build_iiif_resource,
+    build_iiif_resources,
+    can_access,
+    profile_iiif_resource,
+    view_iiif_metrics,
+)
+
+
+@pytest.fixture
+def check_access():
+    with patch('ckanext.iiif.logic.auth.toolkit.check_access') as check_access_mock:
+        yield check_access_mock
+
+
+class TestCanAccess:
+    def test_not_built_from_a_resource(self, check_access):
+        assert can_access({}, 'other/1')
+        check_access.assert_not_called()
+
+    def test_allowed(self, check_access):
+        assert can_access({'user': 'beans'}, 'resource/1/record/2')
+        check_access.assert_called_once_with(
+            'resource_show', {'user': 'beans'}, {'id': '1'}
+        )
+
+    def test_not_allowed(self, check_access):
+        check_access.side_effect = toolkit.NotAuthorized()
+        assert not can_access({}, 'resource/1/record/2')
+
+    def test_not_found(self, check_access):
+        # the builder reports that the resource doesn't exist
+        check_access.side_effect = toolkit.ObjectNotFound()
+        assert can_access({}, 'resource/1/record/2')
+
+    def test_loaded_objects_not_reused(self, check_access):
+        context = {'user': 'beans', 'resource': MagicMock(), 'package': MagicMock()}
+        can_access(context, 'resource/1')
+        assert check_access.call_args.args[1] == {'user': 'beans'}
 
 
 class TestBuildIIIFResource:
-    def test_always_success(self):
-        assert build_iiif_resource(MagicMock(), MagicMock())['success']
+    def test_allowed(self, check_access):
+        data_dict = {'identifier': 'resource/1/record/2'}
+        assert build_iiif_resource({}, data_dict)['success']
+
+    def test_not_allowed(self, check_access):
+        check_access.side_effect = toolkit.NotAuthorized()
+        data_dict = {'identifier': 'resource/1/record/2'}
+        assert not build_iiif_resource({}, data_dict)['success']
+
+    def test_no_identifier(self, check_access):
+        assert build_iiif_resource({}, None)['success']
 
 
 class TestBuildIIIFIdentifier:
     def test_always_success(self):
         assert build_iiif_identifier(MagicMock(), MagicMock())['success']
+
+
+class TestBuildIIIFResources:
+    def test_always_success(self):
+        assert build_iiif_resources(MagicMock(), MagicMock())['success']
+
+
+class TestViewIIIFMetrics:
+    def test_always_fails(self):
+        assert not view_iiif_metrics(MagicMock(), MagicMock())['success']
+
+
+class TestProfileIIIFResource:
+    def test_always_fails(self):
+        assert not profile_iiif_resource(MagicMock(), MagicMock())['success']
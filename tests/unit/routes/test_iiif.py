@@ -1,9 +1,24 @@
+import gzip
+import json
+from datetime import datetime, timezone
 from unittest.mock import MagicMock, patch
 
 import pytest
 from flask import Response
 
-from ckanext.iiif.routes.iiif import blueprint, resource
+from ckanext.iiif.builders.model import Canvas, Manifest
+from ckanext.iiif.lib.cache import ManifestCache
+from ckanext.iiif.lib.resources import BuiltResource
+from ckanext.iiif.lib.store import ManifestStore
+from ckanext.iiif.routes.iiif import (
+    blueprint,
+    choose_encoding,
+    get_accepted_encodings,
+    is_not_modified,
+    resource,
+    send_prebuilt,
+    should_stream,
+)
 
 
 @pytest.mark.ckan_config('ckan.plugins', 'iiif')
@@ -38,3 +53,374 @@ class TestIIIFRoute:
                 assert resource('test') is mock_abort.return_value
 
         mock_abort.assert_called_with(status_code=404, detail='Unknown IIIF identifier')
+
+    def test_conditional_headers(self):
+        mock_manifest = {'limbs': True}
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value=mock_manifest))
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            response: Response = resource('test')
+
+        assert response.headers['ETag'] == f'"{BuiltResource(mock_manifest).etag}"'
+        assert 'Last-Modified' in response.headers
+
+
+class TestIsNotModified:
+    built = BuiltResource(
+        {'limbs': True}, datetime(2024, 5, 1, 12, tzinfo=timezone.utc)
+    )
+
+    def test_no_headers(self, test_request_context):
+        with test_request_context():
+            assert not is_not_modified(self.built)
+
+    def test_if_none_match(self, test_request_context):
+        headers = {'If-None-Match': f'"{self.built.etag}"'}
+        with test_request_context(headers=headers):
+            assert is_not_modified(self.built)
+
+    def test_if_none_match_weak(self, test_request_context):
+        headers = {'If-None-Match': f'W/"{self.built.etag}"'}
+        with test_request_context(headers=headers):
+            assert is_not_modified(self.built)
+
+    def test_if_none_match_other(self, test_request_context):
+        headers = {'If-None-Match': '"beans"'}
+        with test_request_context(headers=headers):
+            assert not is_not_modified(self.built)
+
+    def test_if_modified_since_later(self, test_request_context):
+        headers = {'If-Modified-Since': 'Wed, 01 May 2024 13:00:00 GMT'}
+        with test_request_context(headers=headers):
+            assert is_not_modified(self.built)
+
+    def test_if_modified_since_same(self, test_request_context):
+        headers = {'If-Modified-Since': 'Wed, 01 May 2024 12:00:00 GMT'}
+        with test_request_context(headers=headers):
+            assert is_not_modified(self.built)
+
+    def test_if_modified_since_earlier(self, test_request_context):
+        headers = {'If-Modified-Since': 'Wed, 01 May 2024 11:00:00 GMT'}
+        with test_request_context(headers=headers):
+            assert not is_not_modified(self.built)
+
+    def test_if_modified_since_uses_modified(self, test_request_context):
+        # the resource was built after the If-Modified-Since time but the data it was
+        # built from hasn't been modified since
+        built = BuiltResource(
+            {'limbs': True},
+            datetime(2024, 5, 1, 14, tzinfo=timezone.utc),
+            datetime(2024, 5, 1, 12, tzinfo=timezone.utc),
+        )
+        headers = {'If-Modified-Since': 'Wed, 01 May 2024 13:00:00 GMT'}
+        with test_request_context(headers=headers):
+            assert is_not_modified(built)
+
+    def test_if_none_match_takes_precedence(self, test_request_context):
+        headers = {
+            'If-None-Match': '"beans"',
+            'If-Modified-Since': 'Wed, 01 May 2024 13:00:00 GMT',
+        }
+        with test_request_context(headers=headers):
+            assert not is_not_modified(self.built)
+
+
+class TestShouldStream:
+    def test_small(self):
+        assert not should_stream(BuiltResource({'items': [1, 2, 3]}))
+
+    def test_large(self):
+        assert should_stream(BuiltResource({'items': list(range(1001))}))
+
+    def test_no_items(self):
+        assert not should_stream(BuiltResource({'beans': list(range(1001))}))
+
+    @pytest.mark.ckan_config('ckanext.iiif.stream_threshold', '0')
+    def test_disabled(self):
+        assert not should_stream(BuiltResource({'items': list(range(1001))}))
+
+    @pytest.mark.ckan_config('ckanext.iiif.stream_threshold', '2')
+    def test_threshold(self):
+        assert should_stream(BuiltResource({'items': [1, 2, 3]}))
+
+    def test_serialised(self):
+        built = BuiltResource({'items': list(range(1001))})
+        assert built.body
+        assert not should_stream(built)
+
+    def test_cached(self):
+        built = BuiltResource({'items': list(range(1001))})
+        with patch('ckanext.iiif.logic.actions.CACHE', ManifestCache(10)):
+            assert not should_stream(built)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'iiif')
+@pytest.mark.ckan_config('ckanext.iiif.stream_threshold', '2')
+@pytest.mark.usefixtures('with_plugins', 'with_request_context')
+class TestIIIFRouteStreaming:
+    def test_streamed(self):
+        mock_manifest = {'id': 'test', 'items': [{'id': i} for i in range(100)]}
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value=mock_manifest))
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            response: Response = resource('test')
+
+        assert response.is_streamed
+        assert response.content_type == 'application/json'
+        assert 'ETag' not in response.headers
+        assert 'Last-Modified' in response.headers
+        assert json.loads(b''.join(response.response)) == mock_manifest
+
+
+class TestSendPrebuilt:
+    @pytest.fixture
+    def store(self, tmp_path):
+        store = ManifestStore(str(tmp_path))
+        store.write('resource/1/record/1', b'{"beans":3}')
+        store.write('resource/1/record/1', b'gzipped', '.json.gz')
+        with patch('ckanext.iiif.routes.iiif.store.STORE', store):
+            yield store
+
+    def test_no_store(self, test_request_context):
+        with test_request_context():
+            assert send_prebuilt('resource/1/record/1') is None
+
+    def test_missing(self, test_request_context, store):
+        with test_request_context():
+            assert send_prebuilt('resource/1/record/2') is None
+
+    def test_uncompressed(self, test_request_context, store):
+        with test_request_context():
+            response = send_prebuilt('resource/1/record/1')
+            response.direct_passthrough = False
+            assert response.status_code == 200
+            assert response.content_type == 'application/json'
+            assert response.get_data() == b'{"beans":3}'
+            assert 'Content-Encoding' not in response.headers
+            assert 'Content-Disposition' not in response.headers
+            assert 'Accept-Encoding' in response.vary
+            assert response.headers['ETag']
+
+    def test_compressed(self, test_request_context, store):
+        headers = {'Accept-Encoding': 'br, gzip'}
+        with test_request_context(headers=headers):
+            response = send_prebuilt('resource/1/record/1')
+            response.direct_passthrough = False
+            assert response.get_data() == b'gzipped'
+            assert response.headers['Content-Encoding'] == 'gzip'
+
+    def test_not_modified(self, test_request_context, store):
+        with test_request_context():
+            etag = send_prebuilt('resource/1/record/1').headers['ETag']
+        with test_request_context(headers={'If-None-Match': etag}):
+            assert send_prebuilt('resource/1/record/1').status_code == 304
+
+    @pytest.mark.ckan_config('ckan.plugins', 'iiif')
+    @pytest.mark.usefixtures('with_plugins', 'with_request_context')
+    def test_served_before_building(self, store):
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value={'beans': 4}))
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            response: Response = resource('resource/1/record/1')
+            response.direct_passthrough = False
+            assert response.get_data() == b'{"beans":3}'
+            # but things that aren't in the store are still built
+            assert resource('resource/1/record/2').json == {'beans': 4}
+
+        mock_builder.match_and_build.assert_called_once_with('resource/1/record/2')
+
+
+class TestGetAcceptedEncodings:
+    @pytest.mark.parametrize(
+        'accept_encoding,expected',
+        [
+            (None, []),
+            ('gzip', ['gzip']),
+            ('gzip, br', ['br', 'gzip']),
+            ('br;q=0.5, gzip', ['gzip', 'br']),
+            ('gzip;q=0, br', ['br']),
+            ('*', ['br', 'gzip']),
+            ('deflate', []),
+        ],
+    )
+    def test_encodings(self, test_request_context, accept_encoding, expected):
+        headers = {'Accept-Encoding': accept_encoding} if accept_encoding else {}
+        with test_request_context(headers=headers):
+            assert get_accepted_encodings(['br', 'gzip']) == expected
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'iiif')
+@pytest.mark.usefixtures('with_plugins')
+class TestCompression:
+    large = {'items': [{'id': i, 'type': 'Canvas'} for i in range(100)]}
+
+    def test_compressed(self, test_request_context):
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value=self.large))
+        headers = {'Accept-Encoding': 'gzip'}
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            with test_request_context(headers=headers):
+                response: Response = resource('test')
+
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in response.vary
+        assert json.loads(gzip.decompress(response.get_data())) == self.large
+        built = BuiltResource(self.large)
+        assert response.headers['ETag'] == f'"{built.get_etag("gzip")}"'
+
+    def test_not_accepted(self, test_request_context):
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value=self.large))
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            with test_request_context():
+                response: Response = resource('test')
+
+        assert 'Content-Encoding' not in response.headers
+        assert 'Accept-Encoding' in response.vary
+        assert response.json == self.large
+
+    def test_not_modified(self, test_request_context):
+        built = BuiltResource(self.large)
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value=self.large))
+        headers = {
+            'Accept-Encoding': 'gzip',
+            'If-None-Match': f'"{built.get_etag("gzip")}"',
+        }
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            with test_request_context(headers=headers):
+                response: Response = resource('test')
+
+        assert response.status_code == 304
+
+    def test_cached(self, test_request_context):
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value=self.large))
+        cache = ManifestCache(max_size=10)
+        headers = {'Accept-Encoding': 'gzip'}
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            with patch('ckanext.iiif.logic.actions.CACHE', cache):
+                with test_request_context(headers=headers):
+                    first = resource('test').get_data()
+                with test_request_context(headers=headers):
+                    second = resource('test').get_data()
+
+        assert first == second
+        # the compressed body is kept on the cached resource
+        assert cache.get('test').get_body('gzip') == first
+
+    @pytest.mark.ckan_config('ckanext.iiif.stream_threshold', '2')
+    def test_streamed(self, test_request_context):
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value=self.large))
+        headers = {'Accept-Encoding': 'gzip'}
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            with test_request_context(headers=headers):
+                response: Response = resource('test')
+                assert response.is_streamed
+                body = b''.join(response.response)
+
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert json.loads(gzip.decompress(body)) == self.large
+
+
+def make_manifest(modified):
+    return Manifest(
+        id='https://iiif/manifest',
+        label={'none': ['beans']},
+        metadata=[],
+        rights='https://rights',
+        items=[Canvas(f'https://canvas/{i}', 1, 1, 'beans', ()) for i in range(100)],
+        logo=None,
+        modified=modified,
+    )
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'iiif')
+@pytest.mark.usefixtures('with_plugins')
+class TestWeakETag:
+    modified = datetime(2024, 5, 1, 12, tzinfo=timezone.utc)
+
+    def test_sent(self, test_request_context):
+        manifest = make_manifest(self.modified)
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value=manifest))
+        etag = BuiltResource(manifest).etag
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            with test_request_context(headers={'Accept-Encoding': 'gzip'}):
+                compressed: Response = resource('test')
+            with test_request_context():
+                uncompressed: Response = resource('test')
+
+        assert compressed.headers['Content-Encoding'] == 'gzip'
+        # the encodings share the weak ETag
+        assert compressed.headers['ETag'] == f'W/"{etag}"'
+        assert uncompressed.headers['ETag'] == f'W/"{etag}"'
+        assert compressed.last_modified == self.modified
+
+    @pytest.mark.parametrize(
+        'header,value',
+        [
+            ('If-None-Match', None),
+            ('If-Modified-Since', 'Wed, 01 May 2024 12:00:00 GMT'),
+        ],
+    )
+    def test_not_modified_without_serialising(
+        self, test_request_context, header, value
+    ):
+        manifest = make_manifest(self.modified)
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value=manifest))
+        etag = BuiltResource(manifest).etag
+        headers = {'Accept-Encoding': 'gzip', header: value or f'W/"{etag}"'}
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            with patch.object(Manifest, 'to_json') as to_json_mock:
+                with patch.object(Manifest, 'iter_json') as iter_json_mock:
+                    with test_request_context(headers=headers):
+                        response: Response = resource('test')
+
+        assert response.status_code == 304
+        assert response.headers['ETag'] == f'W/"{etag}"'
+        assert 'Accept-Encoding' in response.vary
+        to_json_mock.assert_not_called()
+        iter_json_mock.assert_not_called()
+
+    def test_modified(self, test_request_context):
+        manifest = make_manifest(self.modified)
+        mock_builder = MagicMock(match_and_build=MagicMock(return_value=manifest))
+        older = BuiltResource(make_manifest(datetime(2024, 4, 1, tzinfo=timezone.utc)))
+        headers = {'If-None-Match': f'W/"{older.etag}"'}
+
+        with patch('ckanext.iiif.logic.actions.BUILDERS', {'mock': mock_builder}):
+            with test_request_context(headers=headers):
+                response: Response = resource('test')
+
+        assert response.status_code == 200
+        assert response.json == manifest.to_dict()
+
+
+class TestChooseEncoding:
+    large = BuiltResource({'items': list(range(1000))})
+    small = BuiltResource({'beans': 3})
+
+    def test_large(self, test_request_context):
+        with test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            assert choose_encoding(self.large) == 'gzip'
+
+    def test_small(self, test_request_context):
+        with test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            assert choose_encoding(self.small) is None
+
+    def test_not_accepted(self, test_request_context):
+        with test_request_context(headers={'Accept-Encoding': 'identity'}):
+            assert choose_encoding(self.large) is None
+
+    @pytest.mark.ckan_config('ckanext.iiif.compression.min_size', '0')
+    def test_no_min_size(self, test_request_context):
+        with test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            assert choose_encoding(self.small) == 'gzip'
+
+    @pytest.mark.ckan_config('ckanext.iiif.compression.enabled', 'false')
+    def test_disabled(self, test_request_context):
+        with test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            assert choose_encoding(self.large) is None
@@ -0,0 +1,65 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+# the maximum time importing the plugin module should take, in seconds. This is generous
+# as it needs to pass on slow CI machines but catches the plugin pulling in the builders
+# and everything they import again
+IMPORT_BUDGET = 0.5
+
+# modules which should only be imported when they are first used
+HEAVY_MODULES = [
+    'ckan.lib.helpers',
+    'ckan.model',
+    'ckanext.iiif.builders.canvas',
+    'ckanext.iiif.builders.collection',
+    'ckanext.iiif.builders.manifest',
+    'ckanext.iiif.builders.template',
+    'ckanext.iiif.lib.prebuild',
+    'requests',
+]
+
+# imports the given module in a fresh interpreter and reports how long it took and which
+# modules it loaded. CKAN itself, Flask and the ckanext namespace package are imported
+# first as they are always loaded before this plugin is and aren't our cost
+IMPORT_SCRIPT = """
+import json, sys, time
+import ckan.plugins, ckanext, flask
+before = set(sys.modules)
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'elapsed': elapsed, 'loaded': sorted(set(sys.modules) - before)}}))
+"""
+
+
+def measure_import(module: str) -> dict:
+    output = subprocess.run(
+        [sys.executable, '-c', IMPORT_SCRIPT.format(module=module)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def test_plugin_import_budget():
+    # take the best of a few runs to smooth out noise from the machine
+    elapsed = min(measure_import('ckanext.iiif.plugin')['elapsed'] for _ in range(3))
+    assert elapsed < IMPORT_BUDGET
+
+
+@pytest.mark.parametrize(
+    'module',
+    [
+        'ckanext.iiif.plugin',
+        'ckanext.iiif.cli',
+        'ckanext.iiif.logic.actions',
+        'ckanext.iiif.routes',
+    ],
+)
+def test_heavy_modules_not_imported(module):
+    loaded = set(measure_import(module)['loaded'])
+    assert not loaded.intersection(HEAVY_MODULES)
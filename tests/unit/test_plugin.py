@@ -1,11 +1,18 @@
 from unittest.mock import MagicMock, call, patch
 
 import pytest
+from ckan.lib.redis import connect_to_redis
 from ckan.tests import factories
 
 from ckanext.iiif.builders.manifest import RecordManifestBuilder
+from ckanext.iiif.cli import iiif
+from ckanext.iiif.lib import dimensions, licences, profiling, store
+from ckanext.iiif.lib.cache import ManifestCache, RedisCache, SQLiteCache
+from ckanext.iiif.lib.resources import BuiltResource
+from ckanext.iiif.lib.search import internal_query
+from ckanext.iiif.lib.singleflight import SingleFlight
 from ckanext.iiif.logic import actions
-from ckanext.iiif.plugin import IIIFPlugin
+from ckanext.iiif.plugin import IIIFPlugin, create_cache
 
 
 @pytest.mark.usefixtures('clean_db')
@@ -32,7 +39,8 @@ class TestVDSAfterMultiQuery:
         )
 
         with patch(
-            'ckanext.iiif.plugin.RecordManifestBuilder', mock_record_manifest_builder
+            'ckanext.iiif.builders.manifest.RecordManifestBuilder',
+            mock_record_manifest_builder,
         ):
             plugin.vds_after_multi_query(MagicMock(), result)
 
@@ -65,7 +73,7 @@ class TestVDSAfterMultiQuery:
         )
 
         with patch(
-            'ckanext.iiif.plugin.RecordManifestBuilder',
+            'ckanext.iiif.builders.manifest.RecordManifestBuilder',
             mock_record_manifest_builder,
         ):
             plugin.vds_after_multi_query(MagicMock(), result)
@@ -77,6 +85,39 @@ class TestVDSAfterMultiQuery:
             call(resource_2, record_data_3),
         ]
 
+    @pytest.mark.ckan_config('ckanext.iiif.search_mode', 'reference')
+    def test_reference_mode(self):
+        plugin = IIIFPlugin()
+
+        resource_1 = factories.Resource()
+        record_data_1 = MagicMock()
+        result = {'records': [{'resource': resource_1['id'], 'data': record_data_1}]}
+
+        mock_record_manifest_builder = MagicMock(
+            build_record_manifest_reference=MagicMock(return_value='ref')
+        )
+
+        with patch(
+            'ckanext.iiif.builders.manifest.RecordManifestBuilder',
+            mock_record_manifest_builder,
+        ):
+            plugin.vds_after_multi_query(MagicMock(), result)
+
+        assert result['records'][0]['iiif'] == 'ref'
+        mock_record_manifest_builder.build_record_manifest.assert_not_called()
+        mock_record_manifest_builder.build_record_manifest_reference.assert_called_once_with(
+            resource_1, record_data_1
+        )
+
+    def test_internal_query_skipped(self):
+        plugin = IIIFPlugin()
+        result = {'records': [{'resource': 'beans', 'data': MagicMock()}]}
+
+        with internal_query():
+            plugin.vds_after_multi_query(MagicMock(), result)
+
+        assert 'iiif' not in result['records'][0]
+
     def test_complete(self):
         # the other tests mock away build_record_manifest in order to control its
         # behaviour, but we should check that that is being used correctly too so that's
@@ -120,6 +161,219 @@ class TestConfigure:
             'ckanext.iiif.plugin.plugins.PluginImplementations',
             plugin_implementations_mock,
         ):
-            plugin.configure(MagicMock())
+            with patch('ckanext.iiif.logic.actions.CACHE', ManifestCache()):
+                plugin.configure({})
 
         assert actions.BUILDERS['test'] == 'yay!'
+        assert actions.INDEX.is_current(actions.BUILDERS)
+
+    def test_cache_defaults(self):
+        plugin = IIIFPlugin()
+
+        with patch('ckanext.iiif.logic.actions.CACHE', ManifestCache()):
+            plugin.configure({})
+            assert not actions.CACHE.enabled
+            assert actions.CACHE.ttl == 300
+
+    def test_cache_configured(self):
+        plugin = IIIFPlugin()
+        config = {'ckanext.iiif.cache.size': '100', 'ckanext.iiif.cache.ttl': '60'}
+
+        with patch('ckanext.iiif.logic.actions.CACHE', ManifestCache()):
+            plugin.configure(config)
+            assert actions.CACHE.max_size == 100
+            assert actions.CACHE.ttl == 60
+
+    def test_cache_sqlite(self, tmp_path):
+        config = {
+            'ckanext.iiif.cache.backend': 'sqlite',
+            'ckanext.iiif.cache.path': str(tmp_path / 'cache.db'),
+            'ckanext.iiif.cache.size': '100',
+            'ckanext.iiif.cache.ttl': '60',
+        }
+
+        with patch('ckanext.iiif.logic.actions.CACHE', ManifestCache()):
+            IIIFPlugin().configure(config)
+            assert isinstance(actions.CACHE, SQLiteCache)
+            assert actions.CACHE.path == config['ckanext.iiif.cache.path']
+            assert actions.CACHE.max_size == 100
+            assert actions.CACHE.ttl == 60
+
+    def test_cache_redis(self):
+        config = {'ckanext.iiif.cache.backend': 'redis'}
+
+        with patch('ckanext.iiif.logic.actions.CACHE', ManifestCache()):
+            IIIFPlugin().configure(config)
+            assert isinstance(actions.CACHE, RedisCache)
+            assert actions.CACHE.connect is connect_to_redis
+            assert actions.CACHE.ttl == 300
+
+    def test_dimensions_disabled_by_default(self):
+        with patch('ckanext.iiif.lib.dimensions.RESOLVER', None):
+            IIIFPlugin().configure({})
+            assert dimensions.RESOLVER is None
+
+    def test_dimensions_enabled(self, tmp_path):
+        config = {
+            'ckanext.iiif.dimensions.enabled': 'true',
+            'ckanext.iiif.dimensions.store': str(tmp_path / 'dimensions.db'),
+            'ckanext.iiif.dimensions.timeout': '0.5',
+            'ckanext.iiif.dimensions.workers': '2',
+        }
+        with patch('ckanext.iiif.lib.dimensions.RESOLVER', None):
+            IIIFPlugin().configure(config)
+            assert dimensions.RESOLVER.timeout == 0.5
+            assert (
+                dimensions.RESOLVER.store.path
+                == config['ckanext.iiif.dimensions.store']
+            )
+
+    def test_licences(self):
+        config = {'ckanext.iiif.licences.refresh_interval': '60'}
+        with patch('ckanext.iiif.lib.licences.LICENCES', None):
+            IIIFPlugin().configure(config)
+            assert licences.LICENCES.refresh_interval == 60
+            assert licences.LICENCES.stale
+
+    def test_profiling(self):
+        config = {
+            'ckanext.iiif.profiling.sample_rate': '0.01',
+            'ckanext.iiif.profiling.dir': '/tmp/profiles',
+        }
+        with patch('ckanext.iiif.lib.profiling.SAMPLE_RATE', 0):
+            with patch('ckanext.iiif.lib.profiling.OUTPUT_DIR', None):
+                IIIFPlugin().configure(config)
+                assert profiling.SAMPLE_RATE == 0.01
+                assert profiling.OUTPUT_DIR == '/tmp/profiles'
+
+    def test_profiling_defaults(self):
+        with patch('ckanext.iiif.lib.profiling.SAMPLE_RATE', 0.5):
+            with patch('ckanext.iiif.lib.profiling.OUTPUT_DIR', '/tmp/profiles'):
+                IIIFPlugin().configure({})
+                assert profiling.SAMPLE_RATE == 0
+                assert profiling.OUTPUT_DIR is None
+
+    def test_store(self, tmp_path):
+        config = {'ckanext.iiif.store.dir': str(tmp_path)}
+        with patch('ckanext.iiif.lib.store.STORE', None):
+            IIIFPlugin().configure(config)
+            assert store.STORE.root == str(tmp_path)
+
+    def test_no_store(self):
+        with patch('ckanext.iiif.lib.store.STORE', MagicMock()):
+            IIIFPlugin().configure({})
+            assert store.STORE is None
+
+    def test_coalesce_defaults(self):
+        with patch('ckanext.iiif.logic.actions.FLIGHTS', None):
+            IIIFPlugin().configure({})
+            assert isinstance(actions.FLIGHTS, SingleFlight)
+            assert actions.FLIGHTS.shared is None
+            assert actions.FLIGHTS.timeout == 10
+
+    def test_coalesce_disabled(self):
+        config = {'ckanext.iiif.coalesce.enabled': 'false'}
+        with patch('ckanext.iiif.logic.actions.FLIGHTS', SingleFlight()):
+            IIIFPlugin().configure(config)
+            assert actions.FLIGHTS is None
+
+    def test_coalesce_shared(self):
+        config = {
+            'ckanext.iiif.coalesce.shared': 'true',
+            'ckanext.iiif.coalesce.timeout': '5',
+            'ckanext.iiif.coalesce.lock_timeout': '60',
+        }
+        with patch('ckanext.iiif.logic.actions.FLIGHTS', None):
+            IIIFPlugin().configure(config)
+            assert actions.FLIGHTS.timeout == 5
+            assert actions.FLIGHTS.shared.timeout == 5
+            assert actions.FLIGHTS.shared.lock_timeout == 60
+            assert actions.FLIGHTS.shared.connect is connect_to_redis
+
+
+class TestCreateCache:
+    def test_sqlite_needs_path(self):
+        with pytest.raises(ValueError, match='ckanext.iiif.cache.path'):
+            create_cache({'ckanext.iiif.cache.backend': 'sqlite'})
+
+    def test_redis_url(self):
+        cache = create_cache(
+            {
+                'ckanext.iiif.cache.backend': 'redis',
+                'ckanext.iiif.cache.redis_url': 'redis://localhost:6379/3',
+            }
+        )
+        assert cache.connect.args == ('redis://localhost:6379/3',)
+
+    def test_compressed_copies_stored(self, tmp_path):
+        cache = create_cache(
+            {
+                'ckanext.iiif.cache.backend': 'sqlite',
+                'ckanext.iiif.cache.path': str(tmp_path / 'cache.db'),
+                'ckanext.iiif.compression.min_size': '0',
+            }
+        )
+        cache.set('test', BuiltResource({'beans': 3}))
+        with patch.dict('ckanext.iiif.lib.resources.COMPRESSORS', clear=True):
+            assert cache.get('test').get_body('gzip')
+
+    def test_compression_disabled(self):
+        cache = create_cache(
+            {
+                'ckanext.iiif.cache.backend': 'redis',
+                'ckanext.iiif.compression.enabled': 'false',
+            }
+        )
+        assert cache.dump is BuiltResource.dump
+
+    def test_unknown(self):
+        with pytest.raises(ValueError, match='Unknown cache backend: beans'):
+            create_cache({'ckanext.iiif.cache.backend': 'beans'})
+
+
+class TestCacheInvalidation:
+    @pytest.fixture
+    def cache(self):
+        cache = ManifestCache(max_size=10)
+        cache.set('resource/1/record/1', 1)
+        cache.set('resource/2/record/1', 2)
+        with patch('ckanext.iiif.logic.actions.CACHE', cache):
+            yield cache
+
+    @pytest.fixture
+    def templates(self):
+        templates = ManifestCache(max_size=10)
+        templates.set('resource/1/2024-01-01T00:00:00', 1)
+        templates.set('resource/2/2024-01-01T00:00:00', 2)
+        with patch('ckanext.iiif.builders.template.TEMPLATES', templates):
+            yield templates
+
+    @pytest.fixture
+    def manifest_store(self):
+        manifest_store = MagicMock()
+        with patch('ckanext.iiif.lib.store.STORE', manifest_store):
+            yield manifest_store
+
+    def test_after_resource_update(self, cache, templates):
+        IIIFPlugin().after_resource_update({}, {'id': '1'})
+        assert cache.get('resource/1/record/1') is None
+        assert cache.get('resource/2/record/1') == 2
+        assert templates.get('resource/1/2024-01-01T00:00:00') is None
+        assert templates.get('resource/2/2024-01-01T00:00:00') == 2
+
+    def test_before_resource_delete(self, cache, templates):
+        IIIFPlugin().before_resource_delete({}, {'id': '1'}, [])
+        assert cache.get('resource/1/record/1') is None
+        assert cache.get('resource/2/record/1') == 2
+        assert templates.get('resource/1/2024-01-01T00:00:00') is None
+        assert templates.get('resource/2/2024-01-01T00:00:00') == 2
+
+    def test_store(self, cache, templates, manifest_store):
+        IIIFPlugin().after_resource_update({}, {'id': '1'})
+        IIIFPlugin().before_resource_delete({}, {'id': '2'}, [])
+        assert manifest_store.invalidate.call_args_list == [call('1'), call('2')]
+
+
+class TestGetCommands:
+    def test_commands(self):
+        assert IIIFPlugin().get_commands() == [iiif]